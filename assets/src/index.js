@@ -1,6 +1,6 @@
-import React, {useEffect, useState} from 'react';
+import React, {useEffect, useRef, useState} from 'react';
 import ReactDOM from 'react-dom';
-import Select from 'react-select';
+import AsyncSelect from 'react-select/async';
 import chroma from 'chroma-js';
 
 const labelColorRect = ({backgroundColor, borderColor}) => ({
@@ -43,36 +43,81 @@ function useDebounce(value, delay, callback) {
   }, [value, delay, callback]);
 }
 
-function LabelSelect({url, ticket, initial}) {
-  const [options, setOptions] = useState();
+function toOptions(labels) {
+  return labels.map(l => ({
+    value: l.pk,
+    label: l.name,
+    color: l.color,
+  }));
+}
+
+async function fetchLabels(url, params) {
+  const query = new URLSearchParams(params).toString();
+  return toOptions(await (await fetch(`${url}?${query}`)).json());
+}
+
+// Apply the change from base to labels on top of current.
+function mergeLabels(base, labels, current) {
+  const added = labels.filter(pk => !base.includes(pk));
+  const removed = base.filter(pk => !labels.includes(pk));
+  return [...new Set([...current, ...added])].filter(pk => !removed.includes(pk));
+}
+
+function LabelSelect({url, ticket, initial, version}) {
   const [selection, setSelection] = useState();
   const [canUpdate, setCanUpdate] = useState(false);
+  // The ticket as last seen from the server, which edits are made against.
+  const saved = useRef({version, labels: initial});
+  const merged = useRef(false);
 
   useDebounce(selection, 1500, async function (newLabels) {
     if (!canUpdate) return;
-    await post(url, {
-      ticket: ticket,
-      labels: (newLabels || []).map(e => e.value),
-    });
+    if (merged.current) {
+      // Already saved, this is the result of a merge.
+      merged.current = false;
+      return;
+    }
+    let labels = (newLabels || []).map(e => e.value);
+    let retried = false;
+    for (let attempt = 0; attempt < 3; attempt++) {
+      const response = await post(url, {
+        ticket: ticket,
+        labels: labels,
+        version: saved.current.version,
+      });
+      const data = await response.json();
+      if (response.status !== 409) {
+        saved.current = {version: data.version, labels};
+        break;
+      }
+      // Someone else edited the ticket meanwhile, retry on top of that.
+      labels = mergeLabels(saved.current.labels, labels, data.labels);
+      saved.current = {version: data.version, labels: data.labels};
+      retried = true;
+    }
+    if (retried) {
+      // Show the merged labels.
+      merged.current = true;
+      setSelection(labels.length
+        ? await fetchLabels(url, labels.map(pk => ['pk', pk]))
+        : []);
+    }
   });
 
   useEffect( () => {
-    async function fetchLabels() {
-      const labels = await (await fetch(url)).json();
-      const options = labels.map(l => ({
-        value: l.pk,
-        label: l.name,
-        color: l.color,
-      }));
-      const optionsById = Object.fromEntries(options.map(o => [o.value, o]));
-      const selected = initial.map(i => optionsById[i]);
-      setOptions(options);
+    async function fetchSelection() {
+      // Only the selected labels, the rest is searched as the user types.
+      const selected = initial.length
+        ? await fetchLabels(url, initial.map(pk => ['pk', pk]))
+        : [];
       setSelection(selected);
       setCanUpdate(true);
     }
-    fetchLabels();
+    fetchSelection();
   }, [url, initial]);
 
+  const loadOptions = input => fetchLabels(url, {q: input});
+
   function getColor({data}) {
     const color = chroma(data.color);
     const textColor = chroma.contrast(color, 'white') > 2 ? 'white' : 'black';
@@ -90,11 +135,13 @@ function LabelSelect({url, ticket, initial}) {
   };
 
   return (
-    <Select isMulti
-            options={options}
-            value={selection}
-            onChange={setSelection}
-            styles={styles}/>
+    <AsyncSelect isMulti
+                 cacheOptions
+                 defaultOptions
+                 loadOptions={loadOptions}
+                 value={selection}
+                 onChange={setSelection}
+                 styles={styles}/>
   );
 }
 
@@ -102,7 +149,8 @@ window.bugz = window.bugz || {};
 window.bugz.labels = function bugz_tags({url, element}) {
   const initial = element.dataset.labels.split(',').map(e => parseInt(e)).filter(isFinite);
   const ticket = parseInt(element.dataset.ticket);
+  const version = parseInt(element.dataset.version);
   ReactDOM.render(<React.StrictMode>
-    <LabelSelect url={url} initial={initial} ticket={ticket}/>
+    <LabelSelect url={url} initial={initial} ticket={ticket} version={version}/>
   </React.StrictMode>, element);
 }
\ No newline at end of file
@@ -1,24 +1,42 @@
 from django.contrib import admin
 
-from bugz import models
+from bugz import duplicates, forms, models, rollups, search
+
+
+class TicketAdminForm(forms.TicketForm):
+    class Meta(forms.TicketForm.Meta):
+        fields = "__all__"
 
 
 class TicketAdmin(admin.ModelAdmin):
+    form = TicketAdminForm
     raw_id_fields = ["assignee", "blocked_by", "dupe_of"]
 
     def save_model(self, request, obj, form, change):
         if not change:
-            return super().save_model(request, obj, form, change)
+            super().save_model(request, obj, form, change)
+            search.index_ticket(obj)
+            if obj.dupe_of_id:
+                duplicates.update_canonical([obj], obj.dupe_of_id)
+            return
         data = form.cleaned_data
         return models.save_ticket_update(
             ticket=obj,
             authored_by=request.user,
             blocked_by=[t.pk for t in data["blocked_by"]],
             labels=[l.pk for l in data["labels"]],
+            version=data["version"],
         )
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        if not change:
+            # Once its labels are set.
+            rollups.record_created(form.instance)
+
 
 class LabelAdmin(admin.ModelAdmin):
+    # Tickets showing labels are bumped by receivers, see BugzConfig.
     fields = ["name", "description", "color"]
 
 
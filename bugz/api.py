@@ -0,0 +1,89 @@
+"""
+JSON representations of tickets and their timeline, for the read API.
+
+Responses are JSON arrays streamed an item at a time, out of querysets read
+in chunks, so exports of any size run in constant memory.
+"""
+
+from typing import Iterable
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from bugz import models
+
+# Rows fetched at once when streaming.
+CHUNK_SIZE = 500
+
+
+def _username(user):
+    return None if user is None else user.get_username()
+
+
+def ticket_json(ticket: models.Ticket) -> dict:
+    """ticket must have its labels and blockers prefetched."""
+    return {
+        "id": ticket.pk,
+        "url": ticket.get_absolute_url(),
+        "title": ticket.title,
+        "description": ticket.description,
+        "open": ticket.open,
+        "locked": ticket.locked,
+        "author": _username(ticket.authored_by),
+        "assignee": _username(ticket.assignee),
+        "created_on": ticket.created_on,
+        "last_activity_on": ticket.last_activity_on,
+        "comment_count": ticket.comment_count,
+        "labels": sorted(label.name for label in ticket.labels.all()),
+        "blocked_by": sorted(t.pk for t in ticket.blocked_by.all()),
+        "dupe_of": ticket.dupe_of_id,
+        "canonical": ticket.canonical_id,
+    }
+
+
+def api_tickets(qs):
+    """Tickets of qs with what ticket_json needs, read in chunks."""
+    return (
+        qs.select_related("authored_by", "assignee")
+        .prefetch_related("labels", "blocked_by")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+
+
+def _value_json(field, value):
+    if value is None:
+        return None
+    if field == "labels":
+        return sorted(label.name for label in value)
+    if field == "assignee":
+        return _username(value)
+    if field in models.MANY_FIELDS:
+        return sorted(obj.pk for obj in value)
+    if field in models.REFERENCE_FIELDS:
+        return value.pk
+    return value
+
+
+def event_json(event: models.Event) -> dict:
+    data = {
+        "id": event.id,
+        "field": event.field,
+        "author": _username(event.authored_by),
+        "authored_on": event.authored_on,
+    }
+    if event.field == "comment":
+        data["comment"] = event.new_value
+        data["html"] = str(event.html)
+    else:
+        data["old_value"] = _value_json(event.field, event.old_value)
+        data["new_value"] = _value_json(event.field, event.new_value)
+    return data
+
+
+def stream_json_array(items: Iterable[dict]):
+    """Encode items as a JSON array, one item at a time."""
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    separator = "["
+    for item in items:
+        yield separator + encoder.encode(item)
+        separator = ",\n"
+    yield "[]\n" if separator == "[" else "]\n"
@@ -1,6 +1,29 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import (
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
 
 
 class BugzConfig(AppConfig):
     name = "bugz"
     verbose_name = "Django Bugz"
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+
+        from bugz import instrumentation, models, rollups, search
+
+        connection_created.connect(instrumentation.install)
+        post_delete.connect(search.remove_deleted_ticket, sender=models.Ticket)
+        # Ticket pages and rows show labels and users.
+        post_save.connect(models.label_changed, sender=models.Label)
+        pre_delete.connect(models.label_deleted, sender=models.Label)
+        pre_save.connect(models.user_changing, sender=get_user_model())
+        pre_delete.connect(models.user_deleted, sender=get_user_model())
+        # Rollups count open tickets per label and assignee.
+        pre_delete.connect(rollups.ticket_deleted, sender=models.Ticket)
+        pre_delete.connect(rollups.assignee_deleted, sender=get_user_model())
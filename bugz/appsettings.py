@@ -1,4 +1,49 @@
 """
 Thin layer of abstraction to access bugz settings, either from the user settings
 or our defaults.
+
+Every setting is looked up as ``BUGZ_<NAME>`` in the Django settings, e.g.
+``BUGZ_SEARCH_CACHE_SIZE``, and read lazily so ``override_settings`` works.
 """
+
+from django.conf import settings
+
+DEFAULTS = {
+    # How many distinct compiled search queries to keep in memory.
+    "SEARCH_CACHE_SIZE": 256,
+    # Dotted path to a bugz.search.SearchBackend subclass, or None to pick one
+    # based on the database vendor.
+    "SEARCH_BACKEND": None,
+    # Number of tickets per page in the ticket list.
+    "TICKETS_PER_PAGE": 50,
+    # Number of events shown at once in a ticket timeline.
+    "LOG_WINDOW_SIZE": 50,
+    # Alias of the Django cache storing rendered fragments.
+    "CACHE": "default",
+    # How long rendered ticket rows are cached, in seconds. Entries are never
+    # invalidated, only outdated, so this bounds how long they waste space.
+    "ROW_CACHE_TIMEOUT": 86400,
+    # How long label usage counts are cached in each process, in seconds.
+    "LABEL_USAGE_TTL": 300,
+    # Default number of labels returned by typeahead requests.
+    "LABEL_TYPEAHEAD_LIMIT": 20,
+    # Dotted path to the bugz.live.Broker subclass fanning out live updates.
+    "LIVE_BROKER": "bugz.live.LocalBroker",
+    # Seconds between keepalive comments on idle live update streams.
+    "LIVE_KEEPALIVE": 15,
+    # How long live update streams look out for events committed after
+    # events written later, in seconds. It bounds how long a transaction
+    # writing events may take for them to be pushed.
+    "LIVE_REREAD_WINDOW": 60,
+    # Number of recent requests per view whose stats are kept by
+    # bugz.instrumentation, for percentiles.
+    "INSTRUMENTATION_SAMPLES": 1000,
+}
+
+
+def __getattr__(name):
+    try:
+        default = DEFAULTS[name]
+    except KeyError:
+        raise AttributeError(name) from None
+    return getattr(settings, f"BUGZ_{name}", default)
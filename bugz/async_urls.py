@@ -0,0 +1,35 @@
+"""
+URLs of bugz served by async views where there are, for ASGI deployments.
+
+Include this module instead of bugz.urls. It also serves live updates of
+ticket timelines, which need ASGI.
+"""
+
+from django.urls import path
+
+from bugz import urls, views
+
+app_name = "bugz"
+
+ASYNC_VIEWS = {
+    "home": views.AsyncListTicketView,
+    "ticket": views.AsyncDetailTicketView,
+    "comment": views.AsyncCommentTicketView,
+    "js.labels": views.AsyncJSLabelView,
+}
+
+urlpatterns = [
+    (
+        path(
+            str(pattern.pattern),
+            ASYNC_VIEWS[pattern.name].as_view(),
+            name=pattern.name,
+        )
+        if pattern.name in ASYNC_VIEWS
+        else pattern
+    )
+    for pattern in urls.urlpatterns
+]
+urlpatterns.append(
+    path("ticket/<int:pk>/live", views.LiveTicketView.as_view(), name="live")
+)
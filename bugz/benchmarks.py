@@ -0,0 +1,173 @@
+"""
+Benchmarks of the hot paths of bugz, run by the ``bugz_benchmark`` command.
+
+They run against whatever is in the database, usually a dataset created by
+``bugz_generate_dataset``. Each benchmark is a setup function returning the
+callable to measure, so that fixture lookups are not accounted for.
+"""
+
+import gc
+import statistics
+import time
+import tracemalloc
+from typing import Callable, Dict, NamedTuple
+
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.db.models import Count
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from bugz import models, views
+
+
+class Measure(NamedTuple):
+    # Median wall time of a run, in seconds.
+    time: float
+    # Number of SQL queries of a run.
+    queries: int
+    # Peak memory allocated by Python during a run, in bytes.
+    memory: int
+
+
+class Environment:
+    """Fixtures shared by benchmarks."""
+
+    def __init__(self, using="default"):
+        self.using = using
+        self.factory = RequestFactory()
+        # An unsaved superuser passes every permission check without
+        # touching the database.
+        self.user = get_user_model()(
+            username="benchmark", is_staff=True, is_superuser=True
+        )
+        self.busiest_ticket = (
+            models.Ticket.objects.using(using)
+            .annotate(n=Count("updates"))
+            .order_by("-n")
+            .first()
+        )
+        if self.busiest_ticket is None:
+            raise ValueError("There are no tickets to benchmark.")
+
+    def get(self, path, data=None):
+        request = self.factory.get(path, data)
+        request.user = self.user
+        return request
+
+
+BENCHMARKS: Dict[str, Callable[[Environment], Callable[[], None]]] = {}
+
+
+def benchmark(name):
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+@benchmark("list_view")
+def bench_list_view(env):
+    view = views.ListTicketView.as_view()
+    return lambda: view(env.get("/")).render()
+
+
+@benchmark("list_view_search")
+def bench_list_view_search(env):
+    view = views.ListTicketView.as_view()
+    word = env.busiest_ticket.title.split()[0]
+    return lambda: view(env.get("/", {"q": f"is:open {word}"})).render()
+
+
+@benchmark("detail_view")
+def bench_detail_view(env):
+    view = views.DetailTicketView.as_view()
+    pk = env.busiest_ticket.pk
+    return lambda: view(env.get(f"/ticket/{pk}"), pk=pk).render()
+
+
+@benchmark("labels_view")
+def bench_labels_view(env):
+    view = views.JSLabelView.as_view()
+    return lambda: view(env.get("/js/labels"))
+
+
+@benchmark("build_ticket_log")
+def bench_build_ticket_log(env):
+    ticket = env.busiest_ticket
+    return lambda: list(models.build_ticket_log(ticket))
+
+
+@benchmark("save_ticket_update")
+def bench_save_ticket_update(env):
+    ticket = env.busiest_ticket
+
+    def run():
+        # Toggling twice leaves the ticket as it was, save for its history.
+        for _ in range(2):
+            ticket.open = not ticket.open
+            models.save_ticket_update(ticket, None)
+
+    return run
+
+
+@benchmark("bulk_update_tickets")
+def bench_bulk_update_tickets(env):
+    pks = list(
+        models.Ticket.objects.using(env.using)
+        .order_by("-created_on")
+        .values_list("pk", flat=True)[:100]
+    )
+
+    def run():
+        # Leaves every ticket open, as most of them already are.
+        for value in (False, True):
+            models.bulk_update_tickets(pks, None, {"open": value})
+
+    return run
+
+
+def measure(run, iterations=10, using="default") -> Measure:
+    # Warm up caches, lazy imports and the like.
+    run()
+
+    connection = connections[using]
+    with CaptureQueriesContext(connection) as queries:
+        run()
+    query_count = len(queries)
+
+    timings = []
+    for _ in range(iterations):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    # Measured apart, tracing allocations slows everything down.
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return Measure(
+        time=statistics.median(timings), queries=query_count, memory=peak
+    )
+
+
+def compare(measure: Measure, baseline: Measure, threshold: float):
+    """List the metrics of measure that regressed from baseline.
+
+    Time and memory may grow up to threshold times the baseline, being
+    noisy. Query counts are deterministic and may not grow at all."""
+    regressions = []
+    if measure.time > baseline.time * threshold:
+        regressions.append("time")
+    if measure.memory > baseline.memory * threshold:
+        regressions.append("memory")
+    if measure.queries > baseline.queries:
+        regressions.append("queries")
+    return regressions
@@ -0,0 +1,116 @@
+"""
+In-process cache of the label catalog, for the label picker.
+
+The catalog is reloaded whenever the label version changes, which any label
+save or deletion does, in this process or another. How often labels are used
+is only refreshed every ``BUGZ_LABEL_USAGE_TTL`` seconds, ranking does not
+need to be exact.
+"""
+
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Max
+
+from bugz import appsettings, models
+
+
+class LabelEntry(NamedTuple):
+    pk: int
+    name: str
+    color: str
+    # Number of tickets with this label.
+    usage: int
+
+
+def get_label_version():
+    """Identifies the current state of the label table, in one query.
+
+    The count accounts for deletions, which leave no date behind."""
+    version = models.Label.objects.aggregate(
+        count=Count("pk"), modified_on=Max("modified_on")
+    )
+    return version["count"], version["modified_on"]
+
+
+async def aget_label_version():
+    """Async version of get_label_version."""
+    version = await models.Label.objects.aaggregate(
+        count=Count("pk"), modified_on=Max("modified_on")
+    )
+    return version["count"], version["modified_on"]
+
+
+class LabelCatalog:
+    def __init__(self, version, labels: List[LabelEntry]):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        # Most used first, which is also the order of typeahead results.
+        self.ranked = sorted(labels, key=lambda e: (-e.usage, e.name))
+        self._folded = [entry.name.casefold() for entry in self.ranked]
+        self.by_name = sorted(labels, key=lambda e: e.name)
+        self.by_pk: Dict[int, LabelEntry] = {e.pk: e for e in labels}
+
+    @classmethod
+    def load(cls, version):
+        rows = models.Label.objects.annotate(
+            usage=Count("ticket")
+        ).values_list("pk", "name", "color", "usage")
+        return cls(version, [LabelEntry(*row) for row in rows])
+
+    def is_fresh(self, version) -> bool:
+        return (
+            self.version == version
+            and time.monotonic() - self.loaded_at
+            <= appsettings.LABEL_USAGE_TTL
+        )
+
+    def search(self, query: str, limit: int) -> List[LabelEntry]:
+        """Labels whose name contains query, prefix matches first."""
+        query = query.strip().casefold()
+        prefixed, containing = [], []
+        for entry, name in zip(self.ranked, self._folded):
+            if name.startswith(query):
+                prefixed.append(entry)
+                if len(prefixed) == limit:
+                    break
+            elif len(containing) < limit and query in name:
+                containing.append(entry)
+        return (prefixed + containing)[:limit]
+
+
+_catalog: Optional[LabelCatalog] = None
+_lock = threading.Lock()
+
+
+def get_catalog(version=None) -> LabelCatalog:
+    """The label catalog, reloaded if outdated.
+
+    version is the result of get_label_version, if already known."""
+    global _catalog
+    if version is None:
+        version = get_label_version()
+    with _lock:
+        catalog = _catalog
+        if catalog is None or not catalog.is_fresh(version):
+            catalog = _catalog = LabelCatalog.load(version)
+        return catalog
+
+
+async def aget_catalog() -> LabelCatalog:
+    """Async version of get_catalog.
+
+    Only reloads, which are rare, run in a thread."""
+    version = await aget_label_version()
+    catalog = _catalog
+    if catalog is not None and catalog.is_fresh(version):
+        return catalog
+    return await sync_to_async(get_catalog)(version)
+
+
+def clear():
+    global _catalog
+    with _lock:
+        _catalog = None
@@ -0,0 +1,122 @@
+"""
+Resolution of duplicate chains.
+
+A ticket can be a duplicate of a duplicate, and so on. The ticket at the end
+of the chain is the canonical one, stored on each ticket of the chain so that
+finding it, or all duplicates of a ticket, is a single indexed lookup. It is
+maintained whenever dupe_of changes, which repoints the whole subtree of
+duplicates of the changed tickets at once, like path compression.
+"""
+
+from typing import Dict, Iterable, List, Optional
+
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Case, F, When
+
+from bugz import models
+
+
+def canonical_pk(ticket) -> int:
+    """The primary key of the canonical ticket of ticket."""
+    return ticket.canonical_id or ticket.pk
+
+
+def duplicates_of(ticket):
+    """Duplicates of ticket, directly or not."""
+    return models.Ticket.objects.filter(canonical=canonical_pk(ticket))
+
+
+def _subtrees(pks: List[int], using=None) -> List[tuple]:
+    """(id, root, canonical_id) of each ticket of pks and their duplicates,
+    directly or not, root being the ticket of pks they lead to."""
+    connection = connections[using or models.Ticket.objects.db]
+    quote = connection.ops.quote_name
+    table = quote(models.Ticket._meta.db_table)
+    dupe_of = quote(models.Ticket._meta.get_field("dupe_of").column)
+    canonical = quote(models.Ticket._meta.get_field("canonical").column)
+    placeholders = ", ".join(["%s"] * len(pks))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"WITH RECURSIVE tree(id, root) AS ("
+            f"SELECT id, id FROM {table} WHERE id IN ({placeholders}) "
+            f"UNION "
+            f"SELECT t.id, tree.root FROM {table} t "
+            f"JOIN tree ON t.{dupe_of} = tree.id"
+            f") SELECT tree.id, tree.root, t.{canonical} FROM tree "
+            f"JOIN {table} t ON t.id = tree.id",
+            pks,
+        )
+        return cursor.fetchall()
+
+
+def _cycle_error(dupe_of) -> ValidationError:
+    return ValidationError(
+        {
+            "dupe_of": ValidationError(
+                "#%(ticket)s is already a duplicate of this ticket.",
+                code="cycle",
+                params={"ticket": getattr(dupe_of, "pk", dupe_of)},
+            )
+        }
+    )
+
+
+def validate_dupe_of(ticket, dupe_of):
+    """Reject dupe_of if it is ticket, or one of its duplicates."""
+    if ticket.pk is None or dupe_of is None:
+        return
+    pk = getattr(dupe_of, "pk", dupe_of)
+    if pk in {row[0] for row in _subtrees([ticket.pk])}:
+        raise _cycle_error(dupe_of)
+
+
+def update_canonical(tickets: Iterable, dupe_of: Optional[int]):
+    """Maintain canonical tickets after tickets were made duplicates of
+    dupe_of, or not duplicates if None.
+
+    Must run in the same transaction as the change, which it rolls back by
+    raising a ValidationError if it made a cycle. Returns the canonical
+    ticket of tickets and their duplicates, by primary key, None for
+    canonical ones."""
+    pks = [getattr(t, "pk", t) for t in tickets]
+    if not pks:
+        return {}
+    rows = _subtrees(pks)
+    if dupe_of is None:
+        # Each ticket is now the canonical one of its subtree.
+        canonicals: Dict[int, Optional[int]] = {
+            pk: (None if pk == root else root) for pk, root, _ in rows
+        }
+    else:
+        if dupe_of in {pk for pk, _, _ in rows}:
+            raise _cycle_error(dupe_of)
+        target = models.Ticket.objects.only("pk", "canonical").get(pk=dupe_of)
+        canonicals = {pk: canonical_pk(target) for pk, _, _ in rows}
+
+    old = {pk: canonical for pk, _, canonical in rows}
+    changed = {pk: c for pk, c in canonicals.items() if c != old[pk]}
+    if not changed:
+        return canonicals
+    groups: Dict[int, List[int]] = {}
+    for pk, c in changed.items():
+        if c is not None:
+            groups.setdefault(c, []).append(pk)
+    # Duplicates of the tickets are bumped here, the tickets themselves by
+    # the caller.
+    models.Ticket.objects.filter(pk__in=changed).update(
+        canonical=Case(
+            *(When(pk__in=group, then=c) for c, group in groups.items()),
+            default=None,
+        ),
+        cache_version=Case(
+            When(pk__in=pks, then=F("cache_version")),
+            default=F("cache_version") + 1,
+        ),
+    )
+    # Canonical tickets list their duplicates.
+    touched = set(groups) | {old[pk] for pk in changed if old[pk]}
+    models.touch_tickets(
+        models.Ticket.objects.filter(pk__in=touched - set(pks))
+    )
+    return canonicals
@@ -1,19 +1,491 @@
-from django import forms
+import copy
+import datetime
+import functools
+import json
+from typing import NamedTuple, Tuple
+
 import pyparsing as pp
+from django import forms
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from bugz import appsettings, duplicates, graph, models, search
 
 
 class CommentForm(forms.Form):
     comment = forms.CharField(widget=forms.Textarea(), required=True)
 
 
+CONFLICT_MESSAGE = (
+    "This ticket was edited since you loaded it, reload it to see the "
+    "changes."
+)
+
+
+class TicketForm(forms.ModelForm):
+    # The version of the ticket the edit was made against.
+    version = forms.IntegerField(widget=forms.HiddenInput(), min_value=0)
+
+    class Meta:
+        model = models.Ticket
+        fields = (
+            "title",
+            "description",
+            "open",
+            "assignee",
+            "blocked_by",
+            "dupe_of",
+            "labels",
+            "locked",
+        )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["version"].initial = self.instance.version
+
+    def clean_blocked_by(self):
+        blocked_by = self.cleaned_data["blocked_by"]
+        graph.validate_blockers(self.instance, blocked_by)
+        return blocked_by
+
+    def clean_dupe_of(self):
+        dupe_of = self.cleaned_data["dupe_of"]
+        duplicates.validate_dupe_of(self.instance, dupe_of)
+        return dupe_of
+
+    def clean_version(self):
+        # Most conflicts are caught here, save_ticket_update catches those
+        # happening between this check and the save.
+        version = self.cleaned_data["version"]
+        if self.instance.pk is not None and version != self.instance.version:
+            raise ValidationError(CONFLICT_MESSAGE, code="conflict")
+        return version
+
+
+class BulkUpdateForm(forms.Form):
+    tickets = forms.ModelMultipleChoiceField(models.Ticket.objects.all())
+    action = forms.ChoiceField(
+        choices=[
+            ("close", "Close"),
+            ("reopen", "Reopen"),
+            ("lock", "Lock"),
+            ("unlock", "Unlock"),
+            ("assign", "Assign to"),
+            ("add-label", "Add label"),
+            ("remove-label", "Remove label"),
+            ("dupe", "Mark as duplicate of"),
+        ]
+    )
+    # Left empty, unassigns.
+    assignee = forms.ModelChoiceField(
+        get_user_model().objects.all(),
+        to_field_name="username",
+        required=False,
+        widget=forms.TextInput(attrs={"placeholder": "Username"}),
+    )
+    label = forms.ModelChoiceField(models.Label.objects.all(), required=False)
+    dupe_of = forms.ModelChoiceField(
+        models.Ticket.objects.all(),
+        required=False,
+        widget=forms.TextInput(attrs={"placeholder": "Ticket number"}),
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        required = {
+            "add-label": "label",
+            "remove-label": "label",
+            "dupe": "dupe_of",
+        }.get(cleaned_data.get("action"))
+        if required and not cleaned_data.get(required):
+            self.add_error(required, "This field is required.")
+        return cleaned_data
+
+    def get_permission(self):
+        """The permission needed on every ticket."""
+        if self.cleaned_data["action"] in ("lock", "unlock"):
+            return "bugz.can_lock_ticket"
+        return "bugz.can_edit_ticket"
+
+    def get_changes(self):
+        """Keyword arguments of bulk_update_tickets for the action."""
+        data = self.cleaned_data
+        action = data["action"]
+        if action in ("close", "reopen"):
+            return {"values": {"open": action == "reopen"}}
+        if action in ("lock", "unlock"):
+            return {"values": {"locked": action == "lock"}}
+        if action == "assign":
+            return {"values": {"assignee": data["assignee"]}}
+        if action == "add-label":
+            return {"add_labels": [data["label"]]}
+        if action == "remove-label":
+            return {"remove_labels": [data["label"]]}
+        return {"values": {"dupe_of": data["dupe_of"]}}
+
+
 def search_parser():
-    quoted = pp.dblQuotedString()
-    literal = pp.Word(pp.pyparsing_unicode.printables)
+    """Build the pyparsing grammar for search queries.
+
+    A query is a whitespace-separated list of terms. A term is either a
+    ``key:value`` qualifier, a "quoted phrase" or a bare word, and can be
+    negated with a leading dash, e.g. ``-label:wontfix``."""
+    quoted = pp.QuotedString('"', esc_char="\\")
+    literal = pp.Regex(r'[^\s"]+')
+    value = (quoted | literal).leave_whitespace()
+    key = pp.Regex(r"[a-z][a-z-]*(?=:)")("key") + pp.Suppress(":")
+    qualifier = key + value("value")
+    text = (quoted | literal)("text")
+    body = qualifier | text
+    negated = pp.Literal("-")("negate") + body.copy().leave_whitespace()
+    return pp.ZeroOrMore(pp.Group(negated | body)) + pp.StringEnd()
+
+
+# Building the grammar is not free, do it once.
+SEARCH_GRAMMAR = search_parser()
+
+
+class _CurrentUser:
+    """Placeholder for the searching user in compiled queries.
+
+    Compiled queries are shared between requests, so ``assignee:me`` cannot
+    embed the user directly: it is bound at filtering time."""
+
+    def __repr__(self):
+        return "<me>"
+
+
+ME = _CurrentUser()
+
+
+def _through_subquery(field, column, **lookups):
+    through = models.Ticket._meta.get_field(field).remote_field.through
+    return Q(pk__in=through.objects.filter(**lookups).values(column))
+
+
+def _is_q(value):
+    try:
+        return {
+            "open": Q(open=True),
+            "closed": Q(open=False),
+            "locked": Q(locked=True),
+            "unlocked": Q(locked=False),
+            "dupe": Q(dupe_of__isnull=False),
+            # Blocked by open tickets, or not.
+            "blocked": _through_subquery(
+                "blocked_by", "from_ticket_id", to_ticket__open=True
+            ),
+            "ready": Q(open=True)
+            & ~_through_subquery(
+                "blocked_by", "from_ticket_id", to_ticket__open=True
+            ),
+        }[value]
+    except KeyError:
+        raise ValidationError(
+            "Unknown state %(value)s.",
+            code="invalid",
+            params={"value": repr(value)},
+        )
+
+
+def _user_q(field):
+    def build(value):
+        if value == "me":
+            return Q(**{field: ME})
+        if value == "none":
+            return Q(**{f"{field}__isnull": True})
+        return Q(**{f"{field}__username": value})
+
+    return build
+
+
+def _label_q(value):
+    # Going through a subquery makes "label:a label:b" mean "both labels"
+    # instead of requiring a single label to be named both a and b.
+    return _through_subquery("labels", "ticket_id", label__name__iexact=value)
+
+
+def _ticket_pk(value):
+    try:
+        pk = int(value[1:] if value.startswith("#") else value)
+    except ValueError:
+        pk = None
+    # Out of range numbers would overflow database integers.
+    if pk is None or not 0 < pk < 2**63:
+        raise ValidationError(
+            "%(value)s is not a ticket number.",
+            code="invalid",
+            params={"value": repr(value)},
+        )
+    return pk
+
+
+def _blocked_by_q(value):
+    return _through_subquery(
+        "blocked_by", "from_ticket_id", to_ticket_id=_ticket_pk(value)
+    )
+
+
+def _dupe_of_q(value):
+    # Duplicates of the ticket, or of the ticket it duplicates, directly or
+    # not.
+    return Q(
+        canonical__in=models.Ticket.objects.filter(
+            pk=_ticket_pk(value)
+        ).values(canonical_or_self=Coalesce("canonical", "pk"))
+    )
+
+
+def _day_start(value, days=0):
+    try:
+        day = datetime.date.fromisoformat(value)
+    except ValueError:
+        raise ValidationError(
+            "%(value)s is not a date.",
+            code="invalid",
+            params={"value": repr(value)},
+        )
+    start = datetime.datetime.combine(
+        day + datetime.timedelta(days=days), datetime.time.min
+    )
+    if settings.USE_TZ:
+        # Compiled queries are shared between requests, so days are those
+        # of the default time zone rather than of the current one.
+        start = timezone.make_aware(start, timezone.get_default_timezone())
+    return start
+
+
+def _date_range_q(value):
+    """A day, e.g. 2024-03-01, or a range of days, with either end
+    optional, e.g. 2024-03-01..2024-03-07."""
+    start, dots, end = value.partition("..")
+    if not dots:
+        end = start
+    q = Q()
+    if start:
+        q &= Q(authored_on__gte=_day_start(start))
+    if end:
+        q &= Q(authored_on__lt=_day_start(end, days=1))
+    return q
+
+
+def _changes_q(field, *args, **lookups):
+    # Tickets with a matching change in their history, see TicketChange.
+    return Q(
+        pk__in=models.TicketChange.objects.filter(
+            *args, field=field, **lookups
+        ).values("ticket_id")
+    )
+
+
+def _open_changed_q(new):
+    def build(value):
+        return _changes_q(
+            "open", _date_range_q(value), new_value=json.dumps(new)
+        )
+
+    return build
+
+
+def _label_changed_q(side):
+    def build(value):
+        labels = models.Label.objects.filter(name__iexact=value)
+        return _changes_q("labels", **{f"{side}__in": labels.values("pk")})
+
+    return build
+
+
+def _unassigned_q(value):
+    users = get_user_model().objects.filter(username=value)
+    return _changes_q("assignee", old_pk__in=users.values("pk"))
+
+
+SEARCH_QUALIFIERS = {
+    "is": _is_q,
+    "label": _label_q,
+    "assignee": _user_q("assignee"),
+    # Alias used by the search_url template tag.
+    "assigned": _user_q("assignee"),
+    "author": _user_q("authored_by"),
+    "blocked-by": _blocked_by_q,
+    "dupe-of": _dupe_of_q,
+    # History.
+    "closed": _open_changed_q(False),
+    "reopened": _open_changed_q(True),
+    "labeled": _label_changed_q("new_pk"),
+    "unlabeled": _label_changed_q("old_pk"),
+    "unassigned": _unassigned_q,
+}
+
+
+def _bind_user(q: Q, user) -> Q:
+    bound = copy.copy(q)
+    bound.children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            child = _bind_user(child, user)
+        elif child[1] is ME:
+            if user is not None and user.is_authenticated:
+                child = (child[0], user.pk)
+            else:
+                child = ("pk__in", [])
+        bound.children.append(child)
+    return bound
+
+
+class CompiledQuery(NamedTuple):
+    """A parsed search query, ready to filter tickets.
+
+    Qualifiers are compiled into q, free text terms are kept apart for the
+    full-text search backend. Instances are cached and shared, do not mutate
+    them."""
+
+    q: Q
+    text: Tuple[search.Term, ...] = ()
+    needs_user: bool = False
+
+    def bind(self, user) -> Q:
+        if not self.needs_user:
+            return self.q
+        return _bind_user(self.q, user)
+
+    def apply(self, qs, user):
+        qs = qs.filter(self.bind(user))
+        if self.text:
+            qs = search.get_backend(qs.db).filter(qs, self.text)
+        return qs
+
+
+# Caches of _compile_search_query, by size.
+_search_caches = {}
+
+
+def search_query_cache():
+    """The cache of compile_search_query, of BUGZ_SEARCH_CACHE_SIZE entries.
+
+    The setting is read on every call, and a cache of another size
+    replaces the previous one."""
+    size = appsettings.SEARCH_CACHE_SIZE
+    cache = _search_caches.get(size)
+    if cache is None:
+        _search_caches.clear()
+        cache = _search_caches[size] = functools.lru_cache(maxsize=size)(
+            _compile_search_query
+        )
+    return cache
+
+
+def compile_search_query(query: str) -> CompiledQuery:
+    """Parse and compile a search query into a single Q tree.
+
+    Results are cached by raw query string since most searches are the
+    same handful of saved queries."""
+    return search_query_cache()(query)
+
+
+def _compile_search_query(query: str) -> CompiledQuery:
+    try:
+        terms = SEARCH_GRAMMAR.parse_string(query, parse_all=True)
+    except pp.ParseException:
+        raise ValidationError("Invalid search query.", code="invalid")
+
+    q = Q()
+    text = []
+    needs_user = False
+    for term in terms:
+        if "key" in term:
+            try:
+                build = SEARCH_QUALIFIERS[term["key"]]
+            except KeyError:
+                raise ValidationError(
+                    "Unknown search qualifier %(key)s.",
+                    code="invalid",
+                    params={"key": repr(term["key"])},
+                )
+            value = term["value"]
+            needs_user |= value == "me"
+            term_q = build(value)
+        else:
+            if term["text"]:
+                text.append((term["text"], "negate" in term))
+            continue
+        q &= ~term_q if "negate" in term else term_q
+    return CompiledQuery(q=q, text=tuple(text), needs_user=needs_user)
+
+
+class ReportForm(forms.Form):
+    dimension = forms.ChoiceField(
+        choices=[
+            ("all", "All tickets"),
+            ("label", "Per label"),
+            ("assignee", "Per assignee"),
+        ],
+        required=False,
+    )
+    since = forms.DateField(required=False)
+    until = forms.DateField(required=False)
+
+    # Longest report, in days.
+    MAX_DAYS = 366
+
+    def clean(self):
+        data = super().clean()
+        data["dimension"] = data.get("dimension") or "all"
+        until = data.get("until") or timezone.localdate(
+            timezone=timezone.get_default_timezone()
+        )
+        since = data.get("since") or until - datetime.timedelta(days=27)
+        if since > until:
+            raise ValidationError("The report must start before it ends.")
+        if (until - since).days >= self.MAX_DAYS:
+            raise ValidationError(
+                "Reports cannot span more than %(days)s days.",
+                params={"days": self.MAX_DAYS},
+            )
+        data["since"], data["until"] = since, until
+        return data
+
+
+# Orderings of the ticket list, each backed by an index of Ticket.
+SEARCH_ORDERINGS = {
+    "updated": ("-last_activity_on", "-id"),
+    "discussed": ("-comment_count", "-id"),
+}
 
 
 class SearchForm(forms.Form):
-    q = forms.CharField(initial="")
+    q = forms.CharField(initial="", required=False)
+    sort = forms.ChoiceField(
+        choices=[
+            ("", "Newest"),
+            ("updated", "Recently updated"),
+            ("discussed", "Most discussed"),
+        ],
+        required=False,
+    )
+
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+
+    def clean_q(self):
+        q = self.cleaned_data["q"]
+        # Compiling here surfaces syntax errors on the form, and primes the
+        # cache for apply_qs.
+        compile_search_query(q)
+        return q
 
     def apply_qs(self, qs):
+        if not self.is_valid():
+            return qs.none()
         q = self.cleaned_data.get("q", "")
+        qs = compile_search_query(q).apply(qs, self.user)
+        sort = self.cleaned_data.get("sort")
+        if sort:
+            # An explicit ordering wins over search relevance.
+            qs = qs.order_by(*SEARCH_ORDERINGS[sort])
         return qs
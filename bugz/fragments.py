@@ -0,0 +1,79 @@
+"""
+Cache of rendered ticket list rows.
+
+Rows are cached under the cache version of their ticket, which is bumped by
+every change to what a row shows. Entries are never invalidated: outdated ones
+are simply not read anymore, and expire.
+"""
+
+from typing import List
+
+from django.core.cache import caches
+from django.db.models import (
+    aprefetch_related_objects,
+    prefetch_related_objects,
+)
+from django.template.loader import render_to_string
+from django.utils import timezone, translation
+from django.utils.html import mark_safe
+
+from bugz import appsettings
+
+ROW_TEMPLATE = "bugz/stub-ticket-row.html"
+# Bump when changing ROW_TEMPLATE, so rows cached before are not used.
+ROW_FORMAT = 3
+
+
+def get_cache():
+    return caches[appsettings.CACHE]
+
+
+def row_key(ticket) -> str:
+    # Rows show localized dates, in the current time zone.
+    return ":".join(
+        [
+            f"bugz-row{ROW_FORMAT}",
+            str(ticket.pk),
+            str(ticket.cache_version),
+            translation.get_language() or "",
+            timezone.get_current_timezone_name(),
+        ]
+    )
+
+
+def render_ticket_rows(tickets) -> List[str]:
+    """Render the list rows of tickets, from the cache when possible.
+
+    Rows are the same for every user, they are rendered without a request.
+    Labels are only fetched for tickets missing from the cache."""
+    cache = get_cache()
+    keys = [row_key(ticket) for ticket in tickets]
+    rows = cache.get_many(keys)
+    missing = [t for t, key in zip(tickets, keys) if key not in rows]
+    if missing:
+        prefetch_related_objects(missing, "labels")
+        rendered = _render_rows(missing)
+        cache.set_many(rendered, appsettings.ROW_CACHE_TIMEOUT)
+        rows.update(rendered)
+    return [mark_safe(rows[key]) for key in keys]
+
+
+async def arender_ticket_rows(tickets) -> List[str]:
+    """Async version of render_ticket_rows."""
+    cache = get_cache()
+    keys = [row_key(ticket) for ticket in tickets]
+    rows = await cache.aget_many(keys)
+    missing = [t for t, key in zip(tickets, keys) if key not in rows]
+    if missing:
+        await aprefetch_related_objects(missing, "labels")
+        rendered = _render_rows(missing)
+        await cache.aset_many(rendered, appsettings.ROW_CACHE_TIMEOUT)
+        rows.update(rendered)
+    return [mark_safe(rows[key]) for key in keys]
+
+
+def _render_rows(tickets):
+    return {
+        row_key(ticket): render_to_string(ROW_TEMPLATE, {"ticket": ticket})
+        for ticket in tickets
+    }
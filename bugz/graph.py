@@ -0,0 +1,144 @@
+"""
+The blocker graph, made of the ``blocked_by`` relations between tickets.
+
+It is kept acyclic: save_ticket_update rejects blockers that would close a
+cycle. Transitive queries are single recursive CTEs over the through table,
+supported by SQLite, PostgreSQL and MySQL 8.
+"""
+
+from typing import Dict, Iterable, List, NamedTuple, Set
+
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+from bugz import models
+
+
+def _pks(tickets) -> List[int]:
+    if isinstance(tickets, (models.Ticket, int)):
+        tickets = [tickets]
+    return [getattr(t, "pk", t) for t in tickets]
+
+
+def _columns(connection):
+    through = models.Ticket.blocked_by.through
+    quote = connection.ops.quote_name
+    return (
+        quote(through._meta.db_table),
+        # The blocked ticket.
+        quote(through._meta.get_field("from_ticket").column),
+        # Its blocker.
+        quote(through._meta.get_field("to_ticket").column),
+    )
+
+
+def _closure_cte(connection, pks, upwards: bool):
+    """A CTE named closure, of the ids of tickets reachable from pks.
+
+    Upwards follows tickets to their blockers, downwards to the tickets they
+    block. UNION, not UNION ALL, makes this terminate even on cycles."""
+    table, blocked, blocker = _columns(connection)
+    start, step = (blocked, blocker) if upwards else (blocker, blocked)
+    placeholders = ", ".join(["%s"] * len(pks))
+    sql = (
+        f"WITH RECURSIVE closure(id) AS ("
+        f"SELECT {step} FROM {table} WHERE {start} IN ({placeholders}) "
+        f"UNION "
+        f"SELECT e.{step} FROM {table} e JOIN closure c ON e.{start} = c.id"
+        f")"
+    )
+    return sql, pks
+
+
+def _closure(tickets, upwards: bool, using=None):
+    pks = _pks(tickets)
+    qs = models.Ticket.objects.using(using)
+    if not pks:
+        return qs.none()
+    cte, params = _closure_cte(connections[qs.db], pks, upwards)
+    return qs.filter(pk__in=RawSQL(f"{cte} SELECT id FROM closure", params))
+
+
+def transitive_blockers(tickets, using=None):
+    """Tickets blocking any of tickets, directly or not."""
+    return _closure(tickets, upwards=True, using=using)
+
+
+def transitive_dependents(tickets, using=None):
+    """Tickets blocked by any of tickets, directly or not."""
+    return _closure(tickets, upwards=False, using=using)
+
+
+def ready(qs):
+    """Open tickets of qs that no open ticket blocks."""
+    return qs.filter(open=True).exclude(blocked_by__open=True)
+
+
+def find_cycle(ticket, blockers: Iterable) -> List[int]:
+    """The blockers that would close a cycle if blocking ticket."""
+    pks = set(_pks(blockers))
+    if ticket.pk is None or not pks:
+        return []
+    if ticket.pk in pks:
+        return [ticket.pk]
+    # Blockers that ticket already blocks, directly or not.
+    return sorted(
+        transitive_dependents(ticket)
+        .filter(pk__in=pks)
+        .values_list("pk", flat=True)
+    )
+
+
+def validate_blockers(ticket, blockers: Iterable):
+    cycle = find_cycle(ticket, blockers)
+    if cycle:
+        raise ValidationError(
+            {
+                "blocked_by": ValidationError(
+                    "Blocking this ticket by %(tickets)s would be circular.",
+                    code="cycle",
+                    params={"tickets": ", ".join(f"#{pk}" for pk in cycle)},
+                )
+            }
+        )
+
+
+class BlockerTree(NamedTuple):
+    root: "models.Ticket"
+    # Direct blockers of each ticket of the tree, by primary key.
+    blockers: Dict[int, List["models.Ticket"]]
+
+    def walk(self, ticket=None, depth=0, seen: Set[int] = None):
+        """Yield (depth, ticket) pairs, depth first.
+
+        Tickets blocking several others of the tree are yielded each time,
+        but their blockers only once."""
+        ticket = ticket or self.root
+        seen = set() if seen is None else seen
+        yield depth, ticket
+        if ticket.pk in seen:
+            return
+        seen.add(ticket.pk)
+        for blocker in self.blockers.get(ticket.pk, []):
+            yield from self.walk(blocker, depth + 1, seen)
+
+
+def blocker_tree(ticket) -> BlockerTree:
+    """Every ticket blocking ticket, and how, in two queries."""
+    connection = connections[models.Ticket.objects.db]
+    table, blocked, blocker = _columns(connection)
+    cte, params = _closure_cte(connection, [ticket.pk], upwards=True)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"{cte} SELECT {blocked}, {blocker} FROM {table} "
+            f"WHERE {blocked} = %s OR {blocked} IN (SELECT id FROM closure)",
+            [*params, ticket.pk],
+        )
+        edges = cursor.fetchall()
+    tickets = models.Ticket.objects.in_bulk({b for _, b in edges})
+    tickets[ticket.pk] = ticket
+    blockers = {}
+    for a, b in sorted(edges):
+        blockers.setdefault(a, []).append(tickets[b])
+    return BlockerTree(ticket, blockers)
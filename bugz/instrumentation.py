@@ -0,0 +1,273 @@
+"""
+Opt-in instrumentation of requests, enabled by adding
+``bugz.instrumentation.InstrumentationMiddleware`` to ``MIDDLEWARE``.
+
+While a request is instrumented, SQL queries, markdown rendering, timeline
+building, ticket updates and inclusion tags add to its Stats. Once it is
+answered, they are logged as a JSON line on the ``bugz.instrumentation``
+logger, sent in a Server-Timing header and kept as a sample of its view, of
+which the stats view shows percentiles. Samples are kept in memory, so each
+process only knows about the requests it served.
+
+Stats are held in a context variable, which follows requests into the
+threads of async views. Timings of nested sections overlap, e.g. the time
+spent building a timeline includes its SQL queries.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, List, NamedTuple, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from bugz import appsettings
+
+logger = logging.getLogger(__name__)
+
+# Timed sections, as named in Server-Timing headers, and their descriptions.
+TIMINGS = {
+    "total": "Total",
+    "sql": "SQL",
+    "markdown": "Markdown",
+    "log": "Timeline",
+    "update": "Ticket updates",
+    "tags": "Inclusion tags",
+}
+# Counted things.
+COUNTS = ("queries", "events", "markdown", "tags")
+
+
+class Stats:
+    """What a request spent, in seconds, and counts of what it did."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def finish(self):
+        self.timings["total"] = time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        """Timings in milliseconds and counts, by name."""
+        return {
+            **{
+                f"{name}_ms": round(self.timings.get(name, 0) * 1000, 3)
+                for name in TIMINGS
+            },
+            **{name: self.counts.get(name, 0) for name in COUNTS},
+        }
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f'{name};dur={self.timings[name] * 1000:.1f};desc="{desc}"'
+            for name, desc in TIMINGS.items()
+            if name in self.timings
+        )
+
+
+_current: "contextvars.ContextVar[Optional[Stats]]" = contextvars.ContextVar(
+    "bugz_stats", default=None
+)
+
+
+def current() -> Optional[Stats]:
+    """The Stats of the request being instrumented, if any."""
+    return _current.get()
+
+
+def count(name: str, n=1):
+    stats = _current.get()
+    if stats is not None:
+        stats.counts[name] += n
+
+
+@contextlib.contextmanager
+def timed(name: str, counter: Optional[str] = None):
+    """Add the time spent in the block to the timing name, and count it
+    in counter. Also a decorator."""
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.timings[name] += time.perf_counter() - started
+        if counter is not None:
+            stats.counts[counter] += 1
+
+
+def timed_iter(name: str, iterable, counter: Optional[str] = None):
+    """Iterate over iterable, adding the time spent producing items to the
+    timing name and counting them in counter."""
+    iterator = iter(iterable)
+    while True:
+        with timed(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        if counter is not None:
+            count(counter)
+        yield item
+
+
+def _execute(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.timings["sql"] += time.perf_counter() - started
+        stats.counts["queries"] += 1
+
+
+def install(sender=None, connection=None, **kwargs):
+    """Time the queries of connection, a connection_created receiver.
+
+    Queries outside of instrumented requests only pay for a lookup."""
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute)
+
+
+class Sample(NamedTuple):
+    timings: Dict[str, float]
+    counts: Dict[str, int]
+
+
+_samples: Dict[str, deque] = {}
+_samples_lock = threading.Lock()
+
+
+def record(view_name: str, stats: Stats):
+    with _samples_lock:
+        samples = _samples.get(view_name)
+        if samples is None:
+            samples = _samples[view_name] = deque(
+                maxlen=appsettings.INSTRUMENTATION_SAMPLES
+            )
+        samples.append(Sample(dict(stats.timings), dict(stats.counts)))
+
+
+def clear():
+    with _samples_lock:
+        _samples.clear()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """The nearest-rank pth percentile of sorted values."""
+    return values[max(math.ceil(len(values) * p / 100) - 1, 0)]
+
+
+class Metric(NamedTuple):
+    name: str
+    # Milliseconds for timings.
+    p50: float
+    p90: float
+    p99: float
+    max: float
+
+
+class ViewSummary(NamedTuple):
+    view_name: str
+    requests: int
+    metrics: List[Metric]
+
+
+def summary() -> List[ViewSummary]:
+    """Percentiles of the samples of each view, the slowest at p90
+    first."""
+    with _samples_lock:
+        samples = {name: list(s) for name, s in _samples.items()}
+    views = []
+    for view_name, view_samples in samples.items():
+        metrics = []
+        columns = [
+            (
+                f"{desc} (ms)",
+                [s.timings.get(name, 0) * 1000 for s in view_samples],
+            )
+            for name, desc in TIMINGS.items()
+        ] + [
+            (name.capitalize(), [s.counts.get(name, 0) for s in view_samples])
+            for name in COUNTS
+        ]
+        for name, values in columns:
+            values.sort()
+            metrics.append(
+                Metric(
+                    name,
+                    *(percentile(values, p) for p in (50, 90, 99)),
+                    values[-1],
+                )
+            )
+        views.append(ViewSummary(view_name, len(view_samples), metrics))
+    views.sort(key=lambda view: -view.metrics[0].p90)
+    return views
+
+
+class InstrumentationMiddleware:
+    """Instrument requests, see the module docstring.
+
+    Streamed responses are only accounted for until their headers."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        stats = Stats()
+        token = _current.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.report(request, response, stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = Stats()
+        token = _current.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.report(request, response, stats)
+        return response
+
+    def report(self, request, response, stats: Stats):
+        stats.finish()
+        match = request.resolver_match
+        view_name = match.view_name if match else None
+        logger.info(
+            json.dumps(
+                {
+                    "method": request.method,
+                    "path": request.path,
+                    "view": view_name,
+                    "status": response.status_code,
+                    **stats.as_dict(),
+                }
+            )
+        )
+        response.headers["Server-Timing"] = stats.server_timing()
+        if view_name is not None:
+            # Unresolved paths are not aggregated, they are unbounded.
+            record(view_name, stats)
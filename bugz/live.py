@@ -0,0 +1,220 @@
+"""
+Live updates of ticket timelines, pushed to viewers with Server-Sent Events.
+
+Writers publish a wake-up on the channel of a ticket once their transaction
+commits. Each stream subscribed to it then reads the events written since the
+last one it sent, so wake-ups carry no data, can be coalesced, and a broker
+may drop them as long as it delivers a later one.
+
+The default broker only reaches streams of the same process. Deployments
+running several processes set ``BUGZ_LIVE_BROKER`` to the dotted path of a
+Broker subclass fanning out across them, e.g. with PostgreSQL NOTIFY or Redis.
+"""
+
+import asyncio
+import functools
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Max
+from django.template.loader import render_to_string
+from django.utils.module_loading import import_string
+
+from bugz import appsettings, models
+
+
+def ticket_channel(ticket_id: int) -> str:
+    return f"ticket-{ticket_id}"
+
+
+class Subscription:
+    """Wake-ups of a channel, for a single stream."""
+
+    def __init__(self, broker: "Broker", channel: str):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        # A single pending wake-up is enough, further ones are coalesced.
+        self.queue = asyncio.Queue(maxsize=1)
+
+    def wake(self):
+        """Queue a wake-up, from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(self._put)
+        except RuntimeError:
+            # The loop is closed, the stream is gone.
+            pass
+
+    def _put(self):
+        if not self.queue.full():
+            self.queue.put_nowait(None)
+
+    async def wait(self, timeout: float) -> bool:
+        """Whether a wake-up came within timeout seconds."""
+        try:
+            await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def __aenter__(self):
+        await self.broker.subscribe(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Fans wake-ups out to the subscriptions of their channel."""
+
+    def publish(self, channel: str):
+        raise NotImplementedError
+
+    async def subscribe(self, subscription: Subscription):
+        raise NotImplementedError
+
+    async def unsubscribe(self, subscription: Subscription):
+        raise NotImplementedError
+
+
+class LocalBroker(Broker):
+    """Reaches the subscriptions of the current process only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+
+    def publish(self, channel):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.wake()
+
+    async def subscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.setdefault(subscription.channel, set()).add(
+                subscription
+            )
+
+    async def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(
+                subscription.channel, set()
+            )
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.channel, None)
+
+
+def get_broker() -> Broker:
+    """The broker of BUGZ_LIVE_BROKER, which is read on every call."""
+    return _broker(appsettings.LIVE_BROKER)
+
+
+@functools.lru_cache(maxsize=None)
+def _broker(path: str) -> Broker:
+    return import_string(path)()
+
+
+def publish_ticket(ticket_id: int):
+    """Wake up the streams of a ticket once the transaction commits."""
+    transaction.on_commit(
+        lambda: get_broker().publish(ticket_channel(ticket_id))
+    )
+
+
+class Cursor:
+    """The TicketEvent rows a stream has sent.
+
+    Ids are allocated before transactions commit, so a row may become
+    visible after rows of higher ids. Rows above settled are read again,
+    save those sent, until LIVE_REREAD_WINDOW seconds after a higher row was
+    sent."""
+
+    def __init__(self, after: int):
+        self.settled = after
+        # Ids of the rows sent above settled, to when they were sent.
+        self.sent: Dict[int, float] = {}
+
+    @property
+    def last(self) -> int:
+        """The highest id sent, to resume from."""
+        return max(self.sent, default=self.settled)
+
+    def add(self, rows):
+        now = time.monotonic()
+        for row in rows:
+            self.sent[row.pk] = now
+
+    def settle(self):
+        horizon = time.monotonic() - appsettings.LIVE_REREAD_WINDOW
+        old = [pk for pk, sent_on in self.sent.items() if sent_on <= horizon]
+        if old:
+            self.settled = max(self.settled, *old)
+            self.sent = {
+                pk: sent_on
+                for pk, sent_on in self.sent.items()
+                if pk > self.settled
+            }
+
+
+async def _new_rows(ticket: models.Ticket, cursor: Cursor, limit: int):
+    """The first TicketEvent rows of ticket the cursor did not send, in
+    id order."""
+    return [
+        row
+        async for row in models._event_rows(ticket)
+        .filter(id__gt=cursor.settled)
+        .exclude(id__in=list(cursor.sent))
+        .order_by("id")[:limit]
+    ]
+
+
+def format_event(html: str, event_id: int) -> str:
+    lines = "".join(f"data: {line}\n" for line in html.splitlines())
+    return f"id: {event_id}\n{lines}\n"
+
+
+async def stream_ticket(ticket: models.Ticket, after: Optional[int]):
+    """Server-Sent Events of the timeline of ticket, each a rendered fragment
+    of the timeline.
+
+    Events start after the TicketEvent row after, or the latest one if
+    None. Each is identified by the highest row id sent so far."""
+    if after is None:
+        latest = await models.TicketEvent.objects.filter(
+            ticket=ticket
+        ).aaggregate(id=Max("id"))
+        after = latest["id"] or 0
+    cursor = Cursor(after)
+    subscription = Subscription(get_broker(), ticket_channel(ticket.pk))
+    async with subscription:
+        # Subscribed first, so nothing written meanwhile is missed.
+        woken = True
+        while True:
+            if woken:
+                limit = appsettings.LOG_WINDOW_SIZE
+                cursor.settle()
+                rows = await _new_rows(ticket, cursor, limit)
+                if rows:
+                    cursor.add(rows)
+                    # In timeline order, rows of late commits included.
+                    rows.sort(key=lambda row: (row.authored_on, row.pk))
+                    events = list(await models._aresolve_chunk(rows))
+                    if events:
+                        html = await sync_to_async(render_to_string)(
+                            "bugz/stub-log.html", {"log": events}
+                        )
+                        yield format_event(html, cursor.last)
+                if len(rows) == limit:
+                    # More rows to catch up with.
+                    continue
+            else:
+                # Keeps proxies from closing the connection, and detects
+                # clients that left.
+                yield ": keepalive\n\n"
+            woken = await subscription.wait(appsettings.LIVE_KEEPALIVE)
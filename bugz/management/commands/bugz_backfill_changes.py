@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from bugz import models
+
+
+class Command(BaseCommand):
+    help = (
+        "Index the field changes of tickets whose history predates "
+        "TicketChange, for searches on history."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="Number of tickets indexed per transaction.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Reindex every ticket, not only those never indexed.",
+        )
+
+    def handle(self, *args, chunk_size, all, **options):
+        tickets = models.Ticket.objects.prefetch_related(
+            "labels", "blocked_by"
+        )
+        if not all:
+            tickets = tickets.filter(changes_indexed=False)
+        tickets = tickets.order_by("pk")
+        last_pk, done = 0, 0
+        while True:
+            chunk = list(tickets.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            # One transaction per chunk, so this can be interrupted and
+            # resumed at any time.
+            models.index_ticket_changes(chunk)
+            last_pk = chunk[-1].pk
+            done += len(chunk)
+            self.stdout.write(f"Indexed {done} tickets.")
+        self.stdout.write(self.style.SUCCESS(f"Done, {done} tickets."))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from bugz import models
+
+
+class Command(BaseCommand):
+    help = (
+        "Materialize the event log of tickets whose history predates "
+        "TicketEvent."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="Number of tickets loaded at once.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Rebuild every ticket, not only those never backfilled.",
+        )
+
+    def handle(self, *args, chunk_size, all, **options):
+        tickets = models.Ticket.objects.select_related("authored_by")
+        if not all:
+            tickets = tickets.filter(log_materialized=False)
+        tickets = tickets.order_by("pk")
+        last_pk, done = 0, 0
+        while True:
+            chunk = list(tickets.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            for ticket in chunk:
+                # One transaction per ticket, so this can be interrupted and
+                # resumed at any time.
+                models.materialize_ticket_log(ticket)
+            last_pk = chunk[-1].pk
+            done += len(chunk)
+            self.stdout.write(f"Backfilled {done} tickets.")
+        self.stdout.write(self.style.SUCCESS(f"Done, {done} tickets."))
@@ -0,0 +1,104 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from bugz import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure wall time, query count and peak memory of bugz hot paths, "
+        "optionally against stored baselines."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "names",
+            nargs="*",
+            metavar="name",
+            help="Benchmarks to run, all of them by default: "
+            + ", ".join(benchmarks.BENCHMARKS),
+        )
+        parser.add_argument("--iterations", type=int, default=10)
+        parser.add_argument(
+            "--baseline",
+            help="JSON file of baseline measures to compare against.",
+        )
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="Write the measures to the --baseline file instead of "
+            "comparing against it.",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=1.25,
+            help="Tolerated time and memory ratio to the baseline.",
+        )
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        names = options["names"] or list(benchmarks.BENCHMARKS)
+        unknown = set(names) - set(benchmarks.BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(unknown)}")
+        if options["save_baseline"] and not options["baseline"]:
+            raise CommandError("--save-baseline requires --baseline.")
+
+        baselines = {}
+        if options["baseline"] and not options["save_baseline"]:
+            try:
+                with open(options["baseline"]) as f:
+                    baselines = {
+                        name: benchmarks.Measure(**measure)
+                        for name, measure in json.load(f).items()
+                    }
+            except OSError as e:
+                raise CommandError(f"Cannot read baseline: {e}")
+
+        database = options["database"]
+        measures, failures = {}, []
+        # Benchmarks may write, leave the database as we found it.
+        with transaction.atomic(using=database):
+            try:
+                env = benchmarks.Environment(using=database)
+            except ValueError as e:
+                raise CommandError(str(e))
+            for name in names:
+                run = benchmarks.BENCHMARKS[name](env)
+                measure = benchmarks.measure(
+                    run, options["iterations"], using=database
+                )
+                measures[name] = measure
+                line = (
+                    f"{name:<20} {measure.time * 1000:>10.2f} ms "
+                    f"{measure.queries:>6} queries "
+                    f"{measure.memory / 1024:>10.1f} KiB"
+                )
+                if name in baselines:
+                    regressions = benchmarks.compare(
+                        measure, baselines[name], options["threshold"]
+                    )
+                    if regressions:
+                        failures.append(name)
+                        line += "  REGRESSED: " + ", ".join(regressions)
+                        line = self.style.ERROR(line)
+                self.stdout.write(line)
+            transaction.set_rollback(True, using=database)
+
+        if options["save_baseline"]:
+            with open(options["baseline"], "w") as f:
+                json.dump(
+                    {name: m._asdict() for name, m in measures.items()},
+                    f,
+                    indent=2,
+                )
+            self.stdout.write(f"Baseline saved to {options['baseline']}.")
+
+        if failures:
+            raise CommandError(
+                f"{len(failures)} benchmark(s) regressed: "
+                + ", ".join(failures)
+            )
@@ -0,0 +1,295 @@
+import gzip
+import itertools
+import json
+import os
+from operator import attrgetter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
+
+from bugz import models
+
+
+def _username(user):
+    return None if user is None else user.get_username()
+
+
+def _date(value):
+    return value.isoformat()
+
+
+def label_record(label):
+    return {
+        "type": "label",
+        "id": label.pk,
+        "name": label.name,
+        "description": label.description,
+        "color": label.color,
+    }
+
+
+def ticket_record(ticket):
+    """ticket must have its labels and blockers prefetched."""
+    return {
+        "type": "ticket",
+        "id": ticket.pk,
+        "title": ticket.title,
+        "description": ticket.description,
+        "author": _username(ticket.authored_by),
+        "created_on": _date(ticket.created_on),
+        "open": ticket.open,
+        "locked": ticket.locked,
+        "assignee": _username(ticket.assignee),
+        "labels": sorted(label.pk for label in ticket.labels.all()),
+        "blocked_by": sorted(t.pk for t in ticket.blocked_by.all()),
+        "dupe_of": ticket.dupe_of_id,
+    }
+
+
+def history_records(ticket, updates):
+    """Generate the comment and change records of ticket, most recent first.
+
+    updates are its TicketUpdate rows, most recent first, and are consumed
+    lazily. Values are primary keys. Updates made at the same date are
+    written oldest first, so bugz_import gives them the same order."""
+    pending = []
+    for update, changes in models.rewind_history(ticket, updates):
+        common = {
+            "ticket": ticket.pk,
+            "author": _username(update.authored_by),
+            "created_on": _date(update.authored_on),
+        }
+        if pending and pending[0]["created_on"] != common["created_on"]:
+            yield from reversed(pending)
+            pending = []
+        if changes is None:
+            pending.append(
+                {"type": "comment", **common, "comment": update.comment}
+            )
+            continue
+        pending.extend(
+            {
+                "type": "change",
+                **common,
+                "field": field,
+                "old": old,
+                "new": new,
+            }
+            for field, (old, new) in reversed(changes.items())
+        )
+    yield from reversed(pending)
+
+
+def drop_missing(records, users, labels, tickets):
+    """Turn user primary keys into usernames and drop references to deleted
+    objects, which history may hold, from change records."""
+    lookups = {"labels": labels, "blocked_by": tickets, "dupe_of": tickets}
+    for record in records:
+        field = record.get("field")
+        if field == "assignee":
+            old, new = (
+                record[key] and _username(users.get(record[key]))
+                for key in ("old", "new")
+            )
+        elif field in models.MANY_FIELDS:
+            old, new = (
+                sorted(set(record[key] or ()) & lookups[field])
+                for key in ("old", "new")
+            )
+        elif field in lookups:
+            old, new = (
+                record[key] if record[key] in lookups[field] else None
+                for key in ("old", "new")
+            )
+        else:
+            yield record
+            continue
+        if old != new:
+            yield {**record, "old": old, "new": new}
+
+
+class Checkpoint:
+    """Progress of an export, saved once a chunk is written and flushed.
+
+    Holds the current section, the last primary key exported in it, and the
+    size of the output file, which is truncated back to it on resume."""
+
+    def __init__(self, path):
+        self.path = path
+        self.section, self.pk, self.offset = "labels", 0, 0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            raise CommandError(f"No checkpoint to resume from: {self.path}.")
+        self.section, self.pk, self.offset = (
+            data["section"],
+            data["pk"],
+            data["offset"],
+        )
+
+    def save(self, section, pk, offset):
+        self.section, self.pk, self.offset = section, pk, offset
+        # Replaced atomically, so an interruption leaves the previous one.
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"section": section, "pk": pk, "offset": offset}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class Command(BaseCommand):
+    help = (
+        "Export labels, tickets and their history to a JSONL file, gzipped "
+        "if its name ends with .gz, in the format of bugz_import. The "
+        "history of each ticket is written most recent first. Rows are "
+        "read in chunks, and progress is saved after each one so an "
+        "interrupted export can be resumed with --resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of labels or tickets read at once.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue an interrupted export from its checkpoint.",
+        )
+
+    def handle(self, *args, output, chunk_size, resume, **options):
+        self.chunk_size = chunk_size
+        self.compress = output.endswith(".gz")
+        self.checkpoint = Checkpoint(output + ".checkpoint")
+        if resume:
+            self.checkpoint.load()
+        tickets = (
+            models.Ticket.objects.select_related("authored_by", "assignee")
+            .prefetch_related(
+                Prefetch("labels", models.Label.objects.only("pk")),
+                Prefetch("blocked_by", models.Ticket.objects.only("pk")),
+            )
+            .order_by("pk")
+        )
+        # Tickets come before any history, which may reference them.
+        sections = [
+            ("labels", models.Label.objects.order_by("pk"), self.label_chunk),
+            ("tickets", tickets, self.ticket_chunk),
+            ("history", tickets, self.history_chunk),
+            ("done", None, None),
+        ]
+        names = [name for name, _, _ in sections]
+        start = names.index(self.checkpoint.section)
+        with open(output, "r+b" if resume else "wb") as self.output:
+            # Drop whatever was written after the last checkpoint.
+            self.output.truncate(self.checkpoint.offset)
+            self.output.seek(self.checkpoint.offset)
+            for (name, qs, records), (following, _, _) in zip(
+                sections[start:], sections[start + 1 :]
+            ):
+                self.export(name, qs, records, self.checkpoint.pk)
+                self.checkpoint.save(following, 0, self.output.tell())
+        self.checkpoint.delete()
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def export(self, section, qs, records, last_pk):
+        """Write the records of the rows of qs after last_pk, in chunks."""
+        done = 0
+        while True:
+            # Keyset iteration: every chunk is an indexed range scan.
+            chunk = list(qs.filter(pk__gt=last_pk)[: self.chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            self.write(records(chunk))
+            self.checkpoint.save(section, last_pk, self.output.tell())
+            done += len(chunk)
+            self.stdout.write(f"Exported {section} of {done} rows.")
+
+    def write(self, records):
+        """Write records, consumed chunk_size at a time, and flush them."""
+        for batch in _batches(records, self.chunk_size):
+            data = "".join(
+                json.dumps(record, ensure_ascii=False) + "\n"
+                for record in batch
+            ).encode()
+            if self.compress:
+                # One gzip member per batch, so the file can be truncated at
+                # any checkpoint. gzip readers handle concatenated members.
+                data = gzip.compress(data)
+            self.output.write(data)
+        self.output.flush()
+        os.fsync(self.output.fileno())
+
+    def label_chunk(self, chunk):
+        return map(label_record, chunk)
+
+    def ticket_chunk(self, chunk):
+        return map(ticket_record, chunk)
+
+    def history_chunk(self, chunk):
+        """Generate the comment and change records of a chunk of tickets.
+
+        Updates are streamed, so memory does not grow with the length of
+        histories, and references are resolved chunk_size records at a
+        time."""
+        tickets = {ticket.pk: ticket for ticket in chunk}
+        updates = (
+            models.TicketUpdate.objects.filter(ticket__in=chunk)
+            .select_related("authored_by")
+            .defer("comment_html", "comment_html_key")
+            .order_by("ticket_id", "-authored_on", "-pk")
+            .iterator(chunk_size=self.chunk_size)
+        )
+        records = (
+            record
+            for pk, ticket_updates in itertools.groupby(
+                updates, attrgetter("ticket_id")
+            )
+            for record in history_records(tickets[pk], ticket_updates)
+        )
+        for batch in _batches(records, self.chunk_size):
+            yield from self.resolve(batch)
+
+    def resolve(self, records):
+        """Resolve the references of a batch of change records."""
+        wanted = {"assignee": set(), "labels": set(), "tickets": set()}
+        for record in records:
+            field = record.get("field")
+            if field not in models.REFERENCE_FIELDS:
+                continue
+            pks = wanted.get(field, wanted["tickets"])
+            for value in (record["old"], record["new"]):
+                if value is not None:
+                    pks.update(
+                        value if field in models.MANY_FIELDS else [value]
+                    )
+        users = get_user_model().objects.in_bulk(wanted["assignee"])
+        labels = set(
+            models.Label.objects.filter(pk__in=wanted["labels"]).values_list(
+                "pk", flat=True
+            )
+        )
+        tickets = set(
+            models.Ticket.objects.filter(pk__in=wanted["tickets"]).values_list(
+                "pk", flat=True
+            )
+        )
+        return drop_missing(records, users, labels, tickets)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,247 @@
+import datetime
+import json
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from bugz import models, search
+
+WORDS = (
+    "crash startup login page button slow memory leak render timeout "
+    "database query label ticket comment user admin export import search "
+    "broken missing wrong flaky regression upgrade config cache header "
+    "unicode mobile layout tooltip migration permission token session"
+).split()
+
+HISTORY_FIELDS = ("open", "assignee", "labels", "title", "locked")
+
+
+def sentence(rng, min_words=3, max_words=12):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize()
+
+
+def paragraph(rng):
+    text = " ".join(sentence(rng) + "." for _ in range(rng.randint(1, 5)))
+    # Exercise the markdown renderer every now and then.
+    if rng.random() < 0.2:
+        text += "\n\n" + "\n".join(f"* {sentence(rng)}" for _ in range(3))
+    if rng.random() < 0.1:
+        text += f"\n\n    {rng.choice(WORDS)}()\n"
+    return text
+
+
+class Command(BaseCommand):
+    help = "Fill the database with a synthetic dataset, for benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--labels", type=int, default=30)
+        parser.add_argument("--tickets", type=int, default=1000)
+        parser.add_argument(
+            "--updates",
+            type=int,
+            default=20,
+            help="Mean number of updates per ticket, exponentially "
+            "distributed so a few tickets have a very long history.",
+        )
+        parser.add_argument(
+            "--labels-per-ticket",
+            type=int,
+            default=3,
+            help="Maximum number of labels per ticket.",
+        )
+        parser.add_argument(
+            "--blockers-per-ticket",
+            type=int,
+            default=2,
+            help="Maximum number of blocking tickets per ticket.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--prefix",
+            default="synthetic",
+            help="Prefix of the generated user names.",
+        )
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.options = options
+        self.now = timezone.now()
+        with transaction.atomic():
+            self.users = self.create_users()
+            self.labels = self.create_labels()
+        self.ticket_pks = []
+        remaining = options["tickets"]
+        while remaining > 0:
+            size = min(remaining, options["batch_size"])
+            with transaction.atomic():
+                self.create_tickets(size)
+            remaining -= size
+            self.stdout.write(
+                f"Created {len(self.ticket_pks)}/{options['tickets']} tickets."
+            )
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def create_users(self):
+        User = get_user_model()
+        prefix = self.options["prefix"]
+        password = make_password(None)
+        User.objects.bulk_create(
+            [
+                User(username=f"{prefix}-{i}", password=password)
+                for i in range(self.options["users"])
+            ],
+            ignore_conflicts=True,
+        )
+        return list(
+            User.objects.filter(username__startswith=f"{prefix}-").values_list(
+                "pk", flat=True
+            )
+        )
+
+    def create_labels(self):
+        labels = models.Label.objects.bulk_create(
+            [
+                models.Label(
+                    name=f"{self.rng.choice(WORDS)}-{i}",
+                    description=sentence(self.rng),
+                    color=f"#{self.rng.randrange(0x1000000):06x}",
+                )
+                for i in range(self.options["labels"])
+            ]
+        )
+        return [label.pk for label in labels]
+
+    def simulate(self, created_on):
+        """Replay a random history, returning the final state and updates.
+
+        Updates store old values exactly like save_ticket_update does. Each
+        update is paired with its changes, as given to field_events, or
+        None for comments."""
+        rng = self.rng
+        state = {
+            "title": sentence(rng),
+            "open": True,
+            "locked": False,
+            "assignee": None,
+            "labels": set(),
+        }
+        count = int(rng.expovariate(1 / self.options["updates"]))
+        span = (self.now - created_on).total_seconds()
+        moments = sorted(rng.uniform(0, span) for _ in range(count))
+        updates = []
+        for moment in moments:
+            update = models.TicketUpdate(
+                authored_by_id=rng.choice(self.users) if self.users else None,
+                authored_on=created_on + datetime.timedelta(seconds=moment),
+            )
+            if rng.random() < 0.6:
+                update.comment = paragraph(rng)
+                updates.append((update, None))
+                continue
+            field = rng.choice(HISTORY_FIELDS)
+            old = state[field]
+            if field in ("open", "locked"):
+                state[field] = not old
+            elif field == "title":
+                state[field] = sentence(rng)
+            elif field == "assignee":
+                choices = [None] + self.users
+                state[field] = rng.choice(choices)
+            elif field == "labels":
+                k = rng.randint(0, self.options["labels_per_ticket"])
+                state[field] = set(
+                    rng.sample(self.labels, min(k, len(self.labels)))
+                )
+                old = sorted(old)
+            new = state[field]
+            if field == "labels":
+                new = sorted(new)
+            update.old_value = json.dumps({field: old})
+            updates.append((update, {field: (old, new)}))
+        return state, updates
+
+    def create_tickets(self, size):
+        rng = self.rng
+        tickets, histories = [], []
+        for _ in range(size):
+            created_on = self.now - datetime.timedelta(
+                seconds=rng.uniform(0, 2 * 365 * 86400)
+            )
+            state, updates = self.simulate(created_on)
+            tickets.append(
+                models.Ticket(
+                    title=state["title"],
+                    description=paragraph(rng),
+                    authored_by_id=(
+                        rng.choice(self.users) if self.users else None
+                    ),
+                    created_on=created_on,
+                    open=state["open"],
+                    locked=state["locked"],
+                    assignee_id=state["assignee"],
+                    comment_count=sum(
+                        1 for _, changes in updates if changes is None
+                    ),
+                    update_count=len(updates),
+                    last_activity_on=(
+                        updates[-1][0].authored_on if updates else created_on
+                    ),
+                )
+            )
+            histories.append((state, updates))
+        tickets = models.Ticket.objects.bulk_create(tickets)
+
+        LabelThrough = models.Ticket.labels.through
+        BlockedThrough = models.Ticket.blocked_by.through
+        label_links, blocked_links, all_updates = [], [], []
+        for ticket, (state, updates) in zip(tickets, histories):
+            label_links.extend(
+                LabelThrough(ticket_id=ticket.pk, label_id=pk)
+                for pk in state["labels"]
+            )
+            k = rng.randint(0, self.options["blockers_per_ticket"])
+            for pk in rng.sample(
+                self.ticket_pks, min(k, len(self.ticket_pks))
+            ):
+                # Only older tickets block newer ones, so there is no cycle.
+                blocked_links.append(
+                    BlockedThrough(from_ticket_id=ticket.pk, to_ticket_id=pk)
+                )
+            for update, _ in updates:
+                update.ticket_id = ticket.pk
+            all_updates.extend(updates)
+        batch_size = self.options["batch_size"]
+        LabelThrough.objects.bulk_create(
+            label_links, batch_size=batch_size, ignore_conflicts=True
+        )
+        BlockedThrough.objects.bulk_create(
+            blocked_links, batch_size=batch_size, ignore_conflicts=True
+        )
+        models.TicketUpdate.objects.bulk_create(
+            [update for update, _ in all_updates], batch_size=batch_size
+        )
+        events = []
+        for update, changes in all_updates:
+            if changes is None:
+                events.append(models.comment_event(update))
+            else:
+                events.extend(models.field_events(update, changes))
+        models.TicketEvent.objects.bulk_create(events, batch_size=batch_size)
+        models.TicketChange.objects.bulk_create(
+            [
+                row
+                for update, changes in all_updates
+                if changes is not None
+                for row in models.field_changes(update, changes)
+            ],
+            batch_size=batch_size,
+        )
+        search.get_backend().index_tickets(tickets)
+        self.ticket_pks.extend(ticket.pk for ticket in tickets)
@@ -0,0 +1,376 @@
+import csv
+import gzip
+import json
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from bugz import duplicates, models, search
+
+# Columns of CSV files holding lists, separated by spaces.
+CSV_LISTS = {"labels", "blocked_by"}
+# Columns of CSV files holding booleans.
+CSV_BOOLEANS = {"open", "locked"}
+# Columns of CSV files holding JSON, the values of field changes.
+CSV_JSON = {"old", "new"}
+
+
+def open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def read_jsonl(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        record = {}
+        for key, value in row.items():
+            if value == "":
+                value = None
+            elif key in CSV_LISTS:
+                value = value.split()
+            elif key in CSV_BOOLEANS:
+                value = value.lower() in ("1", "true", "yes")
+            elif key in CSV_JSON:
+                value = json.loads(value)
+            record[key] = value
+        yield record
+
+
+class Command(BaseCommand):
+    help = (
+        "Import labels, tickets and their history from JSONL or CSV files, "
+        "optionally gzipped. Every record has a type: label, ticket, "
+        "comment or change. Records reference each other by their own id, "
+        "and must come after the labels and tickets they reference, except "
+        "for the blocked_by and dupe_of links of tickets. Users are "
+        "referenced by username, and created if missing. Tickets hold their "
+        "current state, changes only record how they got there. Consecutive "
+        "changes of a ticket by the same author at the same date make a "
+        "single update. Blockers are imported as they are, without checking "
+        "for cycles."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.batch_size = options["batch_size"]
+        self.users = dict(
+            get_user_model().objects.values_list(
+                get_user_model().USERNAME_FIELD, "pk"
+            )
+        )
+        # External ids to primary keys.
+        self.labels = {}
+        self.tickets = {}
+        # Links to tickets that may not be imported yet, as primary keys to
+        # external ids.
+        self.blocked_by = {}
+        self.dupe_of = {}
+        self.pending = {"label": [], "ticket": [], "history": []}
+        self.counts = dict.fromkeys(["label", "ticket", "history"], 0)
+        self.started = time.monotonic()
+
+        for path in options["files"]:
+            read = read_csv if ".csv" in path else read_jsonl
+            with open_text(path) as f:
+                for line, record in enumerate(read(f), 1):
+                    try:
+                        self.add(record)
+                    except (KeyError, ValueError, TypeError) as e:
+                        raise CommandError(f"{path}:{line}: {e}")
+        self.flush()
+        self.link()
+        self.repair()
+        self.report()
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def add(self, record):
+        kind = record["type"]
+        record["created_on"] = _datetime(record.get("created_on"))
+        if kind == "label":
+            self.pending["label"].append(record)
+        elif kind == "ticket":
+            # Tickets use the labels imported so far.
+            self.flush_kind("label")
+            self.value("labels", record.get("labels"))
+            self.pending["ticket"].append(record)
+        elif kind in ("comment", "change"):
+            if str(record["ticket"]) not in self.tickets:
+                self.flush_kind("ticket")
+                if str(record["ticket"]) not in self.tickets:
+                    raise ValueError(f"Unknown ticket {record['ticket']!r}.")
+            if kind == "change" and record["field"] != "assignee":
+                # References are checked now, to report the right line.
+                self.value(record["field"], record.get("old"))
+                self.value(record["field"], record.get("new"))
+            self.pending["history"].append(record)
+        else:
+            raise ValueError(f"Unknown record type {kind!r}.")
+        if len(self.pending[_bucket(kind)]) >= self.batch_size:
+            self.flush_kind(_bucket(kind))
+
+    def flush(self):
+        for kind in self.pending:
+            self.flush_kind(kind)
+
+    def flush_kind(self, kind):
+        records = self.pending[kind]
+        if not records:
+            return
+        self.pending[kind] = []
+        with transaction.atomic():
+            getattr(self, f"create_{kind}")(records)
+        self.counts[kind] += len(records)
+        self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        total = sum(self.counts.values())
+        self.stdout.write(
+            f"{self.counts['label']} labels, {self.counts['ticket']} "
+            f"tickets, {self.counts['history']} comments and changes "
+            f"({total / max(elapsed, 1e-6):.0f} records/s)."
+        )
+
+    def user(self, username):
+        if username is None:
+            return None
+        return self.users[username]
+
+    def create_users(self, usernames):
+        User = get_user_model()
+        missing = set(usernames) - set(self.users) - {None}
+        if not missing:
+            return
+        password = make_password(None)
+        User.objects.bulk_create(
+            [
+                User(**{User.USERNAME_FIELD: name, "password": password})
+                for name in missing
+            ],
+            ignore_conflicts=True,
+        )
+        self.users.update(
+            User.objects.filter(
+                **{f"{User.USERNAME_FIELD}__in": missing}
+            ).values_list(User.USERNAME_FIELD, "pk")
+        )
+
+    def create_label(self, records):
+        labels = _bulk_create(
+            models.Label,
+            [
+                models.Label(
+                    name=record["name"],
+                    description=record.get("description") or "",
+                    color=record.get("color") or "#ffffff",
+                )
+                for record in records
+            ],
+            self.batch_size,
+        )
+        for record, label in zip(records, labels):
+            self.labels[str(record["id"])] = label.pk
+
+    def create_ticket(self, records):
+        self.create_users(
+            [r.get("author") for r in records]
+            + [r.get("assignee") for r in records]
+        )
+        now = timezone.now()
+        tickets = [
+            models.Ticket(
+                title=record["title"],
+                description=record.get("description") or "",
+                authored_by_id=self.user(record.get("author")),
+                created_on=record["created_on"] or now,
+                open=record.get("open", True),
+                locked=record.get("locked") or False,
+                assignee_id=self.user(record.get("assignee")),
+            )
+            for record in records
+        ]
+        for ticket in tickets:
+            # Until history says otherwise.
+            ticket.last_activity_on = ticket.created_on
+        tickets = _bulk_create(models.Ticket, tickets, self.batch_size)
+
+        LabelThrough = models.Ticket.labels.through
+        links = []
+        for record, ticket in zip(records, tickets):
+            self.tickets[str(record["id"])] = ticket.pk
+            links.extend(
+                LabelThrough(ticket_id=ticket.pk, label_id=pk)
+                for pk in {
+                    self.labels[str(label)]
+                    for label in record.get("labels") or ()
+                }
+            )
+            if record.get("blocked_by"):
+                self.blocked_by[ticket.pk] = record["blocked_by"]
+            if record.get("dupe_of") is not None:
+                self.dupe_of[ticket.pk] = record["dupe_of"]
+        LabelThrough.objects.bulk_create(links, batch_size=self.batch_size)
+        search.get_backend().index_tickets(tickets)
+
+    def value(self, field, value):
+        """The internal value of a field, as in TicketUpdate.old_value."""
+        if value is None:
+            return [] if field in models.MANY_FIELDS else None
+        if field in ("title", "description", "open", "locked"):
+            return value
+        if field == "assignee":
+            return self.user(value)
+        try:
+            if field == "labels":
+                return sorted({self.labels[str(pk)] for pk in value})
+            if field == "blocked_by":
+                return sorted({self.tickets[str(pk)] for pk in value})
+            if field == "dupe_of":
+                return self.tickets[str(value)]
+        except KeyError as e:
+            raise ValueError(f"Unknown {field} reference {e}.")
+        raise ValueError(f"Unknown field {field!r}.")
+
+    def create_history(self, records):
+        self.create_users(
+            [r.get("author") for r in records]
+            + [
+                r.get(key)
+                for r in records
+                if r["type"] == "change" and r["field"] == "assignee"
+                for key in ("old", "new")
+            ]
+        )
+        now = timezone.now()
+        updates, changes = [], []
+        for record in records:
+            update = models.TicketUpdate(
+                ticket_id=self.tickets[str(record["ticket"])],
+                authored_by_id=self.user(record.get("author")),
+                authored_on=record["created_on"] or now,
+            )
+            if record["type"] == "comment":
+                update.comment = record["comment"]
+                updates.append(update)
+                changes.append(None)
+                continue
+            field = record["field"]
+            old = self.value(field, record.get("old"))
+            new = self.value(field, record.get("new"))
+            if (
+                changes
+                and changes[-1] is not None
+                and field not in changes[-1]
+                and (update.ticket_id, update.authored_by_id)
+                == (updates[-1].ticket_id, updates[-1].authored_by_id)
+                and update.authored_on == updates[-1].authored_on
+            ):
+                # Changes made together, as exported by bugz_export.
+                changes[-1][field] = (old, new)
+            else:
+                updates.append(update)
+                changes.append({field: (old, new)})
+        for update, change in zip(updates, changes):
+            if change is not None:
+                # As written by save_ticket_update, so build_ticket_log
+                # can replay it.
+                update.old_value = json.dumps(
+                    {field: old for field, (old, _) in change.items()}
+                )
+        updates = _bulk_create(models.TicketUpdate, updates, self.batch_size)
+        events = []
+        for update, change in zip(updates, changes):
+            if change is None:
+                events.append(models.comment_event(update))
+            else:
+                events.extend(models.field_events(update, change))
+        models.TicketEvent.objects.bulk_create(
+            events, batch_size=self.batch_size
+        )
+        models.TicketChange.objects.bulk_create(
+            [
+                row
+                for update, change in zip(updates, changes)
+                if change is not None
+                for row in models.field_changes(update, change)
+            ],
+            batch_size=self.batch_size,
+        )
+
+    def link(self):
+        """Write the blocked_by and dupe_of links, now that every ticket is
+        imported."""
+        Through = models.Ticket.blocked_by.through
+        links = [
+            Through(from_ticket_id=pk, to_ticket_id=self.tickets[str(other)])
+            for pk, others in self.blocked_by.items()
+            for other in others
+        ]
+        Through.objects.bulk_create(
+            links, batch_size=self.batch_size, ignore_conflicts=True
+        )
+
+        targets = {}
+        for pk, other in self.dupe_of.items():
+            targets.setdefault(self.tickets[str(other)], []).append(pk)
+        with transaction.atomic():
+            for target, pks in targets.items():
+                models.Ticket.objects.filter(pk__in=pks).update(dupe_of=target)
+                try:
+                    duplicates.update_canonical(pks, target)
+                except ValidationError:
+                    raise CommandError(
+                        f"Tickets {pks} and {target} duplicate each other."
+                    )
+
+    def repair(self):
+        """Derive the activity counters of tickets from their history."""
+        pks = sorted(self.tickets.values())
+        for i in range(0, len(pks), self.batch_size):
+            models.repair_ticket_counters(
+                models.Ticket.objects.filter(
+                    pk__in=pks[i : i + self.batch_size]
+                )
+            )
+
+
+def _bucket(kind):
+    return "history" if kind in ("comment", "change") else kind
+
+
+def _datetime(value):
+    if not value:
+        return None
+    value = parse_datetime(value)
+    if value is None:
+        raise ValueError("Invalid date.")
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def _bulk_create(model, objs, batch_size):
+    """bulk_create, with primary keys set even where the database cannot
+    return them."""
+    features = connections[model._default_manager.db].features
+    if features.can_return_rows_from_bulk_insert:
+        return model._default_manager.bulk_create(objs, batch_size=batch_size)
+    for obj in objs:
+        obj.save()
+    return objs
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from bugz import rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the reporting rollups from the history of every ticket."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="Number of tickets loaded at once.",
+        )
+
+    def handle(self, *args, chunk_size, **options):
+        done = rollups.rebuild(chunk_size)
+        self.stdout.write(self.style.SUCCESS(f"Done, {done} tickets."))
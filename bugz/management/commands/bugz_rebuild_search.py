@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bugz import models, search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of tickets."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of tickets indexed per transaction.",
+        )
+        parser.add_argument(
+            "--database",
+            default="default",
+            help="Database alias to rebuild the index for.",
+        )
+
+    def handle(self, *args, chunk_size, database, **options):
+        backend = search.get_backend(database)
+        if not backend.indexed:
+            self.stdout.write("Search backend has no index, nothing to do.")
+            return
+
+        backend.clear()
+        tickets = models.Ticket.objects.using(database).order_by("pk")
+        last_pk, done = 0, 0
+        while True:
+            # Keyset iteration: every chunk is an indexed range scan.
+            chunk = list(
+                tickets.filter(pk__gt=last_pk).only(
+                    "pk", "title", "description"
+                )[:chunk_size]
+            )
+            if not chunk:
+                break
+            with transaction.atomic(using=database):
+                backend.index_tickets(chunk)
+            last_pk = chunk[-1].pk
+            done += len(chunk)
+            self.stdout.write(f"Indexed {done} tickets.")
+        self.stdout.write(self.style.SUCCESS(f"Done, {done} tickets indexed."))
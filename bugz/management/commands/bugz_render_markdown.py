@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bugz import markup, models
+
+
+class Command(BaseCommand):
+    help = (
+        "Render ticket descriptions and comments whose stored HTML was made "
+        "by another renderer version."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Render everything again, even if up to date.",
+        )
+
+    def handle(self, *args, chunk_size, all, **options):
+        self.render(
+            models.Ticket.objects.all(), "description", chunk_size, all
+        )
+        self.render(
+            models.TicketUpdate.objects.exclude(comment=""),
+            "comment",
+            chunk_size,
+            all,
+        )
+
+    def render(self, qs, source, chunk_size, all):
+        key_field = f"{source}_html_key"
+        qs = qs.only("pk", source, key_field).order_by("pk")
+        if not all:
+            qs = qs.exclude(
+                **{f"{key_field}__startswith": f"{markup.RENDERER_VERSION}:"}
+            )
+        last_pk, done = 0, 0
+        while True:
+            chunk = list(qs.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            for obj in chunk:
+                if all:
+                    # Empty keys never match, forcing a render.
+                    setattr(obj, key_field, "")
+                markup.refresh(obj, source)
+            with transaction.atomic():
+                qs.model.objects.bulk_update(
+                    chunk, [f"{source}_html", key_field]
+                )
+            last_pk = chunk[-1].pk
+            done += len(chunk)
+            self.stdout.write(f"Rendered {done} {source}s.")
+        self.stdout.write(self.style.SUCCESS(f"Done, {done} {source}s."))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from bugz import models
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the comment and update counts and the last activity date "
+        "of tickets from their history."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of tickets updated per statement.",
+        )
+
+    def handle(self, *args, chunk_size, **options):
+        tickets = models.Ticket.objects.order_by("pk")
+        last_pk, done = 0, 0
+        while True:
+            pks = list(
+                tickets.filter(pk__gt=last_pk).values_list("pk", flat=True)[
+                    :chunk_size
+                ]
+            )
+            if not pks:
+                break
+            # Each statement is atomic, so this can be interrupted and
+            # resumed at any time.
+            models.repair_ticket_counters(
+                models.Ticket.objects.filter(pk__in=pks)
+            )
+            last_pk = pks[-1]
+            done += len(pks)
+            self.stdout.write(f"Repaired {done} tickets.")
+        self.stdout.write(self.style.SUCCESS(f"Done, {done} tickets."))
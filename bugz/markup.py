@@ -0,0 +1,92 @@
+"""
+Markdown rendering of descriptions and comments.
+
+Rendering is slow, so the sanitized HTML is stored next to its source along
+with a key made of the renderer version and a hash of the source. Changing the
+source or the renderer configuration makes the key mismatch, and the HTML is
+rendered again on next read, or in bulk with ``bugz_render_markdown``.
+"""
+
+import hashlib
+
+import bleach
+import markdown
+from django.utils.html import mark_safe
+
+from bugz import instrumentation
+
+EXTENSIONS = ("tables",)
+
+ALLOWED_TAGS = frozenset(bleach.ALLOWED_TAGS) | {
+    "p",
+    "table",
+    "thead",
+    "tbody",
+    "tr",
+    "th",
+    "td",
+}
+
+# Bump the first item to invalidate stored HTML after changing the renderer
+# in a way not captured by the rest.
+RENDERER_VERSION = hashlib.md5(
+    repr((1, EXTENSIONS, sorted(ALLOWED_TAGS))).encode()
+).hexdigest()[:8]
+
+
+@instrumentation.timed("markdown", "markdown")
+def render(text: str) -> str:
+    html = markdown.markdown(
+        text, extensions=list(EXTENSIONS), output_format="html5"
+    )
+    return bleach.clean(html, tags=ALLOWED_TAGS)
+
+
+def html_key(text: str) -> str:
+    digest = hashlib.sha1(text.encode()).hexdigest()
+    return f"{RENDERER_VERSION}:{digest}"
+
+
+def is_stale_key(key: str) -> bool:
+    """Whether a key was made by another renderer version."""
+    return not key.startswith(f"{RENDERER_VERSION}:")
+
+
+def refresh(obj, source: str) -> bool:
+    """Render the source field of obj into its HTML fields, if stale.
+
+    Returns whether anything was rendered. Nothing is saved."""
+    text = getattr(obj, source)
+    key = html_key(text)
+    if getattr(obj, f"{source}_html_key") == key:
+        return False
+    setattr(obj, f"{source}_html", render(text))
+    setattr(obj, f"{source}_html_key", key)
+    return True
+
+
+def _html_fields(obj, source: str):
+    return {
+        f"{source}_html": getattr(obj, f"{source}_html"),
+        f"{source}_html_key": getattr(obj, f"{source}_html_key"),
+    }
+
+
+def cached_html(obj, source: str):
+    """The rendered HTML of the source field of obj.
+
+    Stale HTML is rendered again and persisted."""
+    if refresh(obj, source) and obj.pk is not None:
+        type(obj)._default_manager.filter(pk=obj.pk).update(
+            **_html_fields(obj, source)
+        )
+    return mark_safe(getattr(obj, f"{source}_html"))
+
+
+async def acached_html(obj, source: str):
+    """Async version of cached_html."""
+    if refresh(obj, source) and obj.pk is not None:
+        await type(obj)._default_manager.filter(pk=obj.pk).aupdate(
+            **_html_fields(obj, source)
+        )
+    return mark_safe(getattr(obj, f"{source}_html"))
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE bugz_search_fts "
+            "USING fts5(title, description, comments)"
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE TABLE bugz_search_document ("
+            "ticket_id integer PRIMARY KEY REFERENCES bugz_ticket (id) "
+            "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        schema_editor.execute(
+            "CREATE INDEX bugz_search_document_gin "
+            "ON bugz_search_document USING GIN (document)"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS bugz_search_fts")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP TABLE IF EXISTS bugz_search_document")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
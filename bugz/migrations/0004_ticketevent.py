@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("bugz", "0003_ticket_created_idx"),
+    ]
+
+    operations = [
+        # Existing tickets have their log replayed until backfilled, new
+        # ones are materialized from the start.
+        migrations.AddField(
+            model_name="ticket",
+            name="log_materialized",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AlterField(
+            model_name="ticket",
+            name="log_materialized",
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.CreateModel(
+            name="TicketEvent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("authored_on", models.DateTimeField()),
+                ("anchor", models.CharField(max_length=64)),
+                ("field", models.CharField(max_length=32)),
+                ("old_value", models.TextField(default="null")),
+                ("new_value", models.TextField(default="null")),
+                (
+                    "authored_by",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="events",
+                        to="bugz.Ticket",
+                    ),
+                ),
+                (
+                    "update",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="events",
+                        to="bugz.TicketUpdate",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["authored_on", "id"],
+                "indexes": [
+                    models.Index(
+                        fields=["ticket", "authored_on", "id"],
+                        name="bugz_ticketevent_log_idx",
+                    )
+                ],
+            },
+        ),
+    ]
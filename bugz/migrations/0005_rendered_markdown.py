@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0004_ticketevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="description_html",
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name="ticket",
+            name="description_html_key",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="ticketupdate",
+            name="comment_html",
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name="ticketupdate",
+            name="comment_html_key",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
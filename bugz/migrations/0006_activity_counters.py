@@ -0,0 +1,70 @@
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def count_activity(apps, schema_editor):
+    Ticket = apps.get_model("bugz", "Ticket")
+    TicketUpdate = apps.get_model("bugz", "TicketUpdate")
+    updates = TicketUpdate.objects.filter(ticket=models.OuterRef("pk"))
+
+    def aggregate(qs, expression):
+        return models.Subquery(
+            qs.order_by()
+            .values("ticket")
+            .annotate(value=expression)
+            .values("value")
+        )
+
+    Ticket.objects.using(schema_editor.connection.alias).update(
+        comment_count=Coalesce(
+            aggregate(updates.exclude(comment=""), models.Count("pk")), 0
+        ),
+        update_count=Coalesce(aggregate(updates, models.Count("pk")), 0),
+        last_activity_on=Coalesce(
+            aggregate(updates, models.Max("authored_on")),
+            models.F("created_on"),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0005_rendered_markdown"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="comment_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="ticket",
+            name="update_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="ticket",
+            name="last_activity_on",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+        migrations.RunPython(count_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="ticket",
+            index=models.Index(
+                fields=["-last_activity_on", "-id"],
+                name="bugz_ticket_activity_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ticket",
+            index=models.Index(
+                fields=["-comment_count", "-id"],
+                name="bugz_ticket_comments_idx",
+            ),
+        ),
+    ]
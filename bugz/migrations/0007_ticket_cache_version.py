@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0006_activity_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="cache_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0007_ticket_cache_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="label",
+            name="modified_on",
+            field=models.DateTimeField(
+                auto_now=True, db_index=True, editable=False
+            ),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0008_label_modified_on"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
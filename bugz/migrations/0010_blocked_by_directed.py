@@ -0,0 +1,61 @@
+import json
+
+from django.db import migrations, models
+
+
+def keep_one_direction(apps, schema_editor):
+    """Blockers used to be stored both ways, keep the one that was meant.
+
+    That is the one recorded by the latest event adding the blocker, or else
+    the newest ticket being blocked by the oldest one. Tickets blocking
+    themselves are dropped."""
+    Ticket = apps.get_model("bugz", "Ticket")
+    TicketEvent = apps.get_model("bugz", "TicketEvent")
+    Through = Ticket.blocked_by.through
+    db = schema_editor.connection.alias
+
+    meant = {}
+    events = (
+        TicketEvent.objects.using(db)
+        .filter(field="blocked_by")
+        .order_by("authored_on", "id")
+        .values_list("ticket_id", "new_value")
+    )
+    for ticket_id, added in events:
+        for pk in json.loads(added) or []:
+            meant[frozenset((ticket_id, pk))] = (ticket_id, pk)
+
+    rows = {
+        (a, b): pk
+        for pk, a, b in Through.objects.using(db).values_list(
+            "pk", "from_ticket_id", "to_ticket_id"
+        )
+    }
+    extra = []
+    for (a, b), pk in rows.items():
+        if a == b:
+            extra.append(pk)
+        elif (b, a) in rows:
+            pair = frozenset((a, b))
+            if meant.get(pair, (max(pair), min(pair))) != (a, b):
+                extra.append(pk)
+    for i in range(0, len(extra), 500):
+        Through.objects.using(db).filter(pk__in=extra[i : i + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0009_ticket_version"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="ticket",
+            name="blocked_by",
+            field=models.ManyToManyField(
+                blank=True, related_name="blocking", to="bugz.ticket"
+            ),
+        ),
+        migrations.RunPython(keep_one_direction, migrations.RunPython.noop),
+    ]
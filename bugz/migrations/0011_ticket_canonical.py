@@ -0,0 +1,116 @@
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def resolve_canonical(apps, schema_editor):
+    """Follow every dupe_of chain to its end.
+
+    Chains looping back on themselves predate cycle checks: they are broken
+    at their oldest ticket, which becomes the canonical one. Each break is
+    recorded in the history of the ticket, as an update by nobody."""
+    Ticket = apps.get_model("bugz", "Ticket")
+    db = schema_editor.connection.alias
+    dupe_of = dict(
+        Ticket.objects.using(db)
+        .filter(dupe_of__isnull=False)
+        .values_list("pk", "dupe_of_id")
+    )
+
+    broken = {}
+    for start in list(dupe_of):
+        chain, pk = [], start
+        while pk in dupe_of and pk not in chain:
+            chain.append(pk)
+            pk = dupe_of[pk]
+        if pk in chain:
+            loop = chain[chain.index(pk) :]
+            oldest = min(loop)
+            broken[oldest] = dupe_of.pop(oldest)
+    if broken:
+        break_links(apps, db, broken)
+        print(
+            "\n  Broke duplicate loops at tickets "
+            + ", ".join(f"#{pk}" for pk in sorted(broken))
+            + ".",
+            end="",
+        )
+
+    canonical = {}
+
+    def resolve(pk):
+        chain = []
+        while pk in dupe_of and pk not in canonical:
+            chain.append(pk)
+            pk = dupe_of[pk]
+        root = canonical.get(pk, pk)
+        for link in chain:
+            canonical[link] = root
+        return root
+
+    groups = {}
+    for pk in dupe_of:
+        groups.setdefault(resolve(pk), []).append(pk)
+    for root, pks in groups.items():
+        for i in range(0, len(pks), 500):
+            Ticket.objects.using(db).filter(pk__in=pks[i : i + 500]).update(
+                canonical=root
+            )
+
+
+def break_links(apps, db, broken):
+    """Unset dupe_of for tickets of broken, mapping them to their previous
+    dupe_of, like save_ticket_update would."""
+    Ticket = apps.get_model("bugz", "Ticket")
+    TicketUpdate = apps.get_model("bugz", "TicketUpdate")
+    TicketEvent = apps.get_model("bugz", "TicketEvent")
+    now = timezone.now()
+    for ticket in Ticket.objects.using(db).filter(pk__in=broken):
+        previous = broken[ticket.pk]
+        update = TicketUpdate.objects.using(db).create(
+            ticket=ticket,
+            authored_on=now,
+            old_value=json.dumps({"dupe_of": previous}),
+        )
+        if ticket.log_materialized:
+            TicketEvent.objects.using(db).create(
+                ticket=ticket,
+                update=update,
+                authored_on=now,
+                anchor=f"event-{update.pk}-dupe_of",
+                field="dupe_of",
+                old_value=json.dumps(previous),
+                new_value="null",
+            )
+    Ticket.objects.using(db).filter(pk__in=broken).update(
+        dupe_of=None,
+        update_count=models.F("update_count") + 1,
+        last_activity_on=now,
+        cache_version=models.F("cache_version") + 1,
+        version=models.F("version") + 1,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0010_blocked_by_directed"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="canonical",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="bugz.ticket",
+            ),
+        ),
+        migrations.RunPython(resolve_canonical, migrations.RunPython.noop),
+    ]
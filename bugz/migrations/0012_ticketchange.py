@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("bugz", "0011_ticket_canonical"),
+    ]
+
+    operations = [
+        # Existing tickets are indexed by bugz_backfill_changes, new ones
+        # from the start.
+        migrations.AddField(
+            model_name="ticket",
+            name="changes_indexed",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AlterField(
+            model_name="ticket",
+            name="changes_indexed",
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.CreateModel(
+            name="TicketChange",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("authored_on", models.DateTimeField()),
+                ("field", models.CharField(max_length=32)),
+                ("old_pk", models.IntegerField(blank=True, null=True)),
+                ("new_pk", models.IntegerField(blank=True, null=True)),
+                ("old_value", models.TextField(default="null")),
+                ("new_value", models.TextField(default="null")),
+                (
+                    "authored_by",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="changes",
+                        to="bugz.Ticket",
+                    ),
+                ),
+                (
+                    "update",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="changes",
+                        to="bugz.TicketUpdate",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["authored_on", "id"],
+                "indexes": [
+                    models.Index(
+                        fields=["field", "authored_on"],
+                        name="bugz_ticketchange_date_idx",
+                    ),
+                    models.Index(
+                        fields=["field", "old_pk"],
+                        name="bugz_ticketchange_old_idx",
+                    ),
+                    models.Index(
+                        fields=["field", "new_pk"],
+                        name="bugz_ticketchange_new_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bugz", "0012_ticketchange"),
+    ]
+
+    operations = [
+        # Filled by bugz_rebuild_rollups.
+        migrations.CreateModel(
+            name="TicketRollup",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("dimension", models.CharField(max_length=16)),
+                ("key", models.IntegerField(default=0)),
+                ("entered", models.IntegerField(default=0)),
+                ("exited", models.IntegerField(default=0)),
+                ("closed", models.IntegerField(default=0)),
+                ("close_seconds", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["dimension", "day"],
+                        name="bugz_ticketrollup_day_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("day", "dimension", "key"),
+                        name="bugz_ticketrollup_unique",
+                    )
+                ],
+            },
+        ),
+    ]
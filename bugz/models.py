@@ -1,15 +1,22 @@
+import asyncio
 import datetime
 import hashlib
+import itertools
 import json
-from typing import NamedTuple, Any
+from typing import NamedTuple, Any, List, Optional
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.utils import timezone
 
+from bugz import instrumentation, markup, pagination
+
 
 def parse_color(color: str) -> int:
     color = color.strip()
@@ -44,6 +51,10 @@ class Label(models.Model):
     name = models.CharField(max_length=64)
     description = models.TextField(blank=True)
     color = ColorField(default="#ffffff", max_length=9)
+    # Validates cached copies of the label catalog, see bugz.catalog.
+    modified_on = models.DateTimeField(
+        auto_now=True, db_index=True, editable=False
+    )
 
     @property
     def text_color(self):
@@ -62,6 +73,11 @@ class Label(models.Model):
 class Ticket(models.Model):
     title = models.CharField(max_length=280)
     description = models.TextField(blank=True)
+    # Rendered description, see bugz.markup.
+    description_html = models.TextField(blank=True, editable=False)
+    description_html_key = models.CharField(
+        max_length=64, blank=True, editable=False
+    )
     authored_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         null=True,
@@ -82,9 +98,10 @@ class Ticket(models.Model):
         on_delete=models.SET_NULL,
         related_name="assigned_tickets",
     )
-    # What tickets are blocking this one.
+    # What tickets are blocking this one. Blockers form a directed acyclic
+    # graph, see bugz.graph.
     blocked_by = models.ManyToManyField(
-        "self", related_name="blocking", blank=True
+        "self", related_name="blocking", symmetrical=False, blank=True
     )
     # This ticket is a duplicate of another ticket.
     dupe_of = models.ForeignKey(
@@ -94,11 +111,54 @@ class Ticket(models.Model):
         blank=True,
         on_delete=models.SET_NULL,
     )
+    # The ticket at the end of the dupe_of chain, if this ticket is a
+    # duplicate, see bugz.duplicates.
+    canonical = models.ForeignKey(
+        "self",
+        related_name="+",
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+    )
     # The ticket labels.
     labels = models.ManyToManyField(Label, blank=True)
+    # Whether the history of this ticket is stored as TicketEvent rows, or
+    # predates them and must be replayed, see bugz_backfill_events.
+    log_materialized = models.BooleanField(default=True, editable=False)
+    # Whether the history of this ticket is indexed as TicketChange rows, see
+    # bugz_backfill_changes.
+    changes_indexed = models.BooleanField(default=True, editable=False)
+    # Activity counters, maintained by save_ticket_comment and
+    # save_ticket_update, see bugz_repair_counters.
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    update_count = models.PositiveIntegerField(default=0, editable=False)
+    last_activity_on = models.DateTimeField(
+        default=timezone.now, editable=False
+    )
+    # Bumped by any change to what the ticket list shows of the ticket, see
+    # bugz.fragments.
+    cache_version = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped by every edit of the ticket, to detect concurrent ones, see
+    # save_ticket_update.
+    version = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ("-created_on",)
+        indexes = [
+            # Keyset pagination of the ticket list, in each of its orderings.
+            models.Index(
+                fields=["-created_on", "-id"], name="bugz_ticket_created_idx"
+            ),
+            models.Index(
+                fields=["-last_activity_on", "-id"],
+                name="bugz_ticket_activity_idx",
+            ),
+            models.Index(
+                fields=["-comment_count", "-id"],
+                name="bugz_ticket_comments_idx",
+            ),
+        ]
 
     def get_absolute_url(self):
         return reverse("bugz:ticket", args=[self.pk])
@@ -106,13 +166,37 @@ class Ticket(models.Model):
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Loaded state, diffed against by save_ticket_update.
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using, fields, **kwargs)
+        if fields is None:
+            fields = [
+                f.attname
+                for f in self._meta.concrete_fields
+                if f.attname not in self.get_deferred_fields()
+            ]
+        else:
+            fields = [self._meta.get_field(name).attname for name in fields]
+        loaded = getattr(self, "_loaded_values", {})
+        self._loaded_values = {
+            **loaded,
+            **{name: getattr(self, name) for name in fields},
+        }
+        self._loaded_many = {}
+
     def clean(self):
         if self.pk is not None and self.dupe_of_id == self.pk:
             raise ValidationError(
                 {"dupe_of": "A ticket cannot duplicate itself."}
             )
-        # TODO: validate that blocked_by does not contain itself.
-        # Nontrivial, Django validation of M2M fields is basically nonexistent.
+        # Blockers are validated by graph.validate_blockers, since M2M fields
+        # are only set after clean.
 
 
 class TicketUpdate(models.Model):
@@ -129,62 +213,706 @@ class TicketUpdate(models.Model):
     authored_on = models.DateTimeField(default=timezone.now)
     old_value = models.TextField(blank=True)
     comment = models.TextField(blank=True)
+    # Rendered comment, see bugz.markup.
+    comment_html = models.TextField(blank=True, editable=False)
+    comment_html_key = models.CharField(
+        max_length=64, blank=True, editable=False
+    )
 
     class Meta:
         ordering = ["authored_on"]
 
 
-def save_ticket_comment(ticket: Ticket, authored_by, comment: str):
-    return TicketUpdate.objects.create(
-        ticket=ticket, authored_by=authored_by, comment=comment
+class TicketEvent(models.Model):
+    """A resolved entry of a ticket log, materialized at write time.
+
+    Values are JSON: scalars for plain fields, primary keys for foreign keys
+    and sorted lists of primary keys for many-to-many fields, of which only
+    one side is set. Comments have no value, their text lives in the
+    update."""
+
+    ticket = models.ForeignKey(
+        Ticket, related_name="events", on_delete=models.CASCADE
     )
+    update = models.ForeignKey(
+        TicketUpdate, related_name="events", on_delete=models.CASCADE
+    )
+    authored_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+    authored_on = models.DateTimeField()
+    # Stable HTML anchor, the Event id.
+    anchor = models.CharField(max_length=64)
+    field = models.CharField(max_length=32)
+    old_value = models.TextField(default="null")
+    new_value = models.TextField(default="null")
+
+    class Meta:
+        ordering = ["authored_on", "id"]
+        indexes = [
+            models.Index(
+                fields=["ticket", "authored_on", "id"],
+                name="bugz_ticketevent_log_idx",
+            ),
+        ]
 
 
-def save_ticket_update(
-    ticket: Ticket, authored_by, blocked_by=None, labels=None
-):
-    old_ticket = Ticket.objects.get(pk=ticket.pk)
-    now = timezone.now()
-    updates = {}
+class TicketChange(models.Model):
+    """A change of a single field of a ticket, indexed for search.
+
+    References are stored as primary keys in old_pk and new_pk, with one row
+    per object added or removed for many-to-many fields. Other values are
+    stored as JSON in old_value and new_value."""
+
+    ticket = models.ForeignKey(
+        Ticket, related_name="changes", on_delete=models.CASCADE
+    )
+    update = models.ForeignKey(
+        TicketUpdate, related_name="changes", on_delete=models.CASCADE
+    )
+    authored_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+    authored_on = models.DateTimeField()
+    field = models.CharField(max_length=32)
+    old_pk = models.IntegerField(null=True, blank=True)
+    new_pk = models.IntegerField(null=True, blank=True)
+    old_value = models.TextField(default="null")
+    new_value = models.TextField(default="null")
+
+    class Meta:
+        ordering = ["authored_on", "id"]
+        indexes = [
+            models.Index(
+                fields=["field", "authored_on"],
+                name="bugz_ticketchange_date_idx",
+            ),
+            models.Index(
+                fields=["field", "old_pk"], name="bugz_ticketchange_old_idx"
+            ),
+            models.Index(
+                fields=["field", "new_pk"], name="bugz_ticketchange_new_idx"
+            ),
+        ]
+
+
+class TicketRollup(models.Model):
+    """Activity of a bucket of tickets on a day, see bugz.rollups."""
+
+    day = models.DateField()
+    # all, label or assignee.
+    dimension = models.CharField(max_length=16)
+    # Primary key of the label or assignee, 0 for all tickets or unassigned
+    # ones.
+    key = models.IntegerField(default=0)
+    # Open tickets that entered and left the bucket.
+    entered = models.IntegerField(default=0)
+    exited = models.IntegerField(default=0)
+    # Tickets closed, and the sum of their age when closed.
+    closed = models.IntegerField(default=0)
+    close_seconds = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["day", "dimension", "key"],
+                name="bugz_ticketrollup_unique",
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=["dimension", "day"], name="bugz_ticketrollup_day_idx"
+            ),
+        ]
+
+
+# Bookkeeping columns maintained by bugz itself. They are never diffed nor
+# saved from a possibly stale ticket instance.
+INTERNAL_FIELDS = {
+    "log_materialized",
+    "description_html",
+    "description_html_key",
+    "comment_count",
+    "update_count",
+    "last_activity_on",
+    "cache_version",
+    "version",
+    "canonical",
+    "changes_indexed",
+}
 
-    def compare_and_store(field, getter):
-        old_value = getter(getattr(old_ticket, field.name))
-        if field.name == "blocked_by":
-            if blocked_by is None:
-                return
-            new_value = blocked_by
-        elif field.name == "labels":
-            if labels is None:
-                return
-            new_value = labels
+# Related model of fields referencing other objects, by field name.
+REFERENCE_FIELDS = {
+    "assignee": lambda: get_user_model(),
+    "dupe_of": lambda: Ticket,
+    "labels": lambda: Label,
+    "blocked_by": lambda: Ticket,
+}
+MANY_FIELDS = {"labels", "blocked_by"}
+
+
+def comment_event(update: TicketUpdate) -> TicketEvent:
+    return TicketEvent(
+        ticket_id=update.ticket_id,
+        update=update,
+        authored_by_id=update.authored_by_id,
+        authored_on=update.authored_on,
+        anchor=get_comment_hash(update),
+        field="comment",
+    )
+
+
+def field_events(update: TicketUpdate, changes):
+    """Build the TicketEvent rows of an update.
+
+    changes maps field names to (old, new) pairs of JSON values. Events are
+    returned oldest first, which within a single update is the reverse of
+    the order build_ticket_log always yielded them in."""
+
+    def event(field, suffix, old, new):
+        return TicketEvent(
+            ticket_id=update.ticket_id,
+            update=update,
+            authored_by_id=update.authored_by_id,
+            authored_on=update.authored_on,
+            anchor=f"event-{update.pk}-{field}{suffix}",
+            field=field,
+            old_value=json.dumps(old),
+            new_value=json.dumps(new),
+        )
+
+    events = []
+    for field, (old, new) in changes.items():
+        if field in MANY_FIELDS:
+            removed = sorted(set(old) - set(new))
+            added = sorted(set(new) - set(old))
+            if removed:
+                events.append(event(field, "-removed", removed, None))
+            if added:
+                events.append(event(field, "-added", None, added))
         else:
-            new_value = getter(getattr(ticket, field.name))
-        if old_value != new_value:
-            updates[field.name] = old_value
+            events.append(event(field, "", old, new))
+    return events[::-1]
+
+
+def field_changes(update: TicketUpdate, changes):
+    """Build the TicketChange rows of an update, from the same changes as
+    field_events."""
+
+    def change(field, **values):
+        return TicketChange(
+            ticket_id=update.ticket_id,
+            update=update,
+            authored_by_id=update.authored_by_id,
+            authored_on=update.authored_on,
+            field=field,
+            **values,
+        )
 
-    for field in Ticket._meta.fields:
-        if field.many_to_one:
-            compare_and_store(field, lambda e: None if e is None else e.pk)
+    rows = []
+    for field, (old, new) in changes.items():
+        if field in MANY_FIELDS:
+            rows.extend(
+                change(field, old_pk=pk) for pk in sorted(set(old) - set(new))
+            )
+            rows.extend(
+                change(field, new_pk=pk) for pk in sorted(set(new) - set(old))
+            )
+        elif field in REFERENCE_FIELDS:
+            rows.append(change(field, old_pk=old, new_pk=new))
         else:
-            compare_and_store(field, lambda e: e)
+            rows.append(
+                change(
+                    field, old_value=json.dumps(old), new_value=json.dumps(new)
+                )
+            )
+    return rows
+
+
+def _record_activity(ticket: Ticket, update: TicketUpdate):
+    """Account for a new update in the counters and version of its ticket."""
+    comments = 1 if update.comment else 0
+    Ticket.objects.filter(pk=ticket.pk).update(
+        comment_count=models.F("comment_count") + comments,
+        update_count=models.F("update_count") + 1,
+        last_activity_on=update.authored_on,
+        cache_version=models.F("cache_version") + 1,
+    )
+    # Mirror the change on the instance, without reading it back.
+    ticket.comment_count += comments
+    ticket.update_count += 1
+    ticket.last_activity_on = update.authored_on
+    ticket.cache_version += 1
+
+
+def touch_tickets(tickets) -> int:
+    """Bump the cache version of a queryset of tickets.
+
+    For changes made outside of save_ticket_update, e.g. to their labels."""
+    return tickets.update(cache_version=models.F("cache_version") + 1)
+
+
+def _history_references(field, pks) -> Q:
+    """Tickets whose history references pks in field, or may: those whose
+    changes are not indexed yet."""
+    changes = TicketChange.objects.filter(
+        Q(old_pk__in=pks) | Q(new_pk__in=pks), field=field
+    )
+    return Q(pk__in=changes.values("ticket")) | Q(changes_indexed=False)
+
+
+def touch_label_tickets(pks) -> int:
+    """Bump the tickets showing labels, which were renamed or deleted."""
+    carrying = Ticket.labels.through.objects.filter(label__in=pks)
+    return touch_tickets(
+        Ticket.objects.filter(
+            Q(pk__in=carrying.values("ticket"))
+            | _history_references("labels", pks)
+        )
+    )
+
+
+def touch_user_tickets(pks) -> int:
+    """Bump the tickets showing users, which were renamed or deleted."""
+    authored = TicketUpdate.objects.filter(authored_by__in=pks)
+    return touch_tickets(
+        Ticket.objects.filter(
+            Q(authored_by__in=pks)
+            | Q(assignee__in=pks)
+            | Q(pk__in=authored.values("ticket"))
+            | _history_references("assignee", pks)
+        )
+    )
+
+
+def label_changed(sender, instance, created, **kwargs):
+    """Bump the tickets showing a renamed label, a post_save receiver."""
+    if not created:
+        touch_label_tickets([instance.pk])
+
+
+def label_deleted(sender, instance, **kwargs):
+    """Bump the tickets showing a deleted label, a pre_delete receiver."""
+    touch_label_tickets([instance.pk])
+
+
+def user_changing(sender, instance, update_fields=None, **kwargs):
+    """Bump the tickets showing a user being renamed, a pre_save receiver.
+
+    Saves not writing the username, such as logins, are free."""
+    name = instance.USERNAME_FIELD
+    if instance.pk is None or (
+        update_fields is not None and name not in update_fields
+    ):
+        return
+    old = (
+        sender._default_manager.filter(pk=instance.pk)
+        .values_list(name, flat=True)
+        .first()
+    )
+    if old is not None and old != getattr(instance, name):
+        touch_user_tickets([instance.pk])
+
+
+def user_deleted(sender, instance, **kwargs):
+    """Bump the tickets showing a deleted user, a pre_delete receiver."""
+    touch_user_tickets([instance.pk])
+
+
+def repair_ticket_counters(tickets):
+    """Recompute the activity counters of a queryset of tickets.
 
-    for field in Ticket._meta.many_to_many:
-        compare_and_store(
-            field, lambda e: list(e.values_list("pk", flat=True))
+    Returns the number of tickets updated."""
+    updates = TicketUpdate.objects.filter(ticket=models.OuterRef("pk"))
+
+    def aggregate(qs, expression):
+        return models.Subquery(
+            qs.order_by()
+            .values("ticket")
+            .annotate(value=expression)
+            .values("value")
         )
 
+    return tickets.update(
+        comment_count=Coalesce(
+            aggregate(updates.exclude(comment=""), models.Count("pk")), 0
+        ),
+        update_count=Coalesce(aggregate(updates, models.Count("pk")), 0),
+        last_activity_on=Coalesce(
+            aggregate(updates, models.Max("authored_on")),
+            models.F("created_on"),
+        ),
+    )
+
+
+def save_ticket_comment(ticket: Ticket, authored_by, comment: str):
+    from bugz import live, search
+
     with transaction.atomic():
-        if labels is not None:
-            ticket.labels.set(labels)
-        if blocked_by is not None:
-            ticket.blocked_by.set(blocked_by)
-        ticket.save()
-        return TicketUpdate.objects.create(
+        update = TicketUpdate(
+            ticket=ticket, authored_by=authored_by, comment=comment
+        )
+        markup.refresh(update, "comment")
+        update.save()
+        comment_event(update).save()
+        _record_activity(ticket, update)
+        search.index_ticket(ticket)
+        live.publish_ticket(ticket.pk)
+        return update
+
+
+def _loaded_state(ticket: Ticket, many_fields):
+    """The state of ticket when it was loaded, as diffed by save_ticket_update.
+
+    None unless every field was loaded, and many_fields prefetched or
+    written by save_ticket_update since."""
+    loaded = getattr(ticket, "_loaded_values", None)
+    if loaded is None:
+        return None
+    state = {}
+    for field in Ticket._meta.concrete_fields:
+        if field.attname not in loaded:
+            return None
+        state[field.name] = loaded[field.attname]
+    prefetched = getattr(ticket, "_prefetched_objects_cache", {})
+    for name in many_fields:
+        if name in getattr(ticket, "_loaded_many", {}):
+            state[name] = sorted(ticket._loaded_many[name])
+        elif name in prefetched:
+            state[name] = sorted(obj.pk for obj in prefetched[name])
+        else:
+            return None
+    return state
+
+
+def _read_state_for_update(ticket: Ticket, many_fields):
+    """The state of ticket in the database, locked until the transaction
+    ends."""
+    row = Ticket.objects.select_for_update().get(pk=ticket.pk)
+    state = {
+        field.name: getattr(row, field.attname)
+        for field in Ticket._meta.concrete_fields
+    }
+    for name in many_fields:
+        state[name] = sorted(
+            getattr(row, name).order_by().values_list("pk", flat=True)
+        )
+    return state
+
+
+def _write_many(ticket: Ticket, name, old, new):
+    """Replace the old related primary keys of a ticket by new ones."""
+    field = Ticket._meta.get_field(name)
+    through = field.remote_field.through
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    added = set(new) - set(old)
+    removed = set(old) - set(new)
+    rows = [(ticket.pk, pk) for pk in added]
+    q = Q(**{source: ticket.pk, f"{target}__in": removed})
+    if field.remote_field.symmetrical:
+        # Both directions are stored.
+        rows += [(pk, ticket.pk) for pk in added if pk != ticket.pk]
+        q |= Q(**{f"{source}__in": removed, target: ticket.pk})
+    if removed:
+        through.objects.filter(q).delete()
+    if rows:
+        through.objects.bulk_create(
+            [
+                through(**{f"{source}_id": a, f"{target}_id": b})
+                for a, b in rows
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class TicketConflict(Exception):
+    """The ticket was edited since the version a change was made against."""
+
+    def __init__(self, ticket: Ticket, version: int):
+        super().__init__(f"Ticket {ticket.pk} is at version {version}.")
+        self.ticket = ticket
+        # The current version of the ticket.
+        self.version = version
+
+
+@instrumentation.timed("update")
+def save_ticket_update(
+    ticket: Ticket, authored_by, blocked_by=None, labels=None, version=None
+):
+    """Save the changes made to ticket, and record them in its history.
+
+    Changes are found by diffing ticket against its state when it was
+    loaded, which needs no query if it was fully loaded with the related
+    objects being replaced prefetched. The row is only written if it has not
+    changed since, otherwise, or if that state is unknown, it is read again
+    and locked.
+
+    version is the version of the ticket the change was made against, if
+    known. Should the ticket have been edited since, TicketConflict is
+    raised and nothing is saved. Blockers or duplicates closing a cycle
+    raise a ValidationError."""
+    from bugz import duplicates, graph, live, rollups, search
+
+    many = {}
+    if blocked_by is not None:
+        many["blocked_by"] = [getattr(t, "pk", t) for t in blocked_by]
+    if labels is not None:
+        many["labels"] = [getattr(label, "pk", label) for label in labels]
+
+    now = timezone.now()
+    values = {
+        field.attname: getattr(ticket, field.attname)
+        for field in Ticket._meta.concrete_fields
+        if not field.primary_key and field.name not in INTERNAL_FIELDS
+    }
+    activity = dict(
+        update_count=models.F("update_count") + 1,
+        last_activity_on=now,
+        cache_version=models.F("cache_version") + 1,
+        version=models.F("version") + 1,
+    )
+
+    with transaction.atomic():
+        old = _loaded_state(ticket, many)
+        rows = Ticket.objects.filter(pk=ticket.pk)
+        if version is not None:
+            rows = rows.filter(version=version)
+        if old is None or not rows.filter(
+            cache_version=old["cache_version"]
+        ).update(**values, **activity):
+            old = _read_state_for_update(ticket, many)
+            if version is not None and old["version"] != version:
+                raise TicketConflict(ticket, old["version"])
+            Ticket.objects.filter(pk=ticket.pk).update(**values, **activity)
+
+        updates = {}
+        changes = {}
+        for field in Ticket._meta.concrete_fields:
+            if field.primary_key or field.name in INTERNAL_FIELDS:
+                continue
+            new_value = values[field.attname]
+            if old[field.name] != new_value:
+                updates[field.name] = old[field.name]
+                changes[field.name] = (old[field.name], new_value)
+        for name, new_value in many.items():
+            if name == "blocked_by":
+                graph.validate_blockers(
+                    ticket, set(new_value) - set(old[name])
+                )
+            if set(old[name]) != set(new_value):
+                updates[name] = old[name]
+                changes[name] = (old[name], new_value)
+                _write_many(ticket, name, old[name], new_value)
+        if "dupe_of" in changes:
+            canonical = duplicates.update_canonical(
+                [ticket], ticket.dupe_of_id
+            )[ticket.pk]
+        else:
+            canonical = old["canonical"]
+
+        if "title" in updates or "description" in updates:
+            search.index_ticket(ticket)
+        if "description" in updates:
+            markup.cached_html(ticket, "description")
+        update = TicketUpdate.objects.create(
             ticket=ticket,
             authored_by=authored_by,
             authored_on=now,
             old_value=json.dumps(updates),
         )
+        TicketEvent.objects.bulk_create(field_events(update, changes))
+        TicketChange.objects.bulk_create(field_changes(update, changes))
+        # Buckets of the ticket, see bugz.rollups.
+        new = {"open": ticket.open, "assignee": ticket.assignee_id}
+        if "labels" in many:
+            new["labels"] = many["labels"]
+        rollups.record_changes(
+            [(ticket.pk, old["created_on"], {k: old[k] for k in new}, new)],
+            now,
+        )
+        live.publish_ticket(ticket.pk)
+
+    # The instance now mirrors the row, make that its loaded state.
+    ticket.update_count = old["update_count"] + 1
+    ticket.comment_count = old["comment_count"]
+    ticket.last_activity_on = now
+    ticket.cache_version = old["cache_version"] + 1
+    ticket.version = old["version"] + 1
+    ticket.canonical_id = canonical
+    ticket._loaded_values = {
+        field.attname: getattr(ticket, field.attname)
+        for field in Ticket._meta.concrete_fields
+    }
+    ticket._loaded_many = {
+        **getattr(ticket, "_loaded_many", {}),
+        **{name: set(new_value) for name, new_value in many.items()},
+    }
+    for name in many:
+        # Outdated by the write.
+        getattr(ticket, "_prefetched_objects_cache", {}).pop(name, None)
+    return update
+
+
+# Plain fields bulk_update_tickets can set, by name, and their attribute.
+BULK_FIELDS = {
+    "open": "open",
+    "locked": "locked",
+    "assignee": "assignee_id",
+    "dupe_of": "dupe_of_id",
+}
+
+
+def bulk_update_tickets(
+    tickets, authored_by, values=None, add_labels=(), remove_labels=()
+) -> List[TicketUpdate]:
+    """Apply the same change to many tickets, with their history.
+
+    values maps BULK_FIELDS to their new value, objects or primary keys for
+    references. Tickets are diffed in memory against a single fetch of them
+    and their labels, and written with a fixed number of queries. Only
+    tickets that actually change get an update, which are returned.
+    Duplicates closing a cycle raise a ValidationError."""
+    from bugz import duplicates, live, rollups
+
+    values = {
+        field: getattr(value, "pk", value)
+        for field, value in (values or {}).items()
+    }
+    unknown = set(values) - set(BULK_FIELDS)
+    if unknown:
+        raise ValueError(f"Cannot bulk update {', '.join(sorted(unknown))}.")
+    add_labels = {getattr(label, "pk", label) for label in add_labels}
+    remove_labels = {getattr(label, "pk", label) for label in remove_labels}
+    pks = [getattr(t, "pk", t) for t in tickets]
+    LabelThrough = Ticket.labels.through
+    now = timezone.now()
+
+    with transaction.atomic():
+        rows = (
+            Ticket.objects.filter(pk__in=pks)
+            .select_for_update()
+            .only("pk", "created_on", *BULK_FIELDS.values())
+            .order_by()
+        )
+        labels = {}
+        if add_labels or remove_labels:
+            for ticket_id, label_id in LabelThrough.objects.filter(
+                ticket_id__in=pks
+            ).values_list("ticket_id", "label_id"):
+                labels.setdefault(ticket_id, set()).add(label_id)
+
+        changed, all_changes = [], {}
+        for ticket in rows:
+            changes = {}
+            for field, value in values.items():
+                if field == "dupe_of" and value == ticket.pk:
+                    # A ticket cannot duplicate itself.
+                    continue
+                old = getattr(ticket, BULK_FIELDS[field])
+                if old != value:
+                    setattr(ticket, BULK_FIELDS[field], value)
+                    changes[field] = (old, value)
+            if add_labels or remove_labels:
+                old = labels.get(ticket.pk, set())
+                new = (old | add_labels) - remove_labels
+                if old != new:
+                    changes["labels"] = (sorted(old), sorted(new))
+            if changes:
+                changed.append(ticket)
+                all_changes[ticket.pk] = changes
+        if not changed:
+            return []
+
+        fields = [BULK_FIELDS[field] for field in values]
+        if fields:
+            Ticket.objects.bulk_update(changed, fields)
+        changed_pks = [ticket.pk for ticket in changed]
+        if "dupe_of" in values:
+            duplicates.update_canonical(
+                [pk for pk in changed_pks if "dupe_of" in all_changes[pk]],
+                values["dupe_of"],
+            )
+        if remove_labels:
+            LabelThrough.objects.filter(
+                ticket_id__in=changed_pks, label_id__in=remove_labels
+            ).delete()
+        if add_labels:
+            LabelThrough.objects.bulk_create(
+                [
+                    LabelThrough(ticket_id=pk, label_id=label)
+                    for pk in changed_pks
+                    for label in add_labels - labels.get(pk, set())
+                ]
+            )
+        Ticket.objects.filter(pk__in=changed_pks).update(
+            update_count=models.F("update_count") + 1,
+            last_activity_on=now,
+            cache_version=models.F("cache_version") + 1,
+            version=models.F("version") + 1,
+        )
+
+        updates = [
+            TicketUpdate(
+                ticket_id=pk,
+                authored_by=authored_by,
+                authored_on=now,
+                old_value=json.dumps(
+                    {field: old for field, (old, _) in changes.items()}
+                ),
+            )
+            for pk, changes in all_changes.items()
+        ]
+        features = connections[TicketUpdate.objects.db].features
+        if features.can_return_rows_from_bulk_insert:
+            TicketUpdate.objects.bulk_create(updates)
+        else:
+            # Events need the primary key of their update.
+            for update in updates:
+                update.save()
+        TicketEvent.objects.bulk_create(
+            [
+                event
+                for update in updates
+                for event in field_events(
+                    update, all_changes[update.ticket_id]
+                )
+            ]
+        )
+        TicketChange.objects.bulk_create(
+            [
+                change
+                for update in updates
+                for change in field_changes(
+                    update, all_changes[update.ticket_id]
+                )
+            ]
+        )
+        # Buckets of the tickets, see bugz.rollups.
+        buckets = []
+        for ticket in changed:
+            changes = all_changes[ticket.pk]
+            new = {"open": ticket.open, "assignee": ticket.assignee_id}
+            if add_labels or remove_labels:
+                new["labels"] = labels.get(ticket.pk, set())
+                if "labels" in changes:
+                    new["labels"] = changes["labels"][1]
+            old = {
+                k: changes[k][0] if k in changes else v for k, v in new.items()
+            }
+            buckets.append((ticket.pk, ticket.created_on, old, new))
+        rollups.record_changes(buckets, now)
+        for pk in changed_pks:
+            live.publish_ticket(pk)
+        return updates
 
 
 class Event(NamedTuple):
@@ -196,16 +924,350 @@ class Event(NamedTuple):
     field: str
     old_value: Any = None
     new_value: Any = None
+    # Rendered HTML of comments.
+    html: Optional[str] = None
 
 
 def get_comment_hash(update: TicketUpdate):
     return f"comment-{update.pk}"
 
 
-def build_ticket_log(ticket: Ticket):
+def description_event(ticket: Ticket, html=None) -> Event:
+    """Fake comment for the description itself.
+
+    html is its rendered HTML, if already known."""
+    return Event(
+        id=f"ticket-{ticket.pk}",
+        authored_by=ticket.authored_by,
+        authored_on=ticket.created_on,
+        field="comment",
+        new_value=ticket.description,
+        html=(
+            markup.cached_html(ticket, "description") if html is None else html
+        ),
+    )
+
+
+def _to_json_value(field, value):
+    if field in MANY_FIELDS:
+        return None if value is None else sorted(e.pk for e in value)
+    if field in REFERENCE_FIELDS:
+        return None if value is None else value.pk
+    return value
+
+
+def materialize_ticket_log(ticket: Ticket):
+    """Replace the TicketEvent rows of a ticket by a replay of its history.
+
+    Events referencing deleted objects cannot be replayed and are lost, they
+    were not displayed anyway."""
+    events = []
+    for update, event in _replay_ticket_log(ticket):
+        if update is None:
+            continue
+        events.append(
+            TicketEvent(
+                ticket_id=ticket.pk,
+                update=update,
+                authored_by_id=update.authored_by_id,
+                authored_on=update.authored_on,
+                anchor=event.id,
+                field=event.field,
+                old_value=json.dumps(
+                    _to_json_value(event.field, event.old_value)
+                ),
+                new_value=json.dumps(
+                    _to_json_value(event.field, event.new_value)
+                ),
+            )
+        )
+    with transaction.atomic():
+        TicketEvent.objects.filter(ticket=ticket).delete()
+        TicketEvent.objects.bulk_create(events[::-1])
+        Ticket.objects.filter(pk=ticket.pk).update(log_materialized=True)
+    ticket.log_materialized = True
+
+
+def history_state(ticket: Ticket):
+    """The current value of the fields history is kept of, as JSON.
+
+    ticket must have its labels and blockers prefetched."""
+    return {
+        "title": ticket.title,
+        "description": ticket.description,
+        "open": ticket.open,
+        "locked": ticket.locked,
+        "assignee": ticket.assignee_id,
+        "dupe_of": ticket.dupe_of_id,
+        "labels": sorted(label.pk for label in ticket.labels.all()),
+        "blocked_by": sorted(t.pk for t in ticket.blocked_by.all()),
+    }
+
+
+def rewind_history(ticket: Ticket, updates):
+    """Pair the updates of ticket, most recent first, with their changes.
+
+    Updates only store old values, new ones are found by rewinding the
+    current state of the ticket, like _replay_ticket_log does but without
+    resolving references. Changes map fields to (old, new) pairs of JSON
+    values, as given to field_events, and are None for comments."""
+    state = history_state(ticket)
+    for update in updates:
+        if not update.old_value:
+            yield update, None
+            continue
+        changes = {}
+        for field, old in json.loads(update.old_value).items():
+            if field not in state:
+                # Not a field we keep history of.
+                continue
+            changes[field] = (old, state[field])
+            state[field] = old
+        yield update, changes
+
+
+def index_ticket_changes(tickets):
+    """Replace the TicketChange rows of tickets by a rewind of their history.
+
+    tickets must have their labels and blockers prefetched."""
+    updates = {}
+    for update in (
+        TicketUpdate.objects.filter(ticket__in=tickets)
+        .exclude(old_value="")
+        .only("pk", "ticket", "authored_by", "authored_on", "old_value")
+        .order_by("-authored_on", "-pk")
+    ):
+        updates.setdefault(update.ticket_id, []).append(update)
+    rows = [
+        change
+        for ticket in tickets
+        for update, changes in rewind_history(
+            ticket, updates.get(ticket.pk, ())
+        )
+        for change in field_changes(update, changes)
+    ]
+    pks = [ticket.pk for ticket in tickets]
+    with transaction.atomic():
+        TicketChange.objects.filter(ticket__in=pks).delete()
+        TicketChange.objects.bulk_create(rows)
+        Ticket.objects.filter(pk__in=pks).update(changes_indexed=True)
+
+
+def _decode_chunk(rows):
+    return [
+        (row, json.loads(row.old_value), json.loads(row.new_value))
+        for row in rows
+    ]
+
+
+def _wanted_references(decoded):
+    """Primary keys referenced by decoded rows, by related model."""
+    wanted = {}
+    for row, old, new in decoded:
+        if row.field not in REFERENCE_FIELDS:
+            continue
+        pks = wanted.setdefault(REFERENCE_FIELDS[row.field](), set())
+        for value in (old, new):
+            if value is None:
+                continue
+            pks.update(value if row.field in MANY_FIELDS else [value])
+    return {model: pks for model, pks in wanted.items() if pks}
+
+
+def _resolve_chunk(rows):
+    decoded = _decode_chunk(rows)
+    lookups = {
+        model: model._default_manager.in_bulk(pks)
+        for model, pks in _wanted_references(decoded).items()
+    }
+    html = {
+        row.pk: markup.cached_html(row.update, "comment")
+        for row, _, _ in decoded
+        if row.field == "comment"
+    }
+    return _chunk_events(decoded, lookups, html)
+
+
+async def _aresolve_chunk(rows):
+    """Async version of _resolve_chunk."""
+    decoded = _decode_chunk(rows)
+    wanted = _wanted_references(decoded)
+    # Issued together rather than one after the other.
+    found = await asyncio.gather(
+        *(
+            model._default_manager.ain_bulk(pks)
+            for model, pks in wanted.items()
+        )
+    )
+    lookups = dict(zip(wanted, found))
+    html = {
+        row.pk: await markup.acached_html(row.update, "comment")
+        for row, _, _ in decoded
+        if row.field == "comment"
+    }
+    return _chunk_events(decoded, lookups, html)
+
+
+def _chunk_events(decoded, lookups, html):
+    for row, old, new in decoded:
+        if row.field == "comment":
+            yield Event(
+                id=row.anchor,
+                authored_by=row.authored_by,
+                authored_on=row.authored_on,
+                field="comment",
+                new_value=row.update.comment,
+                html=html[row.pk],
+            )
+            continue
+
+        if row.field in REFERENCE_FIELDS:
+            lookup = lookups.get(REFERENCE_FIELDS[row.field](), {})
+            if row.field in MANY_FIELDS:
+                old = old and {lookup[pk] for pk in old if pk in lookup}
+                new = new and {lookup[pk] for pk in new if pk in lookup}
+                if not old and not new:
+                    continue
+                old, new = old or None, new or None
+            else:
+                if (old is not None and old not in lookup) or (
+                    new is not None and new not in lookup
+                ):
+                    continue
+                old, new = lookup.get(old), lookup.get(new)
+
+        yield Event(
+            id=row.anchor,
+            authored_by=row.authored_by,
+            authored_on=row.authored_on,
+            field=row.field,
+            old_value=old,
+            new_value=new,
+        )
+
+
+def resolve_events(rows, chunk_size=500):
+    """Turn TicketEvent rows into Event tuples.
+
+    References are fetched with one query per related model and chunk of
+    rows. Like deleted objects, they are silently dropped from events, and
+    events left with nothing to show are skipped."""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield from _resolve_chunk(chunk)
+
+
+def _event_rows(ticket: Ticket):
+    """The TicketEvent rows of a ticket, most recent first."""
+    return (
+        TicketEvent.objects.filter(ticket=ticket)
+        .select_related("authored_by", "update")
+        .defer("update__old_value")
+        .order_by("-authored_on", "-id")
+    )
+
+
+def build_ticket_log(
+    ticket: Ticket, oldest_first=False, before=None, chunk_size=500
+):
     """Generate Event tuples for each comment and field update for this ticket.
 
-    Most recent update comes first."""
+    Most recent update comes first, unless oldest_first is set. before is the
+    older_cursor of a LogWindow: only events older than it are generated.
+    Rows are fetched and resolved chunk_size at a time."""
+    return instrumentation.timed_iter(
+        "log",
+        _build_ticket_log(ticket, oldest_first, before, chunk_size),
+        "events",
+    )
+
+
+def _build_ticket_log(ticket: Ticket, oldest_first, before, chunk_size):
+    if not ticket.log_materialized:
+        if before is not None:
+            raise ValueError(f"Log of ticket {ticket.pk} is not materialized.")
+        log = (event for _, event in _replay_ticket_log(ticket))
+        yield from (reversed(list(log)) if oldest_first else log)
+        return
+
+    rows = _event_rows(ticket)
+    if before is not None:
+        rows = pagination.filter_after(rows, before)
+    if oldest_first:
+        yield description_event(ticket)
+        rows = rows.reverse()
+    yield from resolve_events(
+        rows.iterator(chunk_size=chunk_size), chunk_size=chunk_size
+    )
+    if not oldest_first:
+        yield description_event(ticket)
+
+
+class LogWindow(NamedTuple):
+    # Events, oldest first.
+    events: List[Event]
+    # Cursor to the window of events before these, if any.
+    older_cursor: Optional[str] = None
+    # Primary key of the TicketEvent row of the newest event, if the window
+    # ends with it. Live updates start after it.
+    newest_row: Optional[int] = None
+
+
+def get_ticket_log_window(ticket: Ticket, size: int, before=None) -> LogWindow:
+    """The size most recent events of a ticket, or those older than before.
+
+    Tickets whose log is not materialized are not windowed."""
+    if not ticket.log_materialized:
+        return LogWindow(list(build_ticket_log(ticket, oldest_first=True)))
+
+    with instrumentation.timed("log"):
+        paginator = pagination.KeysetPaginator(_event_rows(ticket), size)
+        page = paginator.page(before)
+        events = list(resolve_events(page.object_list[::-1]))
+        if not page.has_next():
+            events.insert(0, description_event(ticket))
+    instrumentation.count("events", len(events))
+    return LogWindow(events, page.next_cursor, _newest_row(page, before))
+
+
+def _newest_row(page, before) -> Optional[int]:
+    if before is None:
+        return page.object_list[0].pk if page.object_list else 0
+
+
+async def aget_ticket_log_window(
+    ticket: Ticket, size: int, before=None
+) -> LogWindow:
+    """Async version of get_ticket_log_window.
+
+    ticket.authored_by must be loaded already. Logs that are not
+    materialized are replayed in a thread."""
+    if not ticket.log_materialized:
+        return await sync_to_async(get_ticket_log_window)(ticket, size, before)
+
+    with instrumentation.timed("log"):
+        paginator = pagination.KeysetPaginator(_event_rows(ticket), size)
+        page = await paginator.apage(before)
+        events = []
+        rows = page.object_list[::-1]
+        for i in range(0, len(rows), 500):
+            events.extend(await _aresolve_chunk(rows[i : i + 500]))
+        if not page.has_next():
+            html = await markup.acached_html(ticket, "description")
+            events.insert(0, description_event(ticket, html))
+    instrumentation.count("events", len(events))
+    return LogWindow(events, page.next_cursor, _newest_row(page, before))
+
+
+def _replay_ticket_log(ticket: Ticket):
+    """Rebuild the log of a ticket from its TicketUpdate rows.
+
+    Generates (update, Event) pairs, most recent first, rewinding the current
+    state of the ticket with each update. This is how logs were built before
+    TicketEvent, and still are for tickets that were not backfilled yet."""
 
     def build_lookup_dict(qs, pks):
         if not pks:
@@ -285,17 +1347,21 @@ def build_ticket_log(ticket: Ticket):
     for update, old_value in zip(updates, decoded_old_values):
         # Just a comment.
         if old_value is None:
-            yield Event(
+            yield update, Event(
                 id=get_comment_hash(update),
                 authored_by=update.authored_by,
                 authored_on=update.authored_on,
                 field="comment",
                 new_value=update.comment,
+                html=markup.cached_html(update, "comment"),
             )
             continue
 
         # Field updates.
         for field, old in old_value.items():
+            if field not in current_state:
+                # Not a field we keep history of.
+                continue
             new = current_state[field]
             if field == "assignee":
                 changes = emit(old, new, many=False, lookup=users)
@@ -312,7 +1378,7 @@ def build_ticket_log(ticket: Ticket):
                 h = hashlib.md5(
                     repr((field, old_v, new_v)).encode()
                 ).hexdigest()[:4]
-                yield Event(
+                yield update, Event(
                     id=f"event-{update.pk}-{h}",
                     authored_by=update.authored_by,
                     authored_on=update.authored_on,
@@ -323,11 +1389,4 @@ def build_ticket_log(ticket: Ticket):
 
             current_state[field] = old
 
-    # Fake comment for the description itself.
-    yield Event(
-        id=f"ticket-{ticket.pk}",
-        authored_by=ticket.authored_by,
-        authored_on=ticket.created_on,
-        field="comment",
-        new_value=ticket.description,
-    )
+    yield None, description_event(ticket)
@@ -0,0 +1,186 @@
+"""
+Keyset (also known as cursor) pagination.
+
+Instead of an OFFSET, a page cursor remembers the ordering values of the row
+it starts after, and the next page filters on them. Provided an index matches
+the ordering, page N costs the same as page 1.
+"""
+
+import base64
+import binascii
+import datetime
+import json
+from typing import List, NamedTuple, Optional
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class OrderKey(NamedTuple):
+    name: str
+    descending: bool
+
+    def order_by(self, forward=True):
+        return self.name if self.descending != forward else f"-{self.name}"
+
+
+def get_order_keys(qs) -> List[OrderKey]:
+    """The ordering of qs, made total by appending the primary key."""
+    keys = []
+    for field in qs.query.order_by or qs.model._meta.ordering:
+        if not isinstance(field, str) or "__" in field or field == "?":
+            raise ValueError(f"Cannot paginate on ordering {field!r}.")
+        name = field.lstrip("-")
+        if name == qs.model._meta.pk.name:
+            name = "pk"
+        keys.append(OrderKey(name, field.startswith("-")))
+    if "pk" not in {key.name for key in keys}:
+        keys.append(OrderKey("pk", keys[-1].descending if keys else False))
+    return keys
+
+
+def _encode_value(value):
+    # DjangoJSONEncoder truncates datetimes to milliseconds, which would make
+    # rows sharing a millisecond unreachable.
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(values, forward: bool) -> str:
+    payload = json.dumps(
+        [forward, [_encode_value(v) for v in values]], separators=(",", ":")
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, model, keys):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        forward, values = json.loads(payload)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise InvalidCursor("Malformed cursor.")
+    if not isinstance(forward, bool) or not isinstance(values, list):
+        raise InvalidCursor("Malformed cursor.")
+    if len(values) != len(keys):
+        raise InvalidCursor("Cursor does not match the ordering.")
+    try:
+        values = [
+            _to_python(model, key.name, value)
+            for key, value in zip(keys, values)
+        ]
+    except (TypeError, ValueError, ValidationError):
+        raise InvalidCursor("Malformed cursor value.")
+    return forward, values
+
+
+def _to_python(model, name, value):
+    # Keyset filters cannot match NULL, and nothing else is ever encoded.
+    if not isinstance(value, (str, int, float)):
+        raise TypeError(f"Unexpected cursor value {value!r}.")
+    try:
+        field = model._meta.pk if name == "pk" else model._meta.get_field(name)
+    except FieldDoesNotExist:
+        # An annotation, JSON types will do.
+        return value
+    value = field.to_python(value)
+    if value is None:
+        raise ValueError("Cursor values cannot be null.")
+    return value
+
+
+def _keyset_q(keys, values, forward):
+    """Match rows strictly after values in the given direction."""
+    q = Q()
+    for i, key in enumerate(keys):
+        lookup = "lt" if key.descending == forward else "gt"
+        equal = {k.name: v for k, v in zip(keys[:i], values[:i])}
+        q |= Q(**equal, **{f"{key.name}__{lookup}": values[i]})
+    return q
+
+
+def filter_after(qs, cursor: str):
+    """Restrict qs to the rows after cursor, in the cursor direction."""
+    keys = get_order_keys(qs)
+    forward, values = decode_cursor(cursor, qs.model, keys)
+    return qs.filter(_keyset_q(keys, values, forward))
+
+
+class KeysetPage:
+    def __init__(self, object_list, has_next, has_previous, keys):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.keys = keys
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def _cursor(self, obj, forward):
+        return encode_cursor(
+            [getattr(obj, key.name) for key in self.keys], forward
+        )
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        if self._has_next and self.object_list:
+            return self._cursor(self.object_list[-1], forward=True)
+
+    @property
+    def previous_cursor(self) -> Optional[str]:
+        if self._has_previous and self.object_list:
+            return self._cursor(self.object_list[0], forward=False)
+
+
+class KeysetPaginator:
+    """Paginate a queryset by its ordering, without OFFSET nor COUNT(*).
+
+    Whether there is a next page is known by fetching one extra row."""
+
+    def __init__(self, queryset, per_page: int):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = get_order_keys(queryset)
+
+    def _query(self, cursor: Optional[str]):
+        qs = self.queryset
+        forward, values = True, None
+        if cursor:
+            forward, values = decode_cursor(cursor, qs.model, self.keys)
+            qs = qs.filter(_keyset_q(self.keys, values, forward))
+        qs = qs.order_by(*(key.order_by(forward) for key in self.keys))
+        return qs[: self.per_page + 1], forward, values
+
+    def page(self, cursor: Optional[str] = None) -> KeysetPage:
+        qs, forward, values = self._query(cursor)
+        return self._page(list(qs), forward, values)
+
+    async def apage(self, cursor: Optional[str] = None) -> KeysetPage:
+        """Async version of page."""
+        qs, forward, values = self._query(cursor)
+        return self._page([row async for row in qs], forward, values)
+
+    def _page(self, rows, forward, values) -> KeysetPage:
+        has_more = len(rows) > self.per_page
+        rows = rows[: self.per_page]
+        if forward:
+            return KeysetPage(rows, has_more, values is not None, self.keys)
+        # Going backwards, there is a next page: the one we came from.
+        rows.reverse()
+        return KeysetPage(rows, True, has_more, self.keys)
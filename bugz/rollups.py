@@ -0,0 +1,386 @@
+"""
+Daily rollups of ticket activity, for reports.
+
+Tickets are counted in buckets: every ticket, each of their labels and their
+assignee. For each day and bucket, a TicketRollup row sums how many open
+tickets entered or left the bucket, how many were closed and how long they
+had been open. Rows hold changes rather than totals, so a write only adds to
+the rows of its own day, with a single upsert, and the number of open
+tickets of a bucket on a day is the sum of those changes up to that day.
+
+Rollups are maintained by the functions changing tickets and by receivers
+of deletions, and rebuilt from history by bugz_rebuild_rollups. Reports read
+nothing else. Deleted tickets leave the open tickets of the day they were
+deleted on, but a rebuild forgets them entirely.
+"""
+
+import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from bugz import models
+
+# Buckets are (dimension, key) pairs. Keys are primary keys, 0 for the whole
+# tracker and for unassigned tickets.
+DIMENSIONS = ("all", "label", "assignee")
+# Columns of TicketRollup added to by writes.
+COUNTERS = ("entered", "exited", "closed", "close_seconds")
+
+
+class State(NamedTuple):
+    """What decides the buckets of a ticket."""
+
+    open: bool
+    labels: Iterable[int]
+    assignee: Optional[int]
+
+
+# A ticket before its creation.
+NOTHING = State(False, (), None)
+
+
+def state_of(values: dict) -> State:
+    """The State of a history_state dict, or of one with the same keys."""
+    return State(values["open"], tuple(values["labels"]), values["assignee"])
+
+
+def _buckets(state: State) -> set:
+    return {
+        ("all", 0),
+        ("assignee", state.assignee or 0),
+        *(("label", pk) for pk in state.labels),
+    }
+
+
+def _open_buckets(state: State) -> set:
+    return _buckets(state) if state.open else set()
+
+
+def day_of(moment: datetime.datetime) -> datetime.date:
+    if settings.USE_TZ:
+        # Days of the default time zone, whoever made the change.
+        return timezone.localtime(
+            moment, timezone.get_default_timezone()
+        ).date()
+    return moment.date()
+
+
+class Rollups:
+    """Changes to TicketRollup rows, accumulated in memory."""
+
+    def __init__(self):
+        self.rows: Dict[Tuple[datetime.date, str, int], List[int]] = {}
+
+    def _add(self, day, bucket, counter, value=1):
+        row = self.rows.setdefault((day, *bucket), [0] * len(COUNTERS))
+        row[COUNTERS.index(counter)] += value
+
+    def change(
+        self,
+        created_on: datetime.datetime,
+        old: State,
+        new: State,
+        on: datetime.datetime,
+    ):
+        """Account for a ticket created on created_on going from old to new
+        on on."""
+        day = day_of(on)
+        old_open, new_open = _open_buckets(old), _open_buckets(new)
+        for bucket in new_open - old_open:
+            self._add(day, bucket, "entered")
+        for bucket in old_open - new_open:
+            self._add(day, bucket, "exited")
+        if old.open and not new.open:
+            seconds = max(int((on - created_on).total_seconds()), 0)
+            for bucket in _buckets(new):
+                self._add(day, bucket, "closed")
+                self._add(day, bucket, "close_seconds", seconds)
+
+    def delete(self, state: State, on: datetime.datetime):
+        """Account for a ticket in state being deleted on on."""
+        for bucket in _open_buckets(state):
+            self._add(day_of(on), bucket, "exited")
+
+    def save(self, using=None, batch_size=500):
+        """Add the accumulated changes to the database, in one query per
+        batch of rows."""
+        rows = [
+            (day, dimension, key, *counters)
+            for (day, dimension, key), counters in self.rows.items()
+            if any(counters)
+        ]
+        self.rows = {}
+        connection = connections[using or models.TicketRollup.objects.db]
+        quote = connection.ops.quote_name
+        table = quote(models.TicketRollup._meta.db_table)
+        columns = ", ".join(
+            quote(c) for c in ("day", "dimension", "key", *COUNTERS)
+        )
+        if connection.vendor == "mysql":
+            conflict = "ON DUPLICATE KEY UPDATE " + ", ".join(
+                f"{quote(c)} = {quote(c)} + VALUES({quote(c)})"
+                for c in COUNTERS
+            )
+        else:
+            conflict = (
+                f"ON CONFLICT ({quote('day')}, {quote('dimension')}, "
+                f"{quote('key')}) DO UPDATE SET "
+                + ", ".join(
+                    f"{quote(c)} = {table}.{quote(c)} + excluded.{quote(c)}"
+                    for c in COUNTERS
+                )
+            )
+        values = "(" + ", ".join(["%s"] * (3 + len(COUNTERS))) + ")"
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i : i + batch_size]
+                cursor.execute(
+                    f"INSERT INTO {table} ({columns}) "
+                    f"VALUES {', '.join([values] * len(batch))} {conflict}",
+                    [value for row in batch for value in row],
+                )
+
+
+def record_created(ticket: models.Ticket):
+    """Account for a new ticket, with its labels set."""
+    rollups = Rollups()
+    rollups.change(
+        ticket.created_on,
+        NOTHING,
+        State(
+            ticket.open,
+            ticket.labels.values_list("pk", flat=True),
+            ticket.assignee_id,
+        ),
+        ticket.created_on,
+    )
+    rollups.save()
+
+
+def _changes_buckets(old: dict, new: dict) -> bool:
+    if old["open"] != new["open"]:
+        return True
+    return old["open"] and (
+        old["assignee"] != new["assignee"]
+        or set(old.get("labels", ())) != set(new.get("labels", ()))
+    )
+
+
+def record_changes(tickets, on: datetime.datetime):
+    """Account for changes made to tickets on on, in at most two queries.
+
+    tickets are (pk, created_on, old, new) tuples, old and new being dicts
+    of open, assignee and labels, which may be left out of both when they
+    did not change."""
+    tickets = [t for t in tickets if _changes_buckets(t[2], t[3])]
+    missing = [pk for pk, _, old, _ in tickets if "labels" not in old]
+    labels = {}
+    if missing:
+        for pk, label in models.Ticket.labels.through.objects.filter(
+            ticket_id__in=missing
+        ).values_list("ticket_id", "label_id"):
+            labels.setdefault(pk, []).append(label)
+    rollups = Rollups()
+    for pk, created_on, old, new in tickets:
+        current = labels.get(pk, ())
+        rollups.change(
+            created_on,
+            State(old["open"], old.get("labels", current), old["assignee"]),
+            State(new["open"], new.get("labels", current), new["assignee"]),
+            on,
+        )
+    rollups.save()
+
+
+def ticket_deleted(sender, instance, using, **kwargs):
+    """Account for a deleted ticket, a pre_delete receiver, which runs while
+    its labels are still there.
+
+    Its state is read again, the instance being deleted may be stale."""
+    tickets = models.Ticket.objects.using(using).filter(pk=instance.pk)
+    current = tickets.filter(open=True).values("assignee").first()
+    if current is None:
+        return
+    rollups = Rollups()
+    rollups.delete(
+        State(
+            True,
+            models.Ticket.labels.through.objects.using(using)
+            .filter(ticket=instance.pk)
+            .values_list("label_id", flat=True),
+            current["assignee"],
+        ),
+        timezone.now(),
+    )
+    rollups.save(using)
+
+
+def assignee_deleted(sender, instance, using, **kwargs):
+    """Move the open tickets of a deleted user to the unassigned bucket, a
+    pre_delete receiver: the deletion unassigns them without saving them."""
+    tickets = models.Ticket.objects.using(using).filter(
+        assignee=instance, open=True
+    )
+    old = {"open": True, "assignee": instance.pk}
+    new = {"open": True, "assignee": None}
+    record_changes(
+        [
+            (pk, created_on, old, new)
+            for pk, created_on in tickets.values_list("pk", "created_on")
+        ],
+        timezone.now(),
+    )
+
+
+def rebuild(chunk_size=100) -> int:
+    """Replace every rollup by a replay of the history of every ticket.
+
+    Returns the number of tickets replayed."""
+    rollups = Rollups()
+    tickets = models.Ticket.objects.prefetch_related(
+        "labels", "blocked_by"
+    ).order_by("pk")
+    last_pk, done = 0, 0
+    while True:
+        chunk = list(tickets.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        updates = {}
+        for update in (
+            models.TicketUpdate.objects.filter(ticket__in=chunk)
+            .exclude(old_value="")
+            .only("pk", "ticket", "authored_on", "old_value")
+            .order_by("-authored_on", "-pk")
+        ):
+            updates.setdefault(update.ticket_id, []).append(update)
+        for ticket in chunk:
+            _replay(rollups, ticket, updates.get(ticket.pk, ()))
+        last_pk = chunk[-1].pk
+        done += len(chunk)
+    with transaction.atomic():
+        models.TicketRollup.objects.all().delete()
+        rollups.save()
+    return done
+
+
+def _replay(rollups: Rollups, ticket: models.Ticket, updates):
+    # States after each update, most recent first, then at creation.
+    steps = []
+    state = models.history_state(ticket)
+    for update, changes in models.rewind_history(ticket, updates):
+        if changes is None:
+            continue
+        steps.append((update.authored_on, state_of(state)))
+        state = {**state, **{f: old for f, (old, _) in changes.items()}}
+    old = state_of(state)
+    rollups.change(ticket.created_on, NOTHING, old, ticket.created_on)
+    for on, new in reversed(steps):
+        rollups.change(ticket.created_on, old, new, on)
+        old = new
+
+
+class ReportRow(NamedTuple):
+    key: int
+    name: str
+    # Open tickets at the end of each day of the report.
+    open: List[int]
+    closed: int
+    mean_time_to_close: Optional[datetime.timedelta]
+    # Tickets closed per week.
+    throughput: float
+
+
+class Report(NamedTuple):
+    dimension: str
+    days: List[datetime.date]
+    rows: List[ReportRow]
+
+    @property
+    def daily(self):
+        """(day, open tickets of each row) pairs."""
+        return [
+            (day, [row.open[i] for row in self.rows])
+            for i, day in enumerate(self.days)
+        ]
+
+
+def _names(dimension, keys) -> Dict[int, str]:
+    if dimension == "all":
+        return {0: "All tickets"}
+    if dimension == "label":
+        return dict(
+            models.Label.objects.filter(pk__in=keys).values_list("pk", "name")
+        )
+    User = get_user_model()
+    names = {
+        pk: str(name)
+        for pk, name in User.objects.filter(pk__in=keys).values_list(
+            "pk", User.USERNAME_FIELD
+        )
+    }
+    names[0] = "Unassigned"
+    return names
+
+
+def report(dimension: str, since: datetime.date, until: datetime.date):
+    """Open tickets of each bucket of dimension for each day from since to
+    until, and how many were closed and how fast in that time, from rollups
+    only."""
+    rollups = models.TicketRollup.objects.filter(dimension=dimension)
+    before = dict(
+        rollups.filter(day__lt=since)
+        .values("key")
+        .annotate(open=Sum(F("entered") - F("exited")))
+        .values_list("key", "open")
+    )
+    daily = {}
+    totals = {}
+    for key, day, entered, exited, closed, seconds in rollups.filter(
+        Q(day__gte=since) & Q(day__lte=until)
+    ).values_list(
+        "key", "day", "entered", "exited", "closed", "close_seconds"
+    ):
+        daily[key, day] = entered - exited
+        total = totals.setdefault(key, [0, 0])
+        total[0] += closed
+        total[1] += seconds
+
+    days = [
+        since + datetime.timedelta(days=i)
+        for i in range((until - since).days + 1)
+    ]
+    keys = set(before) | set(totals)
+    names = _names(dimension, keys)
+    rows = []
+    for key in keys:
+        if key not in names:
+            # Deleted since.
+            continue
+        count, counts = before.get(key, 0), []
+        for day in days:
+            count += daily.get((key, day), 0)
+            counts.append(count)
+        closed, seconds = totals.get(key, (0, 0))
+        if not closed and not any(counts):
+            continue
+        rows.append(
+            ReportRow(
+                key=key,
+                name=names[key],
+                open=counts,
+                closed=closed,
+                mean_time_to_close=(
+                    datetime.timedelta(seconds=seconds // closed)
+                    if closed
+                    else None
+                ),
+                throughput=closed * 7 / len(days),
+            )
+        )
+    rows.sort(key=lambda row: (-row.open[-1], row.name))
+    return Report(dimension, days, rows)
@@ -1,4 +1,5 @@
-from rules import predicate, is_staff, add_rule, is_authenticated
+from django.db.models import BooleanField, ExpressionWrapper, Q, Value
+from rules import predicate, is_staff, add_perm, is_authenticated
 
 
 @predicate
@@ -8,27 +9,109 @@ def ticket_is_unlocked(user, ticket):
 
 @predicate
 def is_own_ticket(user, ticket):
-    return ticket.created_by == user
+    return (
+        ticket.authored_by_id is not None and ticket.authored_by_id == user.pk
+    )
 
 
 @predicate
-def is_own_comment_author(user, revision):
-    return revision.user == user
+def is_own_comment_author(user, update):
+    return (
+        update.authored_by_id is not None and update.authored_by_id == user.pk
+    )
 
 
 can_edit_ticket = is_staff | (
     is_authenticated & ticket_is_unlocked & is_own_ticket
 )
 
-add_rule("bugz.can_comment_ticket", is_staff | ticket_is_unlocked)
-add_rule("bugz.can_edit_ticket", can_edit_ticket)
-add_rule("bugz.can_create_ticket", is_authenticated)
-add_rule("bugz.can_list_labels", is_authenticated)
-add_rule("bugz.can_create_label", is_staff)
-add_rule(
+add_perm(
+    "bugz.can_comment_ticket",
+    is_authenticated & (is_staff | ticket_is_unlocked),
+)
+add_perm("bugz.can_edit_ticket", can_edit_ticket)
+add_perm("bugz.can_create_ticket", is_authenticated)
+add_perm("bugz.can_list_labels", is_authenticated)
+add_perm("bugz.can_create_label", is_staff)
+add_perm(
     "bugz.can_edit_comment",
     is_staff | (is_authenticated & is_own_comment_author),
 )
-add_rule("bugz.can_lock_ticket", is_staff)
-add_rule("bugz.can_delete_comment", is_staff)
-add_rule("bugz.can_delete_ticket", is_staff)
+add_perm("bugz.can_lock_ticket", is_staff)
+add_perm("bugz.can_delete_comment", is_staff)
+add_perm("bugz.can_delete_ticket", is_staff)
+add_perm("bugz.can_view_reports", is_staff)
+add_perm("bugz.can_view_stats", is_staff)
+
+
+# The permissions on tickets above as filters of tickets, to check them for
+# many tickets in a single query. Each maps a user to a Q, or to True or
+# False for all tickets or none. Keep them in sync with the predicates, see
+# test_ticket_filters.
+def _can_comment_ticket(user):
+    if not user.is_authenticated:
+        return False
+    return user.is_staff or Q(locked=False)
+
+
+def _can_edit_ticket(user):
+    if user.is_staff:
+        return True
+    if not user.is_authenticated:
+        return False
+    return Q(locked=False, authored_by=user.pk)
+
+
+def _is_staff(user):
+    return user.is_staff
+
+
+TICKET_FILTERS = {
+    "bugz.can_comment_ticket": _can_comment_ticket,
+    "bugz.can_edit_ticket": _can_edit_ticket,
+    "bugz.can_lock_ticket": _is_staff,
+    "bugz.can_delete_ticket": _is_staff,
+}
+
+
+def ticket_filter(permission: str, user):
+    """The tickets user has permission on, as a Q, or True or False."""
+    if user.is_active and user.is_superuser:
+        # Like User.has_perm.
+        return True
+    return TICKET_FILTERS[permission](user)
+
+
+def filter_tickets(qs, permission: str, user):
+    """Restrict a queryset of tickets to those user has permission on."""
+    q = ticket_filter(permission, user)
+    if q is True:
+        return qs
+    if q is False:
+        return qs.none()
+    return qs.filter(q)
+
+
+def annotate_tickets(qs, user, **permissions):
+    """Annotate tickets with whether user has each of permissions, given as
+    annotation names to permission names."""
+    annotations = {}
+    for name, permission in permissions.items():
+        q = ticket_filter(permission, user)
+        if isinstance(q, bool):
+            annotations[name] = Value(q, output_field=BooleanField())
+        else:
+            annotations[name] = ExpressionWrapper(q, BooleanField())
+    return qs.annotate(**annotations)
+
+
+def has_perm(request, permission: str, obj=None) -> bool:
+    """request.user.has_perm, memoized for the request.
+
+    Objects are told apart by type and primary key, so do not check an
+    object again after changing it in the same request."""
+    memo = request.__dict__.setdefault("_bugz_perms", {})
+    key = (permission, type(obj), getattr(obj, "pk", obj))
+    if key not in memo:
+        memo[key] = request.user.has_perm(permission, obj)
+    return memo[key]
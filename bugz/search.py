@@ -0,0 +1,275 @@
+"""
+Full-text search over ticket titles, descriptions and comments.
+
+Each ticket is indexed as a single document, refreshed whenever the ticket or
+its comments change. The storage depends on the database: an FTS5 virtual
+table on SQLite, a ``tsvector`` column with a GIN index on PostgreSQL. Other
+databases fall back to ``icontains`` lookups.
+"""
+
+import functools
+from typing import Iterable, Sequence, Tuple
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from bugz import appsettings, models
+
+# A search term and whether it is negated.
+Term = Tuple[str, bool]
+
+
+def _ticket_comments(pks):
+    """Map each ticket pk to the concatenation of its comments."""
+    comments = {pk: [] for pk in pks}
+    updates = (
+        models.TicketUpdate.objects.filter(ticket_id__in=pks)
+        .exclude(comment="")
+        .order_by("authored_on")
+        .values_list("ticket_id", "comment")
+    )
+    for ticket_id, comment in updates:
+        comments[ticket_id].append(comment)
+    return {pk: "\n\n".join(texts) for pk, texts in comments.items()}
+
+
+def _ticket_id_column(connection):
+    """The outer ticket id column, for correlated subqueries."""
+    quote = connection.ops.quote_name
+    return f"{quote(models.Ticket._meta.db_table)}.{quote('id')}"
+
+
+class SearchBackend:
+    """Base class for search backends.
+
+    Backends that maintain an index implement ``index_tickets``,
+    ``remove_tickets`` and ``clear``, as well as ``matching`` and ``rank``
+    which return SQL for the tickets matching all of the given terms and
+    their relevance."""
+
+    # Whether there is an index to maintain at all.
+    indexed = True
+
+    def __init__(self, using="default"):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def index_ticket(self, ticket: models.Ticket):
+        self.index_tickets([ticket])
+
+    def index_tickets(self, tickets: Sequence[models.Ticket]):
+        raise NotImplementedError
+
+    def remove_tickets(self, pks: Iterable[int]):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def matching(self, terms: Sequence[str]) -> RawSQL:
+        raise NotImplementedError
+
+    def rank(self, terms: Sequence[str]) -> RawSQL:
+        """A per-ticket relevance expression, higher is better."""
+        raise NotImplementedError
+
+    def filter(self, qs, terms: Sequence[Term]):
+        """Restrict qs to tickets matching terms, most relevant first."""
+        include = [term for term, negated in terms if not negated]
+        for term, negated in terms:
+            if negated:
+                qs = qs.exclude(pk__in=self.matching([term]))
+        if include:
+            qs = (
+                qs.filter(pk__in=self.matching(include))
+                .annotate(search_rank=self.rank(include))
+                .order_by(
+                    "-search_rank",
+                    *(qs.query.order_by or qs.model._meta.ordering),
+                )
+            )
+        return qs
+
+
+class SimpleSearchBackend(SearchBackend):
+    """Unindexed fallback using ``icontains``, slow on large tables."""
+
+    indexed = False
+
+    def index_tickets(self, tickets):
+        pass
+
+    def remove_tickets(self, pks):
+        pass
+
+    def clear(self):
+        pass
+
+    def filter(self, qs, terms):
+        for term, negated in terms:
+            comments = models.TicketUpdate.objects.filter(
+                comment__icontains=term
+            ).values("ticket_id")
+            q = (
+                Q(title__icontains=term)
+                | Q(description__icontains=term)
+                | Q(pk__in=comments)
+            )
+            qs = qs.exclude(q) if negated else qs.filter(q)
+        return qs
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """SQLite FTS5 index, ranked with bm25."""
+
+    table = "bugz_search_fts"
+    # bm25 column weights for title, description and comments.
+    weights = (10.0, 4.0, 1.0)
+
+    @staticmethod
+    def to_query(terms):
+        # Quoting every term as a phrase disables the FTS5 query syntax, so
+        # user input cannot produce invalid queries.
+        return " ".join('"{}"'.format(t.replace('"', '""')) for t in terms)
+
+    def index_tickets(self, tickets):
+        if not tickets:
+            return
+        comments = _ticket_comments([t.pk for t in tickets])
+        with self.connection.cursor() as cursor:
+            self._delete(cursor, [t.pk for t in tickets])
+            cursor.executemany(
+                f"INSERT INTO {self.table} "
+                f"(rowid, title, description, comments) "
+                f"VALUES (%s, %s, %s, %s)",
+                [
+                    (t.pk, t.title, t.description, comments[t.pk])
+                    for t in tickets
+                ],
+            )
+
+    def _delete(self, cursor, pks):
+        cursor.executemany(
+            f"DELETE FROM {self.table} WHERE rowid = %s",
+            [(pk,) for pk in pks],
+        )
+
+    def remove_tickets(self, pks):
+        with self.connection.cursor() as cursor:
+            self._delete(cursor, list(pks))
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+
+    def matching(self, terms):
+        return RawSQL(
+            f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s",
+            (self.to_query(terms),),
+        )
+
+    def rank(self, terms):
+        weights = ", ".join(str(w) for w in self.weights)
+        ticket_id = _ticket_id_column(self.connection)
+        return RawSQL(
+            f"SELECT -bm25({self.table}, {weights}) FROM {self.table} "
+            f"WHERE {self.table} MATCH %s AND rowid = {ticket_id}",
+            (self.to_query(terms),),
+        )
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """PostgreSQL tsvector index, ranked with ts_rank."""
+
+    table = "bugz_search_document"
+    config = "simple"
+
+    def tsquery(self, terms):
+        sql = " && ".join(
+            f"phraseto_tsquery('{self.config}', %s)" for _ in terms
+        )
+        return sql, tuple(terms)
+
+    def index_tickets(self, tickets):
+        if not tickets:
+            return
+        comments = _ticket_comments([t.pk for t in tickets])
+        vector = " || ".join(
+            f"setweight(to_tsvector('{self.config}', %s), '{weight}')"
+            for weight in "ABC"
+        )
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (ticket_id, document) "
+                f"VALUES (%s, {vector}) ON CONFLICT (ticket_id) "
+                f"DO UPDATE SET document = EXCLUDED.document",
+                [
+                    (t.pk, t.title, t.description, comments[t.pk])
+                    for t in tickets
+                ],
+            )
+
+    def remove_tickets(self, pks):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {self.table} WHERE ticket_id = ANY(%s)",
+                (list(pks),),
+            )
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {self.table}")
+
+    def matching(self, terms):
+        sql, params = self.tsquery(terms)
+        return RawSQL(
+            f"SELECT ticket_id FROM {self.table} WHERE document @@ ({sql})",
+            params,
+        )
+
+    def rank(self, terms):
+        sql, params = self.tsquery(terms)
+        ticket_id = _ticket_id_column(self.connection)
+        return RawSQL(
+            f"SELECT ts_rank(document, {sql}) FROM {self.table} "
+            f"WHERE ticket_id = {ticket_id}",
+            params,
+        )
+
+
+VENDOR_BACKENDS = {
+    "sqlite": SQLiteSearchBackend,
+    "postgresql": PostgreSQLSearchBackend,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(using="default") -> SearchBackend:
+    """Return the search backend for a database alias.
+
+    Uses the ``BUGZ_SEARCH_BACKEND`` dotted path if set, otherwise picks the
+    best backend for the database vendor."""
+    path = appsettings.SEARCH_BACKEND
+    if path:
+        backend_class = import_string(path)
+    else:
+        vendor = connections[using].vendor
+        backend_class = VENDOR_BACKENDS.get(vendor, SimpleSearchBackend)
+    return backend_class(using=using)
+
+
+def index_ticket(ticket: models.Ticket):
+    """Refresh the search document of a ticket."""
+    get_backend(ticket._state.db or "default").index_ticket(ticket)
+
+
+def remove_deleted_ticket(sender, instance, using, **kwargs):
+    """Drop the search document of a deleted ticket, a post_delete receiver.
+
+    It runs in the transaction of the deletion, and is rolled back with it."""
+    get_backend(using).remove_tickets([instance.pk])
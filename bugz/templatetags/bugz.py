@@ -1,17 +1,35 @@
 import hashlib
 import urllib.parse
 
-import bleach
-import markdown as markdown_
 from django import template
 from django.conf import settings
 from django.template import TemplateSyntaxError
 from django.urls import reverse
 from django.utils.html import mark_safe
 
+from bugz import instrumentation, markup, rules
+
 register = template.Library()
 
 
+def inclusion_tag(filename):
+    """register.inclusion_tag, timing the rendering of the tag."""
+
+    def decorator(func):
+        register.inclusion_tag(filename)(func)
+        compile_function = register.tags[func.__name__]
+
+        def compile(parser, token):
+            node = compile_function(parser, token)
+            node.render = instrumentation.timed("tags", "tags")(node.render)
+            return node
+
+        register.tags[func.__name__] = compile
+        return func
+
+    return decorator
+
+
 @register.filter
 def hashed_color(stringable):
     h = hashlib.md5(f"{settings.SECRET_KEY}{stringable}".encode()).digest()
@@ -21,18 +39,7 @@ def hashed_color(stringable):
 
 @register.filter
 def markdown(md: str):
-    allowed_tags = bleach.ALLOWED_TAGS + [
-        "p",
-        "table",
-        "thead",
-        "tbody",
-        "tr",
-        "th",
-        "td",
-    ]
-    x = markdown_.markdown(md, extensions=["tables"], output_format="html5")
-    y = bleach.clean(x, tags=allowed_tags)
-    return mark_safe(y)
+    return mark_safe(markup.render(md))
 
 
 @register.simple_tag
@@ -45,22 +52,36 @@ def search_url(*kv):
     return reverse("bugz:home") + "?" + urllib.parse.urlencode({"q": q})
 
 
-@register.inclusion_tag("bugz/stub-assignee.html")
+@register.simple_tag(takes_context=True)
+def cursor_url(context, cursor):
+    """The current URL, moved to another page of results."""
+    params = context["request"].GET.copy()
+    params["cursor"] = cursor
+    return "?" + params.urlencode()
+
+
+@register.simple_tag(takes_context=True)
+def has_perm(context, permission, obj=None):
+    """Whether the user has permission on obj, memoized for the request."""
+    return rules.has_perm(context["request"], permission, obj)
+
+
+@inclusion_tag("bugz/stub-assignee.html")
 def show_assignee(assignee):
     return {"assignee": assignee}
 
 
-@register.inclusion_tag("bugz/stub-author.html")
+@inclusion_tag("bugz/stub-author.html")
 def show_author(author):
     return {"author": author}
 
 
-@register.inclusion_tag("bugz/stub-labels.html")
+@inclusion_tag("bugz/stub-labels.html")
 def show_labels(labels):
     return {"labels": labels}
 
 
-@register.inclusion_tag("bugz/stub-tickets.html")
+@inclusion_tag("bugz/stub-tickets.html")
 def show_tickets(tickets):
     from bugz.models import Ticket
 
@@ -7,11 +7,21 @@ app_name = "bugz"
 urlpatterns = [
     path("", views.ListTicketView.as_view(), name="home"),
     path("new", views.CreateTicketView.as_view(), name="new"),
+    path("bulk", views.BulkUpdateTicketView.as_view(), name="bulk"),
     path("ticket/<int:pk>", views.DetailTicketView.as_view(), name="ticket"),
+    path("ticket/<int:pk>/log", views.TicketLogView.as_view(), name="log"),
     path(
         "ticket/<int:pk>/comment",
         views.CommentTicketView.as_view(),
         name="comment",
     ),
+    path("report", views.ReportView.as_view(), name="report"),
+    path("stats", views.StatsView.as_view(), name="stats"),
     path("js/labels", views.JSLabelView.as_view(), name="js.labels"),
+    path("api/tickets", views.APITicketListView.as_view(), name="api.tickets"),
+    path(
+        "api/ticket/<int:pk>/log",
+        views.APITicketLogView.as_view(),
+        name="api.log",
+    ),
 ]
@@ -1,24 +1,79 @@
+import datetime
+import functools
+import hashlib
 import json
-
-from django.http import JsonResponse, HttpResponse
-from django.shortcuts import redirect, get_object_or_404
+from typing import Optional
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.http import (
+    Http404,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.shortcuts import aget_object_or_404, redirect, get_object_or_404
+from django.db.models import (
+    aprefetch_related_objects,
+    prefetch_related_objects,
+)
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import (
+    http_date,
+    quote_etag,
+    url_has_allowed_host_and_scheme,
+)
 from django.views import View
 from django.views.decorators.csrf import requires_csrf_token
-from django.views.generic import ListView, CreateView, DetailView
+from django.views.generic import (
+    CreateView,
+    DetailView,
+    FormView,
+    ListView,
+    TemplateView,
+)
 from django.views.generic.edit import (
     BaseUpdateView,
     FormMixin,
     UpdateView,
 )
-from rules.contrib.views import PermissionRequiredMixin
+from rules.contrib.views import (
+    PermissionRequiredMixin as BasePermissionRequiredMixin,
+)
+
+from bugz import (
+    api,
+    appsettings,
+    catalog,
+    fragments,
+    instrumentation,
+    live,
+    models,
+    forms,
+    pagination,
+    rollups,
+    rules,
+    search,
+)
+
 
-from bugz import models, forms
+class PermissionRequiredMixin(BasePermissionRequiredMixin):
+    def has_permission(self):
+        # Memoized, so templates checking the same permissions again are
+        # free.
+        obj = self.get_permission_object()
+        return all(
+            rules.has_perm(self.request, permission, obj)
+            for permission in self.get_permission_required()
+        )
 
 
 class ListTicketView(FormMixin, ListView):
     template_name = "bugz/ticket-list.html"
     context_object_name = "tickets"
     form_class = forms.SearchForm
+    cursor_kwarg = "cursor"
 
     def get(self, request, *args, **kwargs):
         self.form = self.get_form()
@@ -30,15 +85,45 @@ class ListTicketView(FormMixin, ListView):
             "initial": self.get_initial(),
             "prefix": self.get_prefix(),
             "data": self.request.GET,
+            "user": self.request.user,
         }
         return kwargs
 
     def get_queryset(self):
-        qs = models.Ticket.objects.select_related(
-            "assignee", "dupe_of"
-        ).prefetch_related("blocked_by", "labels")
+        # Labels are only fetched for rows missing from the cache.
+        qs = models.Ticket.objects.select_related("assignee", "authored_by")
+        if self.request.user.is_authenticated:
+            # Whether a row can be selected for bulk edits, in the same
+            # query.
+            qs = rules.annotate_tickets(
+                qs, self.request.user, can_edit="bugz.can_edit_ticket"
+            )
         return self.form.apply_qs(qs)
 
+    def get_paginate_by(self, queryset):
+        return appsettings.TICKETS_PER_PAGE
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = pagination.KeysetPaginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except pagination.InvalidCursor as e:
+            raise Http404(str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        tickets = context["object_list"]
+        context["ticket_rows"] = list(
+            zip(tickets, self.get_ticket_rows(tickets))
+        )
+        if self.request.user.is_authenticated:
+            context["bulk_form"] = forms.BulkUpdateForm()
+        return context
+
+    def get_ticket_rows(self, tickets):
+        return fragments.render_ticket_rows(tickets)
+
 
 class CreateLabelView(PermissionRequiredMixin, CreateView):
     model = models.Label
@@ -52,8 +137,131 @@ class CreateTicketView(PermissionRequiredMixin, CreateView):
     fields = ("title", "description")
     permission_required = "bugz.can_create_ticket"
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        search.index_ticket(self.object)
+        rollups.record_created(self.object)
+        return response
 
-class DetailTicketView(FormMixin, DetailView):
+
+class ReportView(PermissionRequiredMixin, TemplateView):
+    """Burndown, time to close and throughput, from rollups only."""
+
+    template_name = "bugz/report.html"
+    permission_required = "bugz.can_view_reports"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form = forms.ReportForm(self.request.GET)
+        context["form"] = form
+        if form.is_valid():
+            context["report"] = rollups.report(**form.cleaned_data)
+        return context
+
+
+class StatsView(PermissionRequiredMixin, TemplateView):
+    """Percentiles of the requests instrumented by this process."""
+
+    template_name = "bugz/stats.html"
+    permission_required = "bugz.can_view_stats"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["views"] = instrumentation.summary()
+        return context
+
+
+class TicketLogMixin:
+    """Shows a window of the ticket timeline, with a link to older events."""
+
+    before_kwarg = "before"
+
+    def get_log_context(self, before=None):
+        try:
+            window = models.get_ticket_log_window(
+                self.object, appsettings.LOG_WINDOW_SIZE, before=before
+            )
+        except pagination.InvalidCursor as e:
+            raise Http404(str(e))
+        return self._log_context(window)
+
+    async def aget_log_context(self, before=None):
+        try:
+            window = await models.aget_ticket_log_window(
+                self.object, appsettings.LOG_WINDOW_SIZE, before=before
+            )
+        except pagination.InvalidCursor as e:
+            raise Http404(str(e))
+        return self._log_context(window)
+
+    def _log_context(self, window):
+        older_log_url = None
+        if window.older_cursor:
+            older_log_url = (
+                reverse("bugz:log", args=[self.object.pk])
+                + "?"
+                + urlencode({self.before_kwarg: window.older_cursor})
+            )
+        return {
+            "log": window.events,
+            "older_log_url": older_log_url,
+            "newest_row": window.newest_row,
+        }
+
+
+class ConditionalGetMixin:
+    """Answer conditional GET requests before building the response.
+
+    Responses must be revalidated on every use, so clients always see the
+    latest version, at the cost of a 304 when they already have it."""
+
+    def get_etag(self) -> Optional[str]:
+        return None
+
+    def get_last_modified(self) -> Optional[datetime.datetime]:
+        return None
+
+    def _validators(self):
+        etag = self.get_etag()
+        if etag is not None:
+            etag = quote_etag(etag)
+        last_modified = self.get_last_modified()
+        if last_modified is not None:
+            last_modified = int(last_modified.timestamp())
+        return etag, last_modified
+
+    def conditional_response(self, render):
+        """The response returned by render, or a 304 if the client has it."""
+        etag, last_modified = self._validators()
+        response = get_conditional_response(
+            self.request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = render()
+        return self._patch_validators(response, etag, last_modified)
+
+    async def aconditional_response(self, render):
+        """Async version of conditional_response, for an async render."""
+        etag, last_modified = self._validators()
+        response = get_conditional_response(
+            self.request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = await render()
+        return self._patch_validators(response, etag, last_modified)
+
+    def _patch_validators(self, response, etag, last_modified):
+        if etag is not None:
+            response.headers["ETag"] = etag
+        if last_modified is not None:
+            response.headers["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class DetailTicketView(
+    ConditionalGetMixin, TicketLogMixin, FormMixin, DetailView
+):
     template_name = "bugz/ticket-detail.html"
     model = models.Ticket
     form_class = forms.CommentForm
@@ -62,17 +270,99 @@ class DetailTicketView(FormMixin, DetailView):
         return (
             super()
             .get_queryset()
-            .prefetch_related('labels', 'blocked_by')
-            .select_related('assignee', 'dupe_of')
+            .select_related('assignee', 'authored_by', 'dupe_of', 'canonical')
+        )
+
+    def get_etag(self):
+        # The page shows the user and what they may do, and embeds a CSRF
+        # token derived from the CSRF cookie. Last-Modified cannot account
+        # for either, nor for label renames, so only the ETag is sent.
+        # Permissions depend on the ticket, covered by its cache version,
+        # and on these flags, which are read without a query.
+        user = self.request.user
+        csrf = hashlib.md5(
+            self.request.META.get("CSRF_COOKIE", "").encode()
+        ).hexdigest()[:8]
+        flags = "".join(
+            str(int(bool(getattr(user, flag, False))))
+            for flag in ("is_active", "is_staff", "is_superuser")
+        )
+        return "-".join(
+            [
+                str(self.object.pk),
+                str(self.object.cache_version),
+                str(user.pk or 0),
+                flags,
+                csrf,
+            ]
+        )
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+
+        def render():
+            prefetch_related_objects([self.object], "labels", "blocked_by")
+            context = self.get_context_data(object=self.object)
+            return self.render_to_response(context)
+
+        return self.conditional_response(render)
+
+    def get_context_data(self, **kwargs):
+        return {
+            **super().get_context_data(**kwargs),
+            **self.get_log_context(),
+            "comment_count": self.object.comment_count,
+            # Set on canonical tickets only.
+            "duplicates": models.Ticket.objects.filter(
+                canonical=self.object
+            ).only("pk"),
+        }
+
+
+class APITicketListView(View):
+    """Tickets matching the filters of the ticket list, in JSON."""
+
+    def get(self, request, *args, **kwargs):
+        form = forms.SearchForm(request.GET, user=request.user)
+        if not form.is_valid():
+            return JsonResponse(form.errors, status=400)
+        tickets = api.api_tickets(form.apply_qs(models.Ticket.objects.all()))
+        return StreamingHttpResponse(
+            api.stream_json_array(map(api.ticket_json, tickets)),
+            content_type="application/json",
         )
 
+
+class APITicketLogView(View):
+    """The timeline of a ticket in JSON, oldest event first."""
+
+    def get(self, request, *args, **kwargs):
+        ticket = get_object_or_404(
+            models.Ticket.objects.select_related("authored_by"),
+            pk=kwargs["pk"],
+        )
+        events = models.build_ticket_log(
+            ticket, oldest_first=True, chunk_size=api.CHUNK_SIZE
+        )
+        return StreamingHttpResponse(
+            api.stream_json_array(map(api.event_json, events)),
+            content_type="application/json",
+        )
+
+
+class TicketLogView(TicketLogMixin, DetailView):
+    """A fragment of the timeline, for the "load older events" link."""
+
+    template_name = "bugz/stub-log.html"
+    model = models.Ticket
+
     def get_context_data(self, **kwargs):
-        log = list(models.build_ticket_log(self.object))[::-1]
+        before = self.request.GET.get(self.before_kwarg)
+        if not before:
+            raise Http404("Missing cursor.")
         return {
             **super().get_context_data(**kwargs),
-            # Minus one because the description is a fake comment.
-            "comment_count": sum(1 for l in log if l.field == "comment") - 1,
-            "log": log,
+            **self.get_log_context(before),
         }
 
 
@@ -98,38 +388,110 @@ class CommentTicketView(PermissionRequiredMixin, BaseUpdateView):
 
 class UpdateTicketView(PermissionRequiredMixin, UpdateView):
     model = models.Ticket
-    fields = (
-        "title",
-        "description",
-        "open",
-        "assignee",
-        "blocked_by",
-        "dupe_of",
-        "labels",
-        "locked",
-    )
+    form_class = forms.TicketForm
+    permission_required = "bugz.can_edit_ticket"
 
+    def form_valid(self, form):
+        data = form.cleaned_data
+        try:
+            models.save_ticket_update(
+                form.instance,
+                self.request.user,
+                blocked_by=data["blocked_by"],
+                labels=data["labels"],
+                version=data["version"],
+            )
+        except models.TicketConflict:
+            form.add_error("version", forms.CONFLICT_MESSAGE)
+            response = self.form_invalid(form)
+            response.status_code = 409
+            return response
+        return redirect(form.instance.get_absolute_url())
+
+
+class BulkUpdateTicketView(FormView):
+    """Apply an action to the tickets selected in the ticket list."""
+
+    form_class = forms.BulkUpdateForm
+    http_method_names = ["post"]
 
-class JsonBodyMixin:
-    def dispatch(self, request, *args, **kwargs):
-        if request.method == "POST":
-            self.request_json = self.get_request_json()
+    def form_valid(self, form):
+        user = self.request.user
+        permission = form.get_permission()
+        tickets = form.cleaned_data["tickets"]
+        permitted = rules.filter_tickets(tickets, permission, user)
+        if permitted.count() != len(tickets):
+            raise PermissionDenied
+        try:
+            models.bulk_update_tickets(tickets, user, **form.get_changes())
+        except ValidationError as e:
+            form.add_error(None, e)
+            return self.form_invalid(form)
+        return redirect(self.get_success_url())
 
-        return super().dispatch(request, *args, **kwargs)
+    def form_invalid(self, form):
+        return JsonResponse(form.errors, status=400)
+
+    def get_success_url(self):
+        url = self.request.POST.get("next")
+        if url and url_has_allowed_host_and_scheme(
+            url,
+            allowed_hosts={self.request.get_host()},
+            require_https=self.request.is_secure(),
+        ):
+            return url
+        return reverse("bugz:home")
 
-    def get_request_json(self):
+
+class JsonBodyMixin:
+    @functools.cached_property
+    def request_json(self):
         try:
             return json.loads(self.request.body.decode())
-        except:
+        except (ValueError, UnicodeDecodeError):
             return None
 
 
-class JSLabelView(JsonBodyMixin, PermissionRequiredMixin, View):
+# Upper bound of the ?limit= of label typeahead requests.
+MAX_LABEL_TYPEAHEAD_LIMIT = 100
+
+
+class JSLabelView(
+    ConditionalGetMixin, JsonBodyMixin, PermissionRequiredMixin, View
+):
     def get_permission_required(self):
         if self.request.method == "GET":
-            return "bugz.can_list_labels"
+            return ("bugz.can_list_labels",)
         else:
-            return "bugz.can_edit_ticket"
+            return ("bugz.can_edit_ticket",)
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method == "POST":
+            errors = self.get_body_errors()
+            if errors:
+                return JsonResponse(errors, status=400)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_body_errors(self):
+        """Errors of the body of a POST, checked before permissions, which
+        need its ticket."""
+        data = self.request_json
+        if not isinstance(data, dict):
+            return {"__all__": "Not a JSON object."}
+
+        def is_int(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        errors = {}
+        if not is_int(data.get("ticket")):
+            errors["ticket"] = "Not an integer."
+        labels = data.get("labels")
+        if not isinstance(labels, list) or not all(map(is_int, labels)):
+            errors["labels"] = "Not a list of integers."
+        version = data.get("version")
+        if version is not None and not is_int(version):
+            errors["version"] = "Not an integer."
+        return errors
 
     def get_permission_object(self):
         if self.request.method == "POST":
@@ -139,16 +501,216 @@ class JSLabelView(JsonBodyMixin, PermissionRequiredMixin, View):
         pk = self.request_json["ticket"]
         return get_object_or_404(models.Ticket, pk=pk)
 
+    def get_catalog(self):
+        if not hasattr(self, "_catalog"):
+            self._catalog = catalog.get_catalog()
+        return self._catalog
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.GET.get("limit", ""))
+        except ValueError:
+            limit = appsettings.LABEL_TYPEAHEAD_LIMIT
+        return max(1, min(limit, MAX_LABEL_TYPEAHEAD_LIMIT))
+
+    def get_labels(self):
+        """Labels matching ?q=, or given by ?pk=, or all of them."""
+        if not hasattr(self, "_labels"):
+            labels = self.get_catalog()
+            if "q" in self.request.GET:
+                self._labels = labels.search(
+                    self.request.GET["q"], self.get_limit()
+                )
+            elif "pk" in self.request.GET:
+                pks = self.request.GET.getlist("pk")
+                self._labels = [
+                    labels.by_pk[int(pk)]
+                    for pk in pks
+                    if pk.isdigit() and int(pk) in labels.by_pk
+                ]
+            else:
+                self._labels = labels.by_name
+        return self._labels
+
+    def get_etag(self):
+        # Responses are cheap to compute from the catalog, but not to send.
+        labels = json.dumps(self.get_labels(), separators=(",", ":"))
+        return hashlib.md5(labels.encode()).hexdigest()
+
+    def get_last_modified(self):
+        if not self.request.GET:
+            # Typeahead results also depend on usage, which has no date.
+            return self.get_catalog().version[1]
+
     def get(self, request, *args, **kwargs):
-        labels = [
-            dict(pk=label.pk, name=label.name, color=label.color)
-            for label in models.Label.objects.all()
-        ]
-        return JsonResponse(labels, safe=False)
+        def render():
+            labels = [
+                dict(
+                    pk=label.pk,
+                    name=label.name,
+                    color=label.color,
+                    usage=label.usage,
+                )
+                for label in self.get_labels()
+            ]
+            return JsonResponse(labels, safe=False)
+
+        return self.conditional_response(render)
 
     def post(self, request, *args, **kwargs):
         ticket = self.get_object()
-        models.save_ticket_update(
-            ticket, self.request.user, labels=self.request_json["labels"]
+        try:
+            models.save_ticket_update(
+                ticket,
+                self.request.user,
+                labels=self.request_json["labels"],
+                version=self.request_json.get("version"),
+            )
+        except models.TicketConflict as e:
+            # The client can merge its change into the current labels, and
+            # retry against the current version.
+            labels = ticket.labels.order_by().values_list("pk", flat=True)
+            return JsonResponse(
+                {"version": e.version, "labels": sorted(labels)}, status=409
+            )
+        return JsonResponse({"version": ticket.version})
+
+
+# Async variants of the busiest views, for ASGI deployments, see
+# bugz.async_urls. They read through the async ORM, so slow clients do not
+# hold a thread each. Writes still run in a thread, since the async ORM
+# cannot open transactions, and so do templates, which may query lazily.
+
+
+class AsyncUserMixin:
+    """Load the user before dispatching to async handlers.
+
+    The lazy request.user cannot query the database from the event loop."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncPermissionRequiredMixin(PermissionRequiredMixin):
+    """PermissionRequiredMixin for async handlers.
+
+    Rules are sync and may query the database, they are checked in a
+    thread."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        if not await sync_to_async(self.has_permission)():
+            return self.handle_no_permission()
+        # Not super(), which would check permissions again, synchronously.
+        return await View.dispatch(self, request, *args, **kwargs)
+
+
+class AsyncListTicketView(AsyncUserMixin, ListTicketView):
+    async def get(self, request, *args, **kwargs):
+        self.form = self.get_form()
+        self.form.is_valid()
+        self.object_list = self.get_queryset()
+        paginator = pagination.KeysetPaginator(
+            self.object_list, self.get_paginate_by(self.object_list)
+        )
+        try:
+            page = await paginator.apage(request.GET.get(self.cursor_kwarg))
+        except pagination.InvalidCursor as e:
+            raise Http404(str(e))
+        self.pagination = (
+            paginator,
+            page,
+            page.object_list,
+            page.has_other_pages(),
+        )
+        self.ticket_rows = await fragments.arender_ticket_rows(
+            page.object_list
+        )
+        return self.render_to_response(self.get_context_data())
+
+    def paginate_queryset(self, queryset, page_size):
+        # Fetched by get.
+        return self.pagination
+
+    def get_ticket_rows(self, tickets):
+        return self.ticket_rows
+
+
+class AsyncDetailTicketView(AsyncUserMixin, DetailTicketView):
+    async def get(self, request, *args, **kwargs):
+        self.object = await aget_object_or_404(
+            self.get_queryset(), pk=self.kwargs[self.pk_url_kwarg]
+        )
+
+        async def render():
+            await aprefetch_related_objects(
+                [self.object], "labels", "blocked_by"
+            )
+            self.log_context = await self.aget_log_context()
+            context = self.get_context_data(object=self.object)
+            return self.render_to_response(context)
+
+        return await self.aconditional_response(render)
+
+    def get_log_context(self, before=None):
+        # Fetched by get.
+        return self.log_context
+
+    def get_context_data(self, **kwargs):
+        live_url = reverse("bugz:live", args=[self.object.pk])
+        newest_row = self.log_context["newest_row"]
+        if newest_row is not None:
+            live_url += "?" + urlencode({"after": newest_row})
+        return {**super().get_context_data(**kwargs), "live_url": live_url}
+
+
+class AsyncCommentTicketView(AsyncPermissionRequiredMixin, CommentTicketView):
+    async def post(self, request, *args, **kwargs):
+        self.object = await aget_object_or_404(
+            models.Ticket, pk=self.kwargs[self.pk_url_kwarg]
+        )
+        form = self.get_form()
+        if not form.is_valid():
+            return self.form_invalid(form)
+        return await sync_to_async(self.form_valid)(form)
+
+
+class AsyncJSLabelView(AsyncPermissionRequiredMixin, JSLabelView):
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method == "POST":
+            errors = self.get_body_errors()
+            if errors:
+                return JsonResponse(errors, status=400)
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        self._catalog = await catalog.aget_catalog()
+        return super().get(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        return await sync_to_async(super().post)(request, *args, **kwargs)
+
+
+class LiveTicketView(View):
+    """Server-Sent Events of new events of a ticket timeline, see bugz.live.
+
+    Only served by bugz.async_urls: under WSGI, each stream would hold a
+    thread for as long as it is open."""
+
+    async def get(self, request, *args, **kwargs):
+        ticket = await aget_object_or_404(models.Ticket, pk=kwargs["pk"])
+        # Set by browsers reconnecting to the stream.
+        after = request.headers.get("Last-Event-ID") or request.GET.get(
+            "after"
+        )
+        response = StreamingHttpResponse(
+            live.stream_ticket(
+                ticket, int(after) if after and after.isdigit() else None
+            ),
+            content_type="text/event-stream",
         )
-        return HttpResponse(status=204)
+        patch_cache_control(response, no_cache=True)
+        # Tells nginx not to buffer the stream.
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
@@ -15,20 +15,24 @@ setup(
     description="A standalone Django issue tracking app.",
     long_description=long_description,
     long_description_content_type="text/markdown",
-    python_requires='>=3.8',
+    python_requires='>=3.10',
     package_data={'bugz': ['static/bugz/*', 'templates/bugz/*']},
     install_requires=[
         "bleach>=3",  # HTML sanitizer
         "rules>=2",  # Permission management
-        "django>=2",
+        "django>=5.0",  # Async ORM and views
         "markdown>=3",
+        "pyparsing>=3",  # Search query language
     ],
     classifiers=[
         'Environment :: Web Environment',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Framework :: Django',
+        'Framework :: Django :: 5.0',
         'Intended Audience :: Developers',
         'Topic :: Internet :: WWW/HTTP',
     ],
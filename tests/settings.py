@@ -23,7 +23,7 @@ AUTHENTICATION_BACKENDS = [
     "django.contrib.auth.backends.ModelBackend",
 ]
 
-ROOT_URLCONF = "bugz.urls"
+ROOT_URLCONF = "tests.urls"
 
 SECRET_KEY = "dummy-key"
 
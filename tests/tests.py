@@ -1,9 +1,43 @@
+import datetime
+import gzip
+import io
 import json
+import os
+import tempfile
+from unittest import mock
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
-from bugz import models
+from bugz import (
+    catalog,
+    duplicates,
+    forms,
+    fragments,
+    graph,
+    instrumentation,
+    live,
+    markup,
+    models,
+    pagination,
+    rollups,
+    rules,
+    search,
+    views,
+)
+from bugz.management.commands import bugz_export
+
+# Well-formed cursors with values that do not fit a ticket ordering.
+CRAFTED_CURSORS = [
+    pagination.encode_cursor(values, True)
+    for values in ([1], [5, 1], [None, 1], [True, 1], [{"a": 1}, 1])
+]
 
 
 class BugzTestCase(TestCase):
@@ -41,6 +75,175 @@ class BugzTestCase(TestCase):
         self.assertSetEqual(set(self.t1.labels.all()), {self.l1, self.l2})
         self.assertSetEqual(set(self.t1.blocked_by.all()), {self.t2})
 
+    def test_update_snapshot(self):
+        ticket = models.Ticket.objects.prefetch_related("labels").get(
+            pk=self.t1.pk
+        )
+        stale = models.Ticket.objects.get(pk=self.t1.pk)
+        ticket.locked = True
+        # The ticket, its update, events and changes, within a savepoint.
+        with self.assertNumQueries(6):
+            models.save_ticket_update(ticket, self.u1)
+        # And the new label, and rollups of the ticket buckets.
+        with self.assertNumQueries(8):
+            update = models.save_ticket_update(
+                ticket, self.u1, labels=[self.l1]
+            )
+        self.assertDictEqual(json.loads(update.old_value), {"labels": []})
+
+        # Another instance loaded before those updates is stale, its diff is
+        # made against the database.
+        ticket.open = False
+        models.save_ticket_update(ticket, self.u1)
+        self.t1.assignee = self.u2
+        update = models.save_ticket_update(self.t1, self.u2, labels=[self.l2])
+        self.assertDictEqual(
+            json.loads(update.old_value),
+            {
+                "locked": True,
+                "open": False,
+                "assignee": None,
+                "labels": [self.l1.pk],
+            },
+        )
+
+    def test_blocker_graph(self):
+        t3, t4, t5 = (
+            models.Ticket.objects.create(title=title)
+            for title in ("third", "fourth", "fifth")
+        )
+        # t1 <- t2 <- t3 <- t4, t1 <- t5, where a <- b means b blocks a.
+        models.save_ticket_update(self.t1, self.u1, blocked_by=[self.t2, t5])
+        models.save_ticket_update(self.t2, self.u1, blocked_by=[t3])
+        models.save_ticket_update(t3, self.u1, blocked_by=[t4])
+        self.assertSetEqual(set(self.t2.blocking.all()), {self.t1})
+
+        for blockers in ([self.t1], [t3, self.t1], [self.t2]):
+            with self.assertRaises(ValidationError):
+                models.save_ticket_update(t4, self.u1, blocked_by=blockers)
+        self.assertFalse(t4.blocked_by.exists())
+        with self.assertRaises(ValidationError):
+            models.save_ticket_update(t5, self.u1, blocked_by=[t5])
+
+        self.assertSetEqual(
+            set(graph.transitive_blockers(self.t1)), {self.t2, t3, t4, t5}
+        )
+        self.assertSetEqual(
+            set(graph.transitive_dependents([t4, t5])),
+            {self.t1, self.t2, t3},
+        )
+        t4.open = False
+        models.save_ticket_update(t4, self.u1)
+        self.assertSetEqual(
+            set(graph.ready(models.Ticket.objects.all())), {t3, t5}
+        )
+        form = forms.SearchForm({"q": "is:ready"})
+        self.assertSetEqual(
+            set(form.apply_qs(models.Ticket.objects.all())), {t3, t5}
+        )
+
+        with self.assertNumQueries(2):
+            tree = graph.blocker_tree(self.t1)
+            walk = [(depth, ticket.pk) for depth, ticket in tree.walk()]
+        self.assertListEqual(
+            walk,
+            [
+                (0, self.t1.pk),
+                (1, self.t2.pk),
+                (2, t3.pk),
+                (3, t4.pk),
+                (1, t5.pk),
+            ],
+        )
+
+    def test_duplicates(self):
+        t3, t4 = (
+            models.Ticket.objects.create(title=title)
+            for title in ("third", "fourth")
+        )
+        # t4 -> t3 -> t2, where a -> b means a is a duplicate of b.
+        t3.dupe_of = self.t2
+        models.save_ticket_update(t3, self.u1)
+        t4.dupe_of = t3
+        models.save_ticket_update(t4, self.u1)
+        self.assertEqual(t4.canonical, self.t2)
+        self.assertSetEqual(set(duplicates.duplicates_of(t3)), {t3, t4})
+
+        self.t2.dupe_of = t4
+        with self.assertRaises(ValidationError):
+            models.save_ticket_update(self.t2, self.u1)
+        self.t2.refresh_from_db()
+        self.assertIsNone(self.t2.dupe_of)
+        with self.assertRaises(ValidationError):
+            duplicates.validate_dupe_of(self.t2, t4)
+
+        # Moving t3 moves its own duplicates along, in one write.
+        models.bulk_update_tickets([t3], self.u1, {"dupe_of": self.t1})
+        t4.refresh_from_db()
+        self.assertEqual(t4.canonical, self.t1)
+        self.assertSetEqual(
+            set(
+                forms.SearchForm({"q": f"dupe-of:{t4.pk}"}).apply_qs(
+                    models.Ticket.objects.all()
+                )
+            ),
+            {t3, t4},
+        )
+        t3.refresh_from_db()
+        t3.dupe_of = None
+        models.save_ticket_update(t3, self.u1)
+        t4.refresh_from_db()
+        self.assertIsNone(t3.canonical)
+        self.assertEqual(t4.canonical, t3)
+        self.assertFalse(duplicates.duplicates_of(self.t1).exists())
+
+    def test_version_conflict(self):
+        ticket = models.Ticket.objects.get(pk=self.t1.pk)
+        self.t1.open = False
+        models.save_ticket_update(self.t1, self.u1, version=0)
+        self.assertEqual(self.t1.version, 1)
+        ticket.title = "lost"
+        with self.assertRaises(models.TicketConflict) as cm:
+            models.save_ticket_update(ticket, self.u2, version=0)
+        self.assertEqual(cm.exception.version, 1)
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.title, "test title")
+        self.assertEqual(ticket.update_count, 1)
+
+        self.u1.is_superuser = True
+        self.u1.save()
+        self.client.force_login(self.u1)
+
+        def post(version):
+            data = {"ticket": self.t1.pk, "labels": [self.l1.pk]}
+            if version is not None:
+                data["version"] = version
+            return self.client.post(
+                "/js/labels", json.dumps(data), content_type="application/json"
+            )
+
+        response = post(0)
+        self.assertEqual(response.status_code, 409)
+        self.assertDictEqual(response.json(), {"version": 1, "labels": []})
+        response = post(1)
+        self.assertDictEqual(response.json(), {"version": 2})
+        # Clients not sending a version always win.
+        self.assertEqual(post(None).status_code, 200)
+
+        for body in (
+            "{",
+            b"\xff",
+            "[]",
+            json.dumps({"ticket": self.t1.pk}),
+            json.dumps({"ticket": self.t1.pk, "labels": [True]}),
+            json.dumps({"ticket": "x", "labels": []}),
+            json.dumps({"ticket": self.t1.pk, "labels": [], "version": "1"}),
+        ):
+            response = self.client.post(
+                "/js/labels", body, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 400, body)
+
     def test_event_log(self):
         self.t1.title = "title v2"
         models.save_ticket_update(self.t1, self.u1)
@@ -59,7 +262,8 @@ class BugzTestCase(TestCase):
         models.save_ticket_update(self.t1, self.u1, labels=[self.l1, self.l2])
         models.save_ticket_update(self.t1, self.u1, blocked_by=[self.t2])
         models.save_ticket_update(self.t1, self.u1, labels=[self.l2])
-        models.save_ticket_update(self.t1, self.u1, blocked_by=[self.t1])
+        t3 = models.Ticket.objects.create(title="third")
+        models.save_ticket_update(self.t1, self.u1, blocked_by=[t3])
 
         log = list(models.build_ticket_log(self.t1))[::-1]
         self.assertEqual(len(log), 11)
@@ -106,7 +310,7 @@ class BugzTestCase(TestCase):
 
         self.assertEqual(log[9].field, "blocked_by")
         self.assertEqual(log[9].old_value, None)
-        self.assertEqual(log[9].new_value, {self.t1})
+        self.assertEqual(log[9].new_value, {t3})
 
         self.assertEqual(log[10].field, "blocked_by")
         self.assertEqual(log[10].old_value, {self.t2})
@@ -122,3 +326,1069 @@ class BugzTestCase(TestCase):
         # Event #7 for label was silenced since the label doesn't exist.
         self.assertEqual(len(log), 10)
         self.assertEqual(log[8].field, "blocked_by")
+
+    def test_backfill_events(self):
+        self.t1.title = "title v2"
+        self.t1.assignee = self.u2
+        models.save_ticket_update(self.t1, self.u1, labels=[self.l1])
+        models.save_ticket_comment(self.t1, self.u2, "hello world")
+        models.save_ticket_update(
+            self.t1, self.u1, labels=[self.l2], blocked_by=[self.t2]
+        )
+
+        def summary(log):
+            return [
+                (e.field, e.authored_on, e.old_value, e.new_value) for e in log
+            ]
+
+        materialized = summary(models.build_ticket_log(self.t1))
+        self.assertEqual(len(materialized), 8)
+
+        # Pretend the history predates TicketEvent.
+        self.t1.events.all().delete()
+        models.Ticket.objects.update(log_materialized=False)
+        self.t1.refresh_from_db()
+        self.assertListEqual(
+            summary(models.build_ticket_log(self.t1)), materialized
+        )
+
+        call_command("bugz_backfill_events", stdout=io.StringIO())
+        self.t1.refresh_from_db()
+        self.assertTrue(self.t1.log_materialized)
+        self.assertEqual(self.t1.events.count(), 7)
+        self.assertListEqual(
+            summary(models.build_ticket_log(self.t1)), materialized
+        )
+
+    def test_log_windows(self):
+        for i in range(5):
+            models.save_ticket_comment(self.t1, self.u2, f"comment {i}")
+            self.t1.open = not self.t1.open
+            models.save_ticket_update(self.t1, self.u1)
+        log = list(models.build_ticket_log(self.t1, oldest_first=True))
+        self.assertListEqual(log, list(models.build_ticket_log(self.t1))[::-1])
+        self.assertEqual(len(log), 11)
+
+        windows = [models.get_ticket_log_window(self.t1, 4)]
+        while windows[-1].older_cursor:
+            windows.append(
+                models.get_ticket_log_window(
+                    self.t1, 4, before=windows[-1].older_cursor
+                )
+            )
+        self.assertEqual([len(w.events) for w in windows], [4, 4, 3])
+        self.assertListEqual(sum((w.events for w in windows[::-1]), []), log)
+        self.assertListEqual(
+            list(
+                models.build_ticket_log(
+                    self.t1, oldest_first=True, before=windows[0].older_cursor
+                )
+            ),
+            log[:-4],
+        )
+
+    @override_settings(BUGZ_LOG_WINDOW_SIZE=3)
+    def test_log_views(self):
+        for i in range(5):
+            models.save_ticket_comment(self.t1, self.u2, f"comment {i}")
+        response = self.client.get(self.t1.get_absolute_url())
+        self.assertEqual(response.context["comment_count"], 5)
+        self.assertEqual(len(response.context["log"]), 3)
+        self.assertContains(response, "comment 4")
+        self.assertNotContains(response, "comment 1")
+
+        response = self.client.get(response.context["older_log_url"])
+        self.assertContains(response, "comment 1")
+        self.assertContains(response, "the description")
+        self.assertIsNone(response.context["older_log_url"])
+        url = f"/ticket/{self.t1.pk}/log"
+        self.assertEqual(self.client.get(url).status_code, 404)
+        for cursor in ("nope", *CRAFTED_CURSORS):
+            response = self.client.get(url, {"before": cursor})
+            self.assertEqual(response.status_code, 404)
+
+    @override_settings(BUGZ_LIVE_KEEPALIVE=0.01)
+    async def test_live_stream(self):
+        comment = sync_to_async(models.save_ticket_comment)
+        first = await comment(self.t1, self.u2, "first")
+        stream = live.stream_ticket(self.t1, 0)
+        self.assertIn("first", await anext(stream))
+        self.assertEqual(await anext(stream), ": keepalive\n\n")
+
+        second = await comment(self.t1, self.u2, "second")
+        live.get_broker().publish(live.ticket_channel(self.t1.pk))
+        message = await anext(stream)
+        self.assertIn("second", message)
+        self.assertNotIn("first", message)
+        event = await models.TicketEvent.objects.aget(update=second)
+        self.assertTrue(message.startswith(f"id: {event.pk}\n"))
+        await stream.aclose()
+
+        # A row committed after a row of a higher id is read again.
+        rows = models.TicketEvent.objects.filter(ticket=self.t1)
+        cursor = live.Cursor(0)
+        cursor.add([await rows.aget(update=second)])
+        self.assertListEqual(
+            [
+                row.update_id
+                for row in await live._new_rows(self.t1, cursor, 10)
+            ],
+            [first.pk],
+        )
+        with override_settings(BUGZ_LIVE_REREAD_WINDOW=0):
+            cursor.settle()
+        self.assertEqual(cursor.settled, event.pk)
+        self.assertListEqual(await live._new_rows(self.t1, cursor, 10), [])
+
+    def test_conditional_get(self):
+        url = self.t1.get_absolute_url()
+        response = self.client.get(url)
+        etag = response["ETag"]
+        # Only the ticket is fetched, to compare versions.
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        models.save_ticket_comment(self.t1, self.u2, "hello")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        def changes(change):
+            etag = self.client.get(url)["ETag"]
+            change()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            return response.status_code == 200
+
+        self.client.force_login(self.u1)
+        # What the viewer may do.
+        self.u1.is_staff = True
+        self.assertTrue(changes(self.u1.save))
+        # Labels in past events, and users.
+        models.save_ticket_update(self.t1, self.u1, labels=[self.l2])
+        models.save_ticket_update(self.t1, self.u1, labels=[])
+        self.l2.name = "trivial"
+        self.assertTrue(changes(self.l2.save))
+        self.u2.username = "someone"
+        self.assertTrue(changes(self.u2.save))
+        self.assertFalse(
+            changes(lambda: self.u2.save(update_fields=["last_login"]))
+        )
+        self.assertTrue(changes(self.u2.delete))
+
+        self.u1.is_superuser = True
+        self.u1.save()
+        self.client.force_login(self.u1)
+        response = self.client.get("/js/labels")
+        self.assertEqual(len(response.json()), 3)
+        etag = response["ETag"]
+        response = self.client.get(
+            "/js/labels",
+            HTTP_IF_NONE_MATCH=etag,
+            HTTP_IF_MODIFIED_SINCE=response["Last-Modified"],
+        )
+        self.assertEqual(response.status_code, 304)
+        self.l3.delete()
+        response = self.client.get("/js/labels", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.json()), 2)
+
+    @override_settings(ROOT_URLCONF="tests.async_urls")
+    async def test_async_views(self):
+        self.t1.assignee = self.u2
+        await sync_to_async(models.save_ticket_update)(
+            self.t1, self.u1, labels=[self.l1, self.l2]
+        )
+        await sync_to_async(models.save_ticket_comment)(
+            self.t1, self.u2, "**hello**"
+        )
+        ticket = await models.Ticket.objects.select_related(
+            "authored_by"
+        ).aget(pk=self.t1.pk)
+        window = await models.aget_ticket_log_window(ticket, 10)
+        self.assertListEqual(
+            window.events,
+            (
+                await sync_to_async(models.get_ticket_log_window)(ticket, 10)
+            ).events,
+        )
+
+        self.u1.is_superuser = True
+        await self.u1.asave()
+        await self.async_client.aforce_login(self.u1)
+        response = await self.async_client.get("/")
+        self.assertContains(response, "test title")
+        response = await self.async_client.get("/", {"cursor": "x"})
+        self.assertEqual(response.status_code, 404)
+        url = self.t1.get_absolute_url()
+        response = await self.async_client.get(url)
+        self.assertIs(
+            response.resolver_match.func.view_class,
+            views.AsyncDetailTicketView,
+        )
+        self.assertContains(response, "<strong>hello</strong>")
+        response = await self.async_client.get(
+            url, headers={"if-none-match": response["ETag"]}
+        )
+        self.assertEqual(response.status_code, 304)
+        response = await self.async_client.post(
+            f"{url}/comment", {"comment": "again"}
+        )
+        self.assertEqual(response.status_code, 302)
+        await self.t1.arefresh_from_db()
+        self.assertEqual(self.t1.comment_count, 2)
+
+        response = await self.async_client.get("/js/labels", {"q": "ur"})
+        self.assertListEqual(
+            [label["name"] for label in response.json()], ["urgent"]
+        )
+        response = await self.async_client.post(
+            "/js/labels",
+            {"ticket": self.t1.pk, "labels": [self.l3.pk], "version": 0},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 409)
+        response = await self.async_client.post(
+            "/js/labels", "[]", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+        await self.async_client.alogout()
+        response = await self.async_client.post(
+            f"{url}/comment", {"comment": "anonymous"}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(
+            await models.TicketUpdate.objects.filter(
+                comment="anonymous"
+            ).aexists()
+        )
+
+    def test_json_api(self):
+        self.t1.assignee = self.u2
+        models.save_ticket_update(
+            self.t1, self.u1, labels=[self.l1], blocked_by=[self.t2]
+        )
+        models.save_ticket_comment(self.t1, self.u2, "*hi*")
+
+        response = self.client.get("/api/tickets", {"q": "label:urgent"})
+        self.assertEqual(response["Content-Type"], "application/json")
+        tickets = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(tickets), 1)
+        self.assertEqual(tickets[0]["id"], self.t1.pk)
+        self.assertListEqual(tickets[0]["labels"], ["urgent"])
+        self.assertListEqual(tickets[0]["blocked_by"], [self.t2.pk])
+        self.assertEqual(tickets[0]["assignee"], "seirl")
+        response = self.client.get("/api/tickets", {"q": "label:none"})
+        self.assertListEqual(
+            json.loads(b"".join(response.streaming_content)), []
+        )
+        response = self.client.get("/api/tickets", {"q": "unknown:x"})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(f"/api/ticket/{self.t1.pk}/log")
+        log = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(log), 5)
+        self.assertEqual(log[0]["comment"], "the description")
+        self.assertEqual(log[-1]["html"], "<p><em>hi</em></p>")
+        updates = {event["field"]: event for event in log[1:-1]}
+        self.assertEqual(updates["assignee"]["new_value"], "seirl")
+        self.assertListEqual(updates["labels"]["new_value"], ["urgent"])
+        self.assertListEqual(updates["blocked_by"]["new_value"], [self.t2.pk])
+
+    @override_settings(BUGZ_LIVE_KEEPALIVE=0.01)
+    async def test_live_updates(self):
+        stream = live.stream_ticket(self.t1, after=None)
+        self.assertEqual(await stream.__anext__(), ": keepalive\n\n")
+
+        def comment():
+            with self.captureOnCommitCallbacks(execute=True):
+                models.save_ticket_comment(self.t1, self.u2, "live")
+
+        await sync_to_async(comment)()
+        event = await stream.__anext__()
+        self.assertRegex(event, r"^id: \d+\ndata: ")
+        self.assertIn("<p>live</p>", event)
+        await stream.aclose()
+        self.assertFalse(live.get_broker()._subscriptions)
+
+    def test_label_typeahead(self):
+        models.Label.objects.create(name="ui-urgent")
+        self.t1.labels.set([self.l2])
+        self.t2.labels.set([self.l2, self.l3])
+        labels = catalog.get_catalog()
+        self.assertListEqual(
+            [e.name for e in labels.search("UR", 10)], ["urgent", "ui-urgent"]
+        )
+        self.assertListEqual(
+            [e.name for e in labels.search("", 2)], ["minor", "easy"]
+        )
+        # Saving a label reloads the catalog.
+        self.l1.name = "blocker"
+        self.l1.save()
+        self.assertListEqual(
+            [e.name for e in catalog.get_catalog().search("ur", 10)],
+            ["ui-urgent"],
+        )
+
+        self.u1.is_superuser = True
+        self.u1.save()
+        self.client.force_login(self.u1)
+        response = self.client.get("/js/labels", {"q": "i", "limit": 1})
+        self.assertListEqual(
+            [label["name"] for label in response.json()], ["minor"]
+        )
+        response = self.client.get("/js/labels", {"pk": [self.l3.pk, "x"]})
+        self.assertListEqual(
+            response.json(),
+            [
+                {
+                    "pk": self.l3.pk,
+                    "name": "easy",
+                    "color": "#ffffff",
+                    "usage": 1,
+                }
+            ],
+        )
+
+    def test_bulk_update(self):
+        self.t1.labels.set([self.l1])
+        t3 = models.Ticket.objects.create(title="third", open=False)
+        tickets = [self.t1, self.t2, t3]
+        # Savepoint included.
+        with self.assertNumQueries(12):
+            updates = models.bulk_update_tickets(
+                tickets,
+                self.u1,
+                values={"open": False, "assignee": self.u2},
+                add_labels=[self.l2],
+                remove_labels=[self.l1],
+            )
+        self.assertEqual(len(updates), 3)
+        for ticket in tickets:
+            ticket.refresh_from_db()
+            self.assertFalse(ticket.open)
+            self.assertEqual(ticket.assignee, self.u2)
+            self.assertSetEqual(set(ticket.labels.all()), {self.l2})
+            self.assertEqual(ticket.update_count, 1)
+            # History matches a replay, as if updated one by one.
+            self.assertListEqual(
+                [
+                    (e.field, e.old_value, e.new_value)
+                    for e in models.build_ticket_log(ticket)
+                ],
+                [
+                    (e.field, e.old_value, e.new_value)
+                    for _, e in models._replay_ticket_log(ticket)
+                ],
+            )
+        log = list(models.build_ticket_log(self.t1))
+        self.assertSetEqual(
+            {(e.field, e.id.rsplit("-", 1)[-1]) for e in log[:-1]},
+            {
+                ("open", "open"),
+                ("assignee", "assignee"),
+                ("labels", "removed"),
+                ("labels", "added"),
+            },
+        )
+
+        # Nothing changes, nothing is written.
+        self.assertListEqual(
+            models.bulk_update_tickets(tickets, self.u1, {"open": False}),
+            [],
+        )
+        updates = models.bulk_update_tickets(
+            tickets, self.u1, {"dupe_of": self.t2}
+        )
+        self.assertEqual(len(updates), 2)
+        self.t2.refresh_from_db()
+        self.assertIsNone(self.t2.dupe_of)
+
+        self.u1.is_superuser = True
+        self.u1.save()
+        self.client.force_login(self.u1)
+        response = self.client.post(
+            "/bulk",
+            {"tickets": [self.t1.pk, t3.pk], "action": "reopen", "next": "/"},
+        )
+        self.assertRedirects(response, "/", fetch_redirect_response=False)
+        self.assertEqual(models.Ticket.objects.filter(open=True).count(), 2)
+        response = self.client.post(
+            "/bulk", {"tickets": [self.t1.pk], "action": "add-label"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.client.force_login(self.u2)
+        response = self.client.post(
+            "/bulk", {"tickets": [self.t1.pk], "action": "close"}
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_rendered_markdown(self):
+        update = models.save_ticket_comment(self.t1, self.u2, "*hello*")
+        self.assertEqual(update.comment_html, "<p><em>hello</em></p>")
+        self.t1.description = "<script>x</script> **bold**"
+        models.save_ticket_update(self.t1, self.u1)
+        self.t1.refresh_from_db()
+        self.assertIn("<strong>bold</strong>", self.t1.description_html)
+        self.assertNotIn("<script>", self.t1.description_html)
+
+        log = list(models.build_ticket_log(self.t1))
+        self.assertEqual(log[1].html, "<p><em>hello</em></p>")
+        self.assertEqual(log[-1].html, self.t1.description_html)
+
+        # Stale HTML is rendered again on read, and persisted.
+        models.TicketUpdate.objects.filter(pk=update.pk).update(
+            comment_html="stale", comment_html_key="0:0"
+        )
+        log = list(models.build_ticket_log(self.t1))
+        self.assertEqual(log[1].html, "<p><em>hello</em></p>")
+        update.refresh_from_db()
+        self.assertEqual(update.comment_html_key, markup.html_key("*hello*"))
+
+    def test_export(self):
+        self.t1.assignee = self.u2
+        models.save_ticket_update(
+            self.t1, self.u1, labels=[self.l1], blocked_by=[self.t2]
+        )
+        models.save_ticket_comment(self.t1, self.u2, "me too")
+        self.t1.open = False
+        models.save_ticket_update(self.t1, self.u1, labels=[])
+        # Updates made at the same date keep their order.
+        same_date = timezone.now()
+        models.TicketUpdate.objects.update(authored_on=same_date)
+        models.TicketEvent.objects.update(authored_on=same_date)
+        log = [
+            (e.field, e.new_value if e.field == "comment" else None)
+            for e in models.build_ticket_log(self.t1)
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dump.jsonl.gz")
+            call_command(
+                "bugz_export", path, chunk_size=1, stdout=io.StringIO()
+            )
+            self.assertFalse(os.path.exists(path + ".checkpoint"))
+            with gzip.open(path, "rt") as f:
+                full = f.read()
+            records = [json.loads(line) for line in full.splitlines()]
+            self.assertListEqual(
+                [r["type"] for r in records[:5]],
+                ["label"] * 3 + ["ticket"] * 2,
+            )
+            changes = {
+                (r["field"], json.dumps(r["old"]), json.dumps(r["new"]))
+                for r in records
+                if r["type"] == "change"
+            }
+            self.assertIn(("assignee", "null", '"seirl"'), changes)
+            self.assertIn(("labels", "[]", f"[{self.l1.pk}]"), changes)
+            self.assertIn(("labels", f"[{self.l1.pk}]", "[]"), changes)
+            self.assertIn(("open", "true", "false"), changes)
+
+            # Interrupted after a few chunks, then resumed.
+            write = bugz_export.Command.write
+            calls = []
+
+            def interrupted(command, records):
+                calls.append(None)
+                if len(calls) == 5:
+                    raise KeyboardInterrupt
+                write(command, records)
+
+            with mock.patch.object(bugz_export.Command, "write", interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    call_command(
+                        "bugz_export",
+                        path,
+                        chunk_size=1,
+                        stdout=io.StringIO(),
+                    )
+            call_command(
+                "bugz_export",
+                path,
+                chunk_size=1,
+                resume=True,
+                stdout=io.StringIO(),
+            )
+            with gzip.open(path, "rt") as f:
+                self.assertEqual(f.read(), full)
+
+            models.Ticket.objects.all().delete()
+            models.Label.objects.all().delete()
+            call_command("bugz_import", path, stdout=io.StringIO())
+        ticket = models.Ticket.objects.get(title="test title")
+        self.assertListEqual(
+            [t.title for t in ticket.blocked_by.all()], ["big issue"]
+        )
+        self.assertListEqual(
+            [
+                (e.field, e.new_value if e.field == "comment" else None)
+                for e in models.build_ticket_log(ticket)
+            ],
+            log,
+        )
+
+    def test_rollups(self):
+        def report(dimension):
+            today = rollups.day_of(timezone.now())
+            return {
+                row.name: (row.open[-1], row.closed)
+                for row in rollups.report(dimension, today, today).rows
+            }
+
+        # Tickets created outside of the views are counted once rebuilt.
+        rollups.rebuild()
+        self.assertDictEqual(report("all"), {"All tickets": (2, 0)})
+        self.t1.assignee = self.u2
+        models.save_ticket_update(self.t1, self.u1, labels=[self.l1])
+        self.t1.open = False
+        models.save_ticket_update(self.t1, self.u1)
+        models.bulk_update_tickets(
+            [self.t2], self.u1, values={"open": False}, add_labels=[self.l1]
+        )
+        self.assertDictEqual(report("all"), {"All tickets": (0, 2)})
+        self.assertDictEqual(report("label"), {"urgent": (0, 2)})
+        self.assertDictEqual(
+            report("assignee"), {"seirl": (0, 1), "Unassigned": (0, 1)}
+        )
+        incremental = list(
+            models.TicketRollup.objects.order_by(
+                "day", "dimension", "key"
+            ).values_list(
+                "day", "dimension", "key", "entered", "exited", "closed"
+            )
+        )
+        call_command("bugz_rebuild_rollups", stdout=io.StringIO())
+        self.assertListEqual(
+            list(
+                models.TicketRollup.objects.order_by(
+                    "day", "dimension", "key"
+                ).values_list(
+                    "day", "dimension", "key", "entered", "exited", "closed"
+                )
+            ),
+            incremental,
+        )
+
+        # Deletions leave the open tickets of their buckets.
+        self.t2.open = True
+        models.save_ticket_update(self.t2, self.u1)
+        self.t2.assignee = self.u2
+        models.save_ticket_update(self.t2, self.u1)
+        self.assertDictEqual(
+            report("assignee"), {"seirl": (1, 1), "Unassigned": (0, 1)}
+        )
+        self.u2.delete()
+        self.assertDictEqual(report("assignee"), {"Unassigned": (1, 1)})
+        self.t2.delete()
+        self.assertDictEqual(report("all"), {"All tickets": (0, 2)})
+        self.assertDictEqual(report("label"), {"urgent": (0, 2)})
+        self.assertDictEqual(report("assignee"), {"Unassigned": (0, 1)})
+
+        superuser = get_user_model().objects.create(
+            username="root", is_superuser=True
+        )
+        self.client.force_login(superuser)
+        response = self.client.get("/report", {"dimension": "label"})
+        self.assertContains(response, "urgent")
+        response = self.client.get(
+            "/report", {"since": "2024-02-01", "until": "2024-01-01"}
+        )
+        self.assertNotIn("report", response.context)
+
+    def test_ticket_filters(self):
+        staff = get_user_model().objects.create(
+            username="staff", is_staff=True
+        )
+        self.t2.locked = True
+        self.t2.save()
+        tickets = models.Ticket.objects.order_by("pk")
+        for user in (AnonymousUser(), self.u1, self.u2, staff):
+            for permission in rules.TICKET_FILTERS:
+                self.assertListEqual(
+                    list(rules.filter_tickets(tickets, permission, user)),
+                    [t for t in tickets if user.has_perm(permission, t)],
+                    (user, permission),
+                )
+
+        request = mock.Mock(user=self.u1)
+        with mock.patch.object(
+            self.u1, "has_perm", wraps=self.u1.has_perm
+        ) as has_perm:
+            for ticket in (self.t1, self.t1, self.t2):
+                rules.has_perm(request, "bugz.can_edit_ticket", ticket)
+        self.assertEqual(has_perm.call_count, 2)
+
+        self.client.force_login(self.u1)
+        response = self.client.get("/")
+        self.assertListEqual(
+            [
+                (ticket.pk, ticket.can_edit)
+                for ticket, _ in response.context["ticket_rows"]
+            ],
+            [(self.t2.pk, False), (self.t1.pk, True)],
+        )
+
+    @override_settings(
+        MIDDLEWARE=["bugz.instrumentation.InstrumentationMiddleware"]
+        + settings.MIDDLEWARE
+    )
+    def test_instrumentation(self):
+        instrumentation.clear()
+        self.addCleanup(instrumentation.clear)
+        models.save_ticket_comment(self.t1, self.u2, "*hello*")
+        with self.assertLogs("bugz.instrumentation") as logs:
+            response = self.client.get(f"/ticket/{self.t1.pk}")
+        self.assertIn("sql;dur=", response["Server-Timing"])
+        self.assertIn("log;dur=", response["Server-Timing"])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["view"], "bugz:ticket")
+        self.assertGreater(line["queries"], 0)
+        self.assertEqual(line["events"], 2)
+
+        self.client.force_login(self.u1)
+        self.assertEqual(self.client.get("/stats").status_code, 403)
+        staff = get_user_model().objects.create(
+            username="staff", is_staff=True
+        )
+        self.client.force_login(staff)
+        with self.assertLogs("bugz.instrumentation"):
+            response = self.client.get("/stats")
+        self.assertSetEqual(
+            {view.view_name for view in response.context["views"]},
+            {"bugz:ticket", "bugz:stats"},
+        )
+        # Outside of instrumented requests, nothing is recorded.
+        self.assertIsNone(instrumentation.current())
+        self.assertEqual(instrumentation.percentile([1, 2, 3, 4], 50), 2)
+
+    def test_render_markdown_command(self):
+        models.save_ticket_comment(self.t1, self.u2, "*hello*")
+        models.TicketUpdate.objects.update(comment_html_key="0:0")
+        call_command("bugz_render_markdown", stdout=io.StringIO())
+        self.assertFalse(
+            models.TicketUpdate.objects.exclude(comment="")
+            .exclude(comment_html_key=markup.html_key("*hello*"))
+            .exists()
+        )
+        self.assertFalse(
+            any(
+                markup.is_stale_key(key)
+                for key in models.Ticket.objects.values_list(
+                    "description_html_key", flat=True
+                )
+            )
+        )
+
+    def test_activity_counters(self):
+        models.save_ticket_comment(self.t1, self.u2, "first")
+        models.save_ticket_comment(self.t1, self.u1, "second")
+        self.t1.open = False
+        update = models.save_ticket_update(self.t1, self.u1)
+        self.assertEqual(self.t1.comment_count, 2)
+        self.assertEqual(self.t1.update_count, 3)
+        self.t1.refresh_from_db()
+        self.assertEqual(self.t1.comment_count, 2)
+        self.assertEqual(self.t1.update_count, 3)
+        self.assertEqual(self.t1.last_activity_on, update.authored_on)
+
+        form = forms.SearchForm({"sort": "discussed"})
+        qs = form.apply_qs(models.Ticket.objects.all())
+        self.assertEqual(list(qs), [self.t1, self.t2])
+        models.save_ticket_comment(self.t2, self.u1, "latest")
+        form = forms.SearchForm({"sort": "updated"})
+        qs = form.apply_qs(models.Ticket.objects.all())
+        self.assertEqual(list(qs), [self.t2, self.t1])
+
+        models.Ticket.objects.update(
+            comment_count=0, update_count=0, last_activity_on=timezone.now()
+        )
+        call_command("bugz_repair_counters", stdout=io.StringIO())
+        self.t1.refresh_from_db()
+        self.t2.refresh_from_db()
+        self.assertEqual(self.t1.comment_count, 2)
+        self.assertEqual(self.t1.update_count, 3)
+        self.assertEqual(self.t1.last_activity_on, update.authored_on)
+        self.assertEqual(self.t2.comment_count, 1)
+        self.assertEqual(self.t2.update_count, 1)
+
+    def test_ticket_row_cache(self):
+        fragments.get_cache().clear()
+        self.t1.labels.set([self.l1])
+        tickets = list(models.Ticket.objects.all())
+        rows = fragments.render_ticket_rows(tickets)
+        self.assertIn("urgent", rows[tickets.index(self.t1)])
+        with self.assertNumQueries(0):
+            self.assertListEqual(fragments.render_ticket_rows(tickets), rows)
+
+        models.save_ticket_comment(self.t1, self.u2, "hello")
+        self.l1.name = "critical"
+        self.l1.save()
+        models.touch_tickets(models.Ticket.objects.filter(labels=self.l1))
+        tickets = list(
+            models.Ticket.objects.select_related("assignee", "authored_by")
+        )
+        # Only the changed row is rendered again.
+        with self.assertNumQueries(1):
+            new_rows = fragments.render_ticket_rows(tickets)
+        self.assertIn("critical", new_rows[tickets.index(self.t1)])
+        self.assertEqual(
+            new_rows[tickets.index(self.t2)], rows[tickets.index(self.t2)]
+        )
+
+        response = self.client.get("/")
+        self.assertContains(response, "critical")
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.l1 = models.Label.objects.create(name="urgent")
+        self.l2 = models.Label.objects.create(name="needs review")
+        self.u1 = get_user_model().objects.create(username="zopieux")
+        self.u2 = get_user_model().objects.create(username="seirl")
+        self.t1 = models.Ticket.objects.create(
+            authored_by=self.u1, title="crash on startup", assignee=self.u2
+        )
+        self.t2 = models.Ticket.objects.create(
+            authored_by=self.u2, title="typo in docs", open=False
+        )
+        self.t3 = models.Ticket.objects.create(
+            authored_by=self.u2, title="slow startup"
+        )
+        self.t1.labels.set([self.l1, self.l2])
+        self.t3.labels.set([self.l1])
+        self.t3.blocked_by.set([self.t1])
+        for ticket in (self.t1, self.t2, self.t3):
+            search.index_ticket(ticket)
+
+    def search(self, q, user=None):
+        form = forms.SearchForm(data={"q": q}, user=user or AnonymousUser())
+        return set(form.apply_qs(models.Ticket.objects.all()))
+
+    def test_qualifiers(self):
+        self.assertSetEqual(self.search("is:open"), {self.t1, self.t3})
+        self.assertSetEqual(self.search("is:closed"), {self.t2})
+        self.assertSetEqual(self.search("label:URGENT"), {self.t1, self.t3})
+        self.assertSetEqual(
+            self.search('label:urgent label:"needs review"'), {self.t1}
+        )
+        self.assertSetEqual(self.search("-label:urgent"), {self.t2})
+        self.assertSetEqual(self.search("author:seirl"), {self.t2, self.t3})
+        self.assertSetEqual(self.search("assignee:none"), {self.t2, self.t3})
+        self.assertSetEqual(
+            self.search(f"blocked-by:#{self.t1.pk}"), {self.t3}
+        )
+        self.assertSetEqual(self.search('startup -"slow"'), {self.t1})
+        self.assertSetEqual(self.search(""), {self.t1, self.t2, self.t3})
+
+    def test_history(self):
+        self.t1.open = False
+        self.t1.assignee = None
+        models.save_ticket_update(self.t1, self.u1, labels=[self.l1])
+        models.bulk_update_tickets([self.t3], self.u1, remove_labels=[self.l1])
+        today = timezone.localdate(
+            timezone.now(), timezone.get_default_timezone()
+        )
+        self.assertSetEqual(self.search(f"closed:{today}"), {self.t1})
+        self.assertSetEqual(self.search(f"closed:{today}.."), {self.t1})
+        self.assertSetEqual(self.search("closed:..2000-01-01"), set())
+        self.assertSetEqual(self.search(f"reopened:{today}"), set())
+        self.assertSetEqual(self.search("unassigned:seirl"), {self.t1})
+        self.assertSetEqual(self.search("unlabeled:urgent"), {self.t3})
+        self.assertSetEqual(self.search('unlabeled:"needs review"'), {self.t1})
+        self.assertSetEqual(self.search("labeled:urgent"), set())
+        self.assertFalse(
+            forms.SearchForm(data={"q": "closed:soon"}).is_valid()
+        )
+
+        # Pretend the history predates TicketChange.
+        models.TicketChange.objects.all().delete()
+        models.Ticket.objects.update(changes_indexed=False)
+        self.assertSetEqual(self.search("unassigned:seirl"), set())
+        call_command("bugz_backfill_changes", stdout=io.StringIO())
+        self.assertSetEqual(self.search("unassigned:seirl"), {self.t1})
+        self.assertSetEqual(self.search("unlabeled:urgent"), {self.t3})
+        self.assertFalse(
+            models.Ticket.objects.filter(changes_indexed=False).exists()
+        )
+
+    def test_me(self):
+        self.assertSetEqual(self.search("assignee:me", self.u2), {self.t1})
+        self.assertSetEqual(self.search("assignee:me", self.u1), set())
+        self.assertSetEqual(
+            self.search("-assignee:me"), {self.t1, self.t2, self.t3}
+        )
+        self.assertSetEqual(self.search("assignee:me"), set())
+
+    def test_invalid(self):
+        form = forms.SearchForm(data={"q": "frobnicate:yes"})
+        self.assertFalse(form.is_valid())
+        self.assertIn("q", form.errors)
+        self.assertSetEqual(self.search("is:maybe"), set())
+        for q in ("blocked-by:#99999999999999999999999", "dupe-of:0"):
+            self.assertFalse(forms.SearchForm(data={"q": q}).is_valid())
+            self.assertEqual(self.client.get("/", {"q": q}).status_code, 200)
+
+    def test_cache(self):
+        forms.search_query_cache().cache_clear()
+        self.search("is:open label:urgent")
+        self.search("is:open label:urgent")
+        info = forms.search_query_cache().cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertGreaterEqual(info.hits, 1)
+        with override_settings(BUGZ_SEARCH_CACHE_SIZE=1):
+            self.search("is:open")
+            self.search("is:closed")
+            info = forms.search_query_cache().cache_info()
+            self.assertEqual((info.maxsize, info.currsize), (1, 1))
+
+    def test_full_text(self):
+        models.save_ticket_comment(self.t2, self.u1, "also fails at startup")
+        self.t3.title = "sluggish boot"
+        models.save_ticket_update(self.t3, self.u1)
+        self.assertSetEqual(self.search("startup"), {self.t1, self.t2})
+        self.assertSetEqual(self.search("sluggish"), {self.t3})
+        self.assertSetEqual(self.search('"fails at"'), {self.t2})
+        # Title matches rank above comment matches.
+        results = forms.SearchForm(data={"q": "startup"}).apply_qs(
+            models.Ticket.objects.all()
+        )
+        self.assertListEqual(list(results), [self.t1, self.t2])
+
+    def test_delete(self):
+        backend = search.get_backend()
+        matching = backend.matching(["startup"])
+
+        def indexed():
+            with backend.connection.cursor() as cursor:
+                cursor.execute(matching.sql, matching.params)
+                return {row[0] for row in cursor.fetchall()}
+
+        self.assertSetEqual(indexed(), {self.t1.pk, self.t3.pk})
+        self.t1.delete()
+        self.assertSetEqual(indexed(), {self.t3.pk})
+        models.Ticket.objects.all().delete()
+        self.assertSetEqual(indexed(), set())
+
+    def test_simple_backend(self):
+        backend = search.SimpleSearchBackend()
+        qs = models.Ticket.objects.all()
+        self.assertSetEqual(
+            set(backend.filter(qs, [("startup", False)])), {self.t1, self.t3}
+        )
+        self.assertSetEqual(
+            set(backend.filter(qs, [("startup", False), ("slow", True)])),
+            {self.t1},
+        )
+
+    def test_rebuild_index(self):
+        search.get_backend().clear()
+        self.assertSetEqual(self.search("startup"), set())
+        call_command("bugz_rebuild_search", chunk_size=2, stdout=io.StringIO())
+        self.assertSetEqual(self.search("startup"), {self.t1, self.t3})
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # Some share a creation date to exercise the pk tie-breaker.
+        self.tickets = [
+            models.Ticket.objects.create(
+                title=f"ticket {i}",
+                created_on=now - datetime.timedelta(minutes=i // 2),
+            )
+            for i in range(7)
+        ]
+        self.expected = sorted(
+            self.tickets, key=lambda t: (t.created_on, t.pk), reverse=True
+        )
+
+    def test_walk(self):
+        paginator = pagination.KeysetPaginator(models.Ticket.objects.all(), 3)
+        page = paginator.page()
+        self.assertFalse(page.has_previous())
+        pages = [list(page)]
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            pages.append(list(page))
+        self.assertEqual([len(p) for p in pages], [3, 3, 1])
+        self.assertListEqual(sum(pages, []), self.expected)
+
+        # And back.
+        self.assertTrue(page.has_previous())
+        page = paginator.page(page.previous_cursor)
+        self.assertListEqual(list(page), pages[1])
+        page = paginator.page(page.previous_cursor)
+        self.assertListEqual(list(page), pages[0])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    @override_settings(BUGZ_TICKETS_PER_PAGE=4)
+    def test_invalid_cursor(self):
+        paginator = pagination.KeysetPaginator(models.Ticket.objects.all(), 3)
+        for cursor in ("garbage", *CRAFTED_CURSORS):
+            with self.assertRaises(pagination.InvalidCursor):
+                paginator.page(cursor)
+        for cursor in CRAFTED_CURSORS:
+            response = self.client.get("/", {"cursor": cursor})
+            self.assertEqual(response.status_code, 404)
+        # A cursor of another ordering.
+        response = self.client.get("/", {"sort": "discussed"})
+        cursor = response.context["page_obj"].next_cursor
+        response = self.client.get("/", {"sort": "updated", "cursor": cursor})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(BUGZ_TICKETS_PER_PAGE=4)
+    def test_view(self):
+        response = self.client.get("/")
+        self.assertListEqual(
+            list(response.context["tickets"]), self.expected[:4]
+        )
+        cursor = response.context["page_obj"].next_cursor
+        response = self.client.get("/", {"cursor": cursor})
+        self.assertListEqual(
+            list(response.context["tickets"]), self.expected[4:]
+        )
+        self.assertEqual(
+            self.client.get("/", {"cursor": "nope"}).status_code, 404
+        )
+
+
+class BenchmarkTestCase(TestCase):
+    def test_generate_and_benchmark(self):
+        call_command(
+            "bugz_generate_dataset",
+            users=5,
+            labels=4,
+            tickets=30,
+            updates=10,
+            batch_size=12,
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(models.Ticket.objects.count(), 30)
+        self.assertTrue(models.TicketUpdate.objects.exists())
+        # Generated events must match a replay of the generated history.
+        for ticket in models.Ticket.objects.all():
+            self.assertListEqual(
+                [
+                    (e.field, e.old_value, e.new_value)
+                    for e in models.build_ticket_log(ticket)
+                ],
+                [
+                    (e.field, e.old_value, e.new_value)
+                    for _, e in models._replay_ticket_log(ticket)
+                ],
+            )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline = os.path.join(tmp, "baseline.json")
+            call_command(
+                "bugz_benchmark",
+                iterations=1,
+                baseline=baseline,
+                save_baseline=True,
+                stdout=io.StringIO(),
+            )
+            with open(baseline) as f:
+                measures = json.load(f)
+            self.assertIn("detail_view", measures)
+
+            measures["labels_view"]["queries"] = 0
+            with open(baseline, "w") as f:
+                json.dump(measures, f)
+            with self.assertRaisesMessage(CommandError, "labels_view"):
+                call_command(
+                    "bugz_benchmark",
+                    "labels_view",
+                    iterations=1,
+                    baseline=baseline,
+                    stdout=io.StringIO(),
+                )
+
+
+class ImportTestCase(TestCase):
+    def test_import(self):
+        records = [
+            {"type": "label", "id": "bug", "name": "bug", "color": "#ff0000"},
+            {
+                "type": "ticket",
+                "id": 10,
+                "title": "crash",
+                "author": "alice",
+                "created_on": "2020-01-01T10:00:00Z",
+                "labels": ["bug"],
+                "blocked_by": [11],
+                "open": False,
+                "assignee": "bob",
+            },
+            {
+                "type": "ticket",
+                "id": 11,
+                "title": "crash again",
+                "author": "bob",
+                "created_on": "2020-01-02T10:00:00Z",
+                "dupe_of": 10,
+            },
+            {
+                "type": "comment",
+                "ticket": 10,
+                "author": "bob",
+                "created_on": "2020-01-03T10:00:00Z",
+                "comment": "me too",
+            },
+            {
+                "type": "change",
+                "ticket": 10,
+                "author": "alice",
+                "created_on": "2020-01-04T10:00:00Z",
+                "field": "assignee",
+                "old": None,
+                "new": "bob",
+            },
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dump.jsonl")
+            with open(path, "w") as f:
+                f.writelines(json.dumps(r) + "\n" for r in records)
+            changes = os.path.join(tmp, "changes.csv")
+            with open(changes, "w") as f:
+                f.write(
+                    "type,ticket,author,created_on,field,old,new\n"
+                    'change,10,bob,2020-01-05T10:00:00Z,open,true,false\n'
+                )
+            call_command(
+                "bugz_import",
+                path,
+                changes,
+                batch_size=2,
+                stdout=io.StringIO(),
+            )
+
+            with open(path, "w") as f:
+                f.write(json.dumps({"type": "comment", "ticket": 99}) + "\n")
+            with self.assertRaisesMessage(
+                CommandError, "dump.jsonl:1: Unknown ticket 99."
+            ):
+                call_command("bugz_import", path, stdout=io.StringIO())
+
+        t10 = models.Ticket.objects.get(title="crash")
+        t11 = models.Ticket.objects.get(title="crash again")
+        self.assertEqual(t10.authored_by.username, "alice")
+        self.assertEqual(t10.created_on.year, 2020)
+        self.assertListEqual(
+            [label.name for label in t10.labels.all()], ["bug"]
+        )
+        self.assertListEqual(list(t10.blocked_by.all()), [t11])
+        self.assertEqual(t11.canonical_id, t10.pk)
+        self.assertEqual(t10.comment_count, 1)
+        self.assertEqual(t10.update_count, 3)
+        self.assertEqual(t10.last_activity_on.day, 5)
+        self.assertListEqual(
+            [
+                (e.field, e.old_value, e.new_value)
+                for e in models.build_ticket_log(t10)
+            ],
+            [
+                (e.field, e.old_value, e.new_value)
+                for _, e in models._replay_ticket_log(t10)
+            ],
+        )